@@ -0,0 +1,212 @@
+from morphablemodel import MorphableModel
+from sphericalharmonics import SphericalHarmonics
+from config import Config
+from utils import loadDictionaryFromPickle
+import argparse
+import torch
+import time
+
+'''
+micro benchmarks comparing the optimized code paths against the original implementations.
+usage: python benchmark.py --config ./optimConfig.ini --frames 1 --iterations 100
+'''
+
+def timeFunction(function, iterations, device):
+    '''
+    return the average run time of function in milliseconds
+    '''
+    function() # warm up (allocations, kernels compilation...)
+    if str(device).startswith('cuda'):
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for i in range(iterations):
+        function()
+    if str(device).startswith('cuda'):
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) * 1000.0 / iterations
+
+def report(name, referenceTime, optimizedTime, error):
+    print('{:<28} reference: {:9.3f} ms  optimized: {:9.3f} ms  speedup: {:6.2f}x  max abs error: {:.3e}'.format(
+        name, referenceTime, optimizedTime, referenceTime / max(optimizedTime, 1e-9), error))
+
+def benchmarkShapeAlbedo(morphableModel, frames, iterations):
+    '''
+    compare the fused single-gemm evaluation of the shape and albedo against the original per-basis einsum
+    '''
+    device = morphableModel.device
+    sampler = morphableModel.sampler
+    shapeCoeff, expCoeff, albedoCoeff = sampler.sampleShape(frames), sampler.sampleExpression(frames), sampler.sampleAlbedo(frames)
+
+    def einsumShapeAlbedo():
+        vertices = morphableModel.shapeMean + torch.einsum('ni,ijk->njk', (shapeCoeff, morphableModel.shapePca)) + torch.einsum('ni,ijk->njk', (expCoeff, morphableModel.expressionPca))
+        diffAlbedo = morphableModel.diffuseAlbedoMean + torch.einsum('ni,ijk->njk', (albedoCoeff, morphableModel.diffuseAlbedoPca))
+        specAlbedo = morphableModel.specularAlbedoMean + torch.einsum('ni,ijk->njk', (albedoCoeff, morphableModel.specularAlbedoPca))
+        return vertices, diffAlbedo, specAlbedo
+
+    def fusedShapeAlbedo():
+        return morphableModel.computeShapeAlbedo(shapeCoeff, expCoeff, albedoCoeff)
+
+    with torch.no_grad():
+        reference = einsumShapeAlbedo()
+        optimized = [x.clone() for x in fusedShapeAlbedo()]
+        error = max([(a - b).abs().max().item() for a, b in zip(reference, optimized)])
+        report('computeShapeAlbedo', timeFunction(einsumShapeAlbedo, iterations, device), timeFunction(fusedShapeAlbedo, iterations, device), error)
+
+    shapeCoeff.requires_grad = True
+    expCoeff.requires_grad = True
+    albedoCoeff.requires_grad = True
+
+    def einsumBackward():
+        loss = sum([x.sum() for x in einsumShapeAlbedo()])
+        loss.backward()
+
+    def fusedBackward():
+        loss = sum([x.sum() for x in fusedShapeAlbedo()])
+        loss.backward()
+
+    report('computeShapeAlbedo backward', timeFunction(einsumBackward, iterations, device), timeFunction(fusedBackward, iterations, device), 0.0)
+
+def benchmarkNormals(morphableModel, normalsPath, frames, iterations):
+    '''
+    compare the single index_add normals computation against the original per neighbors group loop
+    '''
+    device = morphableModel.device
+    dic = loadDictionaryFromPickle(normalsPath)
+    vertexIndex = [torch.tensor(vi).to(device) for vi in dic['vertexIndex']]
+    vertexFaceNeighbors = [torch.tensor(ni).to(device) for ni in dic['vertexFaceNeighbors']]
+    faces = morphableModel.faces
+    sampler = morphableModel.sampler
+    with torch.no_grad():
+        vertices = morphableModel.computeShape(sampler.sampleShape(frames), sampler.sampleExpression(frames)).clone()
+
+    def loopNormals():
+        v1 = vertices[..., faces[:, 0], :]
+        v2 = vertices[..., faces[:, 1], :] - v1
+        v3 = vertices[..., faces[:, 2], :] - v1
+        faceNormals = torch.cross(v2, v3, dim=vertices.dim() - 1)
+        normals = torch.zeros_like(vertices)
+        for (ni, vi) in zip(vertexFaceNeighbors, vertexIndex):
+            normals[..., vi, :] = torch.mean(faceNormals[..., ni, :], -2)
+        return torch.nn.functional.normalize(normals, 2, -1)
+
+    def scatterNormals():
+        return morphableModel.meshNormals.computeNormals(vertices)
+
+    with torch.no_grad():
+        error = (loopNormals() - scatterNormals()).abs().max().item()
+        report('computeNormals', timeFunction(loopNormals, iterations, device), timeFunction(scatterNormals, iterations, device), error)
+
+def benchmarkSHBasis(morphableModel, frames, iterations):
+    '''
+    compare the cartesian sh basis evaluation against the original per (l, m) evaluation from the spherical angles
+    '''
+    device = morphableModel.device
+    sh = SphericalHarmonics(64, device)
+    sampler = morphableModel.sampler
+    with torch.no_grad():
+        vertices = morphableModel.computeShape(sampler.sampleShape(frames), sampler.sampleExpression(frames)).clone()
+        normals = morphableModel.computeNormals(vertices)
+    order = 8
+
+    def anglesSHBasis():
+        Y = torch.empty((normals.shape[0], normals.shape[1], (order + 1) ** 2), device=normals.device)
+        theta = torch.acos(normals[..., 2])
+        phi = torch.atan2(normals[..., 1], normals[..., 0])
+        element = 0
+        for l in range(order + 1):
+            for m in range(-l, l + 1):
+                Y[..., element] = sh.SH(l, m, theta, phi)
+                element += 1
+        return Y
+
+    def cartesianSHBasis():
+        return sh.preComputeSHBasisFunction(normals, order)
+
+    with torch.no_grad():
+        error = (anglesSHBasis() - cartesianSHBasis()).abs().max().item()
+        report('preComputeSHBasisFunction', timeFunction(anglesSHBasis, iterations, device), timeFunction(cartesianSHBasis, iterations, device), error)
+
+def benchmarkDrjitBridge(device, resolution, iterations):
+    '''
+    compare the dlpack torch <-> drjit bridge against the original numpy round trip of utils.to_torch / from_torch
+    on a rendered image sized tensor. both paths are timed and their copies measured the same way, per torch -> drjit -> torch round trip
+    '''
+    import mitsuba as mi
+    import numpy as np
+    import drjitbridge
+    mi.set_variant(drjitbridge.mitsubaVariant(device))
+    isCuda = str(device).startswith('cuda')
+    image = torch.rand([resolution, resolution, 4], device=device)
+    imageBytes = image.numel() * image.element_size()
+    array = drjitbridge.torchToDrjit(image)
+
+    def numpyToTorch():
+        # np.array: device -> host (or host copy), torch.tensor: host copy, cuda(): host -> device
+        result = torch.tensor(np.array(array))
+        return result.cuda() if isCuda else result
+
+    def dlpackToTorch():
+        return drjitbridge.drjitToTorch(array)
+
+    def drjitPointer(x):
+        # address of the drjit storage (the dlpack export shares it)
+        return drjitbridge.drjitToTorch(x).data_ptr()
+
+    def numpyRoundTrip():
+        # original from_torch (drjit array built from the tensor) then to_torch (np.array, torch.tensor and cuda())
+        x = mi.TensorXf(image)
+        host = np.array(x)
+        result = torch.tensor(host)
+        pointers = [image.data_ptr(), drjitPointer(x), host.ctypes.data, result.data_ptr()]
+        if isCuda:
+            result = result.cuda()
+            pointers.append(result.data_ptr())
+        return result, pointers
+
+    def dlpackRoundTrip():
+        x = drjitbridge.torchToDrjit(image)
+        result = drjitbridge.drjitToTorch(x)
+        return result, [image.data_ptr(), drjitPointer(x), result.data_ptr()]
+
+    def roundTripBytes(roundTrip):
+        # every conversion whose output does not share the memory of its input copied the image
+        pointers = roundTrip()[1]
+        return sum(imageBytes for a, b in zip(pointers[:-1], pointers[1:]) if a != b)
+
+    reference = numpyToTorch()
+    optimized = dlpackToTorch()
+    error = (reference - optimized).abs().max().item()
+    report('drjit -> torch', timeFunction(numpyToTorch, iterations, device), timeFunction(dlpackToTorch, iterations, device), error)
+
+    error = (numpyRoundTrip()[0] - dlpackRoundTrip()[0]).abs().max().item()
+    report('torch -> drjit -> torch', timeFunction(numpyRoundTrip, iterations, device), timeFunction(dlpackRoundTrip, iterations, device), error)
+    print('{:<28} reference: {:9d} bytes  optimized: {:9d} bytes copied per round trip'.format('drjit <-> torch copies', roundTripBytes(numpyRoundTrip), roundTripBytes(dlpackRoundTrip)))
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", required=False, default='./optimConfig.ini', help="path to the configuration file (used to load the morphable model)")
+    parser.add_argument("--frames", required=False, default=1, type=int, help="batch size used for the benchmarks")
+    parser.add_argument("--iterations", required=False, default=100, type=int, help="number of timed iterations per benchmark")
+    params = parser.parse_args()
+
+    config = Config()
+    config.fillFromDicFile(params.config)
+    if config.device == 'cuda' and torch.cuda.is_available() == False:
+        print('[WARN] no cuda enabled device found. switching to cpu... ')
+        config.device = 'cpu'
+
+    morphableModel = MorphableModel(path = config.path,
+                                    textureResolution = config.textureResolution,
+                                    trimPca = config.trimPca,
+                                    device = config.device,
+                                    useCache = config.useModelCache,
+                                    shapeRank = config.shapeRank,
+                                    expressionRank = config.expressionRank,
+                                    albedoRank = config.albedoRank,
+                                    explainedVariance = config.explainedVariance)
+
+    benchmarkShapeAlbedo(morphableModel, params.frames, params.iterations)
+    benchmarkNormals(morphableModel, config.path + '/normals.pickle', params.frames, params.iterations)
+    benchmarkSHBasis(morphableModel, params.frames, params.iterations)
+    benchmarkDrjitBridge(config.device, config.maxResolution, params.iterations)
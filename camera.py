@@ -1,5 +1,4 @@
 import torch
-import numpy as np
 
 
 
@@ -7,63 +6,111 @@ class Camera:
 
     def __init__(self, device):
         self.device = device
+        self.matrix = None
+        self.buffers = {}
+
+    def getBuffer(self, name, shape, reference):
+        '''
+        return a preallocated output buffer (reallocated only if the shape changes)
+        :param name: buffer name
+        :param shape: buffer shape
+        :param reference: tensor giving the dtype and device of the buffer
+        '''
+        buffer = self.buffers.get(name)
+        if buffer is None or buffer.shape != torch.Size(shape) or buffer.dtype != reference.dtype or buffer.device != reference.device:
+            buffer = torch.empty(shape, dtype=reference.dtype, device=reference.device)
+            self.buffers[name] = buffer
+        return buffer
+
+    def computeRotation(self, rotation):
+        '''
+        create rotation matrices (rotz @ roty @ rotx) from euler angles
+        rotation: [n, 3]
+        return: rotation matrix [n, 3, 3]
+        '''
+        assert (rotation.dim() == 2 and rotation.shape[-1] == 3)
 
-        self.rotXm1 = torch.tensor(np.array([[0., 0., 0.], [0., 1., 0.], [0., 0., 1.]]), dtype=torch.float, device=device)
-        self.rotXm2 = torch.tensor(np.array([[0., 0., 0.], [0., 0., -1.], [0., 1., 0.]]), dtype=torch.float, device=device)
-        self.rotXm3 = torch.tensor(np.array([[1., 0., 0.], [0., 0., 0.], [0., 0., 0.]]), dtype=torch.float, device=device)
+        cos = torch.cos(rotation)
+        sin = torch.sin(rotation)
+        cx, cy, cz = cos.unbind(-1)
+        sx, sy, sz = sin.unbind(-1)
 
-        self.rotYm1 = torch.tensor(np.array([[1., 0., 0.], [0., 0., 0.], [0., 0., 1.]]), dtype=torch.float, device=device)
-        self.rotYm2 = torch.tensor(np.array([[0., 0., 1.], [0., 0., 0.], [-1., 0., 0.]]), dtype=torch.float, device=device)
-        self.rotYm3 = torch.tensor(np.array([[0., 0., 0.], [0., 1., 0.], [0., 0., 0.]]), dtype=torch.float, device=device)
+        return torch.stack([cz * cy, cz * sy * sx - sz * cx, cz * sy * cx + sz * sx,
+                            sz * cy, sz * sy * sx + cz * cx, sz * sy * cx - cz * sx,
+                            -sy, cy * sx, cy * cx], -1).view(-1, 3, 3)
 
-        self.rotZm1 = torch.tensor(np.array([[1., 0., 0.], [0., 1., 0.], [0., 0., 0.]]), dtype=torch.float, device=device)
-        self.rotZm2 = torch.tensor(np.array([[0., -1., 0.], [1., 0., 0.], [0., 0., 0.]]), dtype=torch.float, device=device)
-        self.rotZm3 = torch.tensor(np.array([[0., 0., 0.], [0., 0., 0.], [0., 0., 1.]]), dtype=torch.float, device=device)
-        
-        self.matrix = None
     def computeTransformation(self, rotation, translation):
         '''
         create a transformation matrix from rotation and translation
         rotation: [n, 3]
         translation: [n, 3]
-        return: transformation matrix [n, 4, 3]
+        return: transformation matrix [n, 3, 4]
         '''
 
         assert (rotation.dim() == 2 and rotation.shape[-1] == 3)
         assert(translation.dim() == 2 and translation.shape[-1] == 3)
 
-        rotx = torch.cos(rotation[..., :1, None]).expand(-1, 3, 3) * self.rotXm1 \
-               + torch.sin(rotation[..., :1, None]).expand(-1, 3, 3) * self.rotXm2 \
-               + self.rotXm3
-        roty = torch.cos(rotation[..., 1:2, None]).expand(-1, 3, 3) * self.rotYm1 \
-               + torch.sin(rotation[..., 1:2, None]).expand( -1, 3, 3) * self.rotYm2 \
-               + self.rotYm3
-        rotz = torch.cos(rotation[..., 2:, None]).expand(-1, 3, 3) * self.rotZm1 \
-               + torch.sin(rotation[..., 2:, None]).expand(-1, 3, 3) * self.rotZm2 \
-               + self.rotZm3
-
-        rotMatrix = torch.matmul(rotz, torch.matmul(roty, rotx))
+        rotMatrix = self.computeRotation(rotation)
         transformation = torch.cat((rotMatrix, translation[ :, :, None]), -1)
-        
+
         self.matrix = transformation
         return transformation
 
+    def isRecording(self, *tensors):
+        return torch.is_grad_enabled() and any(t.requires_grad for t in tensors)
+
     def transformVertices(self, vertices, translation, rotation):
         '''
-        transform vertices by the rotation and translation vector
+        transform vertices by the rotation and translation vector (R @ v + t in a single batched gemm)
         :param vertices: tensor [n, verticesNumber, 3]
         :param translation:  tensor [n, 3]
         :param rotation: tensor [n, 3]
         :return: transformed vertices [n, verticesNumber, 3]
         '''
         assert (vertices.dim() == 3 and vertices.shape[-1] == 3)
+        assert (translation.dim() == 2 and translation.shape[-1] == 3)
+
+        rotMatrix = self.computeRotation(rotation)
+        return torch.baddbmm(translation[:, None, :], vertices, rotMatrix.transpose(1, 2))
+
+    def projectVertices(self, cameraVertices, focals, centers):
+        '''
+        project vertices in camera space to pixels (pinhole camera)
+        when autograd is not recording, the result is written into a preallocated buffer that is overwritten by the next call
+        :param cameraVertices: tensor [n, verticesNumber, 3]
+        :param focals: tensor [n]
+        :param centers: tensor [n, 2]
+        :return: pixels coordinates [n, verticesNumber, 2]
+        '''
+        assert (cameraVertices.dim() == 3 and cameraVertices.shape[-1] == 3)
+        assert (focals.dim() == 1)
+        assert (centers.dim() == 2 and centers.shape[-1] == 2)
+
+        if self.isRecording(cameraVertices, focals, centers):
+            return torch.addcmul(centers[:, None, :], focals.view(-1, 1, 1), cameraVertices[..., :2] / cameraVertices[..., 2:])
+
+        pixels = self.getBuffer('pixels', [cameraVertices.shape[0], cameraVertices.shape[1], 2], cameraVertices)
+        torch.div(cameraVertices[..., :2], cameraVertices[..., 2:], out=pixels)
+        return pixels.mul_(focals.view(-1, 1, 1)).add_(centers[:, None, :])
+
+    def transformAndProject(self, vertices, translation, rotation, focals, centers):
+        '''
+        transform vertices to camera space and project them to pixels in one pass
+        when autograd is not recording, the camera space vertices and the pixels are written into preallocated buffers overwritten by the next call
+        :param vertices: tensor [n, verticesNumber, 3]
+        :param translation: tensor [n, 3]
+        :param rotation: tensor [n, 3]
+        :param focals: tensor [n]
+        :param centers: tensor [n, 2]
+        :return: pixels coordinates [n, verticesNumber, 2]
+        '''
+        assert (vertices.dim() == 3 and vertices.shape[-1] == 3)
+        assert (translation.dim() == 2 and translation.shape[-1] == 3)
 
-        transformationMatrix = self.computeTransformation(rotation, translation)
-        ones = torch.ones([vertices.shape[0], vertices.shape[1], 1], dtype = torch.float, device = vertices.device)
-        vertices = torch.cat((vertices, ones), -1)
-        framesNumber = transformationMatrix.shape[0]
-        verticesNumber = vertices.shape[1]
-        out = torch.matmul(transformationMatrix.view(1, framesNumber, 1, 3, 4),
-                           vertices.view(framesNumber, verticesNumber, 4, 1)).view(1, framesNumber, verticesNumber, 3)
-        return out[0]
-     
\ No newline at end of file
+        rotMatrix = self.computeRotation(rotation)
+        if self.isRecording(vertices, translation, rotation):
+            cameraVertices = torch.baddbmm(translation[:, None, :], vertices, rotMatrix.transpose(1, 2))
+        else:
+            cameraVertices = self.getBuffer('cameraVertices', [vertices.shape[0], vertices.shape[1], 3], vertices)
+            torch.baddbmm(translation[:, None, :], vertices, rotMatrix.transpose(1, 2), out=cameraVertices)
+        return self.projectVertices(cameraVertices, focals, centers)
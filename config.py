@@ -9,11 +9,23 @@ class Config:
 
 		#tracker
 		self.lamdmarksDetectorType = 'mediapipe'  # Options ['mediapipe', 'fan']
+		self.fanBatchSize = 8 # number of frames sent at once to the fan face detector
+		self.trackFaceBoxes = False # fan only: if True the input frames are consecutive frames of a video, the face box of a frame is taken from the previous frame landmarks and the face detector only runs when the tracking is lost
+		self.useLandmarksCache = True # if True the detected landmarks are stored in a cache file (keyed by image content and detection settings) and re-runs on the same images skip the detection
+		self.landmarksCachePath = '' # path of the landmarks cache file (empty: next to the input image/folder, <input>.landmarks.cache)
 
 		#morphable model
 		self.path = 'baselMorphableModel'
 		self.textureResolution = 256 #256 or 512
 		self.trimPca = False  # if True keep only a subset of the pca basis (eigen vectors)
+		self.shapeRank = 0 # number of leading shape pca components to use (0: all or see explainedVariance)
+		self.expressionRank = 0 # number of leading expression pca components to use (0: all or see explainedVariance), 40 is enough for tracking
+		self.albedoRank = 0 # number of leading albedo pca components to use (0: all or see explainedVariance)
+		self.explainedVariance = 0.0 # if > 0, the ranks not set explicitly keep the components explaining this fraction of the pca variance (ex: 0.99)
+		self.useTextureBasis = False # if True the albedo basis is precomputed in texture space (stage 2 generates textures with one gemm instead of per vertex albedo + uv mapping)
+		self.textureBasisRank = 0 # number of albedo components precomputed in texture space (0: all), the others use the per vertex path. each costs 2 * textureResolution^2 * 3 floats
+		self.useModelCache = True # if True the morphable model is loaded from memory mapped binary caches (built on first run next to the pickle files)
+		self.verifyModelCache = False # if True the checksum of the cached arrays is verified at startup (slower)
 
 		#spherical harmonics
 		self.bands = 9
@@ -23,16 +35,29 @@ class Config:
 		#camera
 		self.camFocalLength = 500.0 #focal length in pixels (f =  f_{mm} * imageWidth / sensorWidth)
 		self.optimizeFocalLength = True #if True the initial focal length is estimated otherwise it remains constant
+		self.pnpSolver = 'batched' # solver used to initialize the head pose. Options ['batched', 'opencv'] (batched solves all frames at once in torch and falls back to opencv for degenerate frames)
+		self.pnpWorkers = 0 # number of threads used by the opencv pnp solver (0: serial)
 
 		#image
 		self.maxResolution = 256
+		self.videoChunkSize = 64 # video input: number of consecutive frames decoded and optimized at once
+		self.trackingMode = False # video or folder of consecutive frames input: if True the identity is solved on the first frame, then every frame is tracked from the previous one (see trackingIterations)
+		self.trackingIterations = 30 # tracking mode: number of pose, expression and light refinement iterations per frame (vertex renderer)
+		self.weightLandmarksLossTracking = 0.01 # tracking mode: landmarks weight during the per frame refinement
 
 		#optimization
 		self.iterStep1 = 2000 # number of iterations for the coarse optim
+		self.step1Solver = 'adam' # solver used for the coarse (landmarks) optim. Options ['adam', 'lm'] (lm: levenberg-marquardt, converges in tens of iterations instead of thousands)
+		self.lmIterations = 50 # maximum number of levenberg-marquardt iterations for the coarse optim (step1Solver = 'lm')
 		self.iterStep2 = 400 #number of iteration for the first dense optim (based on statistical priors)
+		self.pyramidResolutions = '' # stage 2 coarse to fine schedule: comma separated widths (in pixels) of the coarse levels, ex: '64,128' (empty: always render at full resolution)
+		self.pyramidIterations = '' # stage 2 coarse to fine schedule: comma separated number of iterations of each coarse level, ex: '150,100' (the remaining iterations run at full resolution)
 		self.iterStep3 = 100 #number of iterations for refining the statistical albedo priors
 		self.weightLandmarksLossStep2 = 0.001 #landmarks weight during step2
 		self.weightLandmarksLossStep3 = 0.001  # landmarks weight during step3
+		self.convergenceTolerance = 0.0 # early stopping, disabled by default (0.0: always run iterStep1/2/3 iterations). set it explicitly (ex: 1e-4) to stop a stage when its loss did not improve by more than this fraction for convergencePatience iterations
+		self.convergencePatience = 50 # early stopping: number of iterations without improvement before stopping a stage
+		self.convergenceMinIterations = 100 # early stopping: minimum number of iterations of a stage
 
 		self.weightShapeReg = 0.001 #weight for shape regularization
 		self.weightExpressionReg = 0.001  # weight for expression regularization
@@ -57,7 +82,9 @@ class Config:
 		self.rtSamples = 500 #the number of ray tracer samples to render the final output
 		self.rtTrainingSamples = 8  # number of ray tracing to use during training
 		self.bounces = 2 # number of bounces
+		self.mitsubaThreads = 0 # cpu device only (mitsuba llvm variant): number of threads used by the renderer (0: all the cores)
 		self.smoothing = True #should we smooth the face when doing diff
+		self.maskTolerance = 0.5 # mitsuba renderer: the face mask is recomputed only when a projected vertex moved by more than this number of pixels (0: recomputed at every iteration)
 	def fillFromDicFile(self, filePath):
 		'''
 		overwrite default config
@@ -0,0 +1,128 @@
+import numpy as np
+import torch
+import math
+
+class ConvergenceMonitor:
+
+    def __init__(self, tolerance = 1e-4, patience = 50, minIterations = 100):
+        '''
+        detect when an optimization stops improving.
+        the optimization is considered converged when the loss did not improve the best loss seen so far by more than
+        tolerance (relative) during patience consecutive iterations, and at least minIterations iterations were done
+        :param tolerance: minimum relative improvement of the best loss (<= 0 disables early stopping)
+        :param patience: number of iterations without improvement before stopping
+        :param minIterations: minimum number of iterations before stopping
+        '''
+        self.tolerance = tolerance
+        self.patience = patience
+        self.minIterations = minIterations
+        self.best = math.inf
+        self.staleIterations = 0
+        self.iterations = 0
+        self.converged = False
+
+    def step(self, loss):
+        '''
+        record the loss of an iteration
+        :param loss: float
+        :return: True if the optimization has converged and should stop
+        '''
+        self.iterations += 1
+        if loss < self.best - self.tolerance * abs(self.best) or math.isinf(self.best):
+            self.best = loss
+            self.staleIterations = 0
+        else:
+            self.staleIterations += 1
+
+        self.converged = self.tolerance > 0. and self.iterations >= self.minIterations and self.staleIterations >= self.patience
+        return self.converged
+
+class FrameConvergenceMonitor:
+
+    def __init__(self, framesNumber, tolerance = 1e-4, patience = 50, minIterations = 100, dropFrames = True):
+        '''
+        per frame version of ConvergenceMonitor for multi frames optimizations.
+        a frame whose loss stopped improving is frozen: it is no more rendered, the gradients of its parameters are masked
+        and its parameters are restored after each optimizer step (adam would otherwise keep moving them with its momentum).
+        the optimization is converged when all the frames are frozen
+        :param framesNumber: number of frames
+        :param dropFrames: if False the frozen frames are still rendered and kept in the loss, only their per frame parameters are frozen.
+        required when parameters shared by all the frames are optimized (shared identity), they would otherwise only fit the remaining frames
+        (see ConvergenceMonitor for the other parameters)
+        '''
+        self.framesNumber = framesNumber
+        self.dropFrames = dropFrames
+        self.tolerance = tolerance
+        self.patience = patience
+        self.minIterations = minIterations
+        self.best = np.full([framesNumber], np.inf)
+        self.staleIterations = np.zeros([framesNumber], dtype=np.int64)
+        self.active = np.ones([framesNumber], dtype=bool)
+        self.iterations = 0
+        self.converged = False
+        self.savedParameters = {}
+
+    def activeFrames(self, device):
+        '''
+        :return: indices of the frames still optimized (long tensor on device) or None if all frames are active (or frames are not dropped)
+        '''
+        if not self.dropFrames or self.active.all():
+            return None
+        return torch.from_numpy(self.active.nonzero()[0]).to(device)
+
+    def step(self, frameLosses, frames = None):
+        '''
+        record the losses of the active frames for an iteration
+        :param frameLosses: loss of each active frame (numpy array or tensor [k])
+        :param frames: indices of the active frames the losses belong to (as returned by activeFrames)
+        :return: True if all the frames have converged
+        '''
+        self.iterations += 1
+        if hasattr(frameLosses, 'detach'):
+            frameLosses = frameLosses.detach().cpu().numpy()
+        indices = np.arange(self.framesNumber) if frames is None else frames.cpu().numpy()
+
+        best = self.best[indices]
+        improved = (frameLosses < best - self.tolerance * np.abs(best)) | np.isinf(best)
+        self.best[indices] = np.where(improved, frameLosses, best)
+        self.staleIterations[indices] = np.where(improved, 0, self.staleIterations[indices] + 1)
+
+        if self.tolerance > 0. and self.iterations >= self.minIterations:
+            self.active[indices] &= self.staleIterations[indices] < self.patience
+        self.converged = not self.active.any()
+        return self.converged
+
+    def reset(self):
+        '''
+        forget the loss history and unfreeze all the frames (ex: the loss scale changed), the iterations count is kept
+        '''
+        self.best[:] = np.inf
+        self.staleIterations[:] = 0
+        self.active[:] = True
+        self.converged = False
+
+    def maskGradients(self, parameters):
+        '''
+        zero the gradients of the frozen frames (call before optimizer.step())
+        :param parameters: list of per frame parameters [framesNumber, ...] (shared parameters must not be given)
+        '''
+        if self.active.all():
+            return
+        for p in parameters:
+            if p.grad is not None:
+                p.grad[torch.from_numpy(~self.active).to(p.device)] = 0.
+
+    def restoreParameters(self, parameters):
+        '''
+        reset the parameters of the frozen frames to their value when they converged (call after optimizer.step())
+        :param parameters: list of per frame parameters [framesNumber, ...] (shared parameters must not be given)
+        '''
+        with torch.no_grad():
+            for p in parameters:
+                saved = self.savedParameters.get(id(p))
+                if saved is None or saved.shape != p.shape:
+                    self.savedParameters[id(p)] = p.detach().clone()
+                    continue
+                active = torch.from_numpy(self.active).to(p.device)
+                saved[active] = p[active]
+                p[~active] = saved[~active]
@@ -0,0 +1,45 @@
+import torch
+import drjit as dr
+import mitsuba as mi
+
+'''
+exchange tensors between torch and drjit through dlpack: drjit maps the memory of a contiguous torch tensor (and torch the memory of an
+evaluated drjit array) without any copy, instead of the numpy round trip (device -> host -> device) of a torch.tensor(np.array(x)) conversion.
+a copy is only made when the tensor is not contiguous, does not have the expected scalar type or is not on the drjit backend device,
+the number of bytes copied that way is accumulated in bytesCopied (see benchmark.py).
+'''
+
+bytesCopied = 0
+scalarTypes = {dr.VarType.Float32: torch.float32, dr.VarType.Float64: torch.float64, dr.VarType.Int32: torch.int32, dr.VarType.Int64: torch.int64}
+
+def mitsubaVariant(device):
+    '''
+    mitsuba variant matching a torch device (cuda_ad_rgb on cuda, llvm_ad_rgb on cpu)
+    '''
+    return 'cuda_ad_rgb' if torch.device(device).type == 'cuda' else 'llvm_ad_rgb'
+
+def torchToDrjit(tensor, dtype = None):
+    '''
+    convert a torch tensor to a drjit array sharing its memory
+    :param tensor: torch tensor (the gradients are not tracked)
+    :param dtype: drjit type of the result (default mi.TensorXf), its backend and scalar type must match the tensor or a copy is made
+    :return: drjit array of type dtype
+    '''
+    global bytesCopied
+    if dtype is None:
+        dtype = mi.TensorXf
+    source = tensor.detach()
+    scalarType = scalarTypes.get(dtype.Type, source.dtype)
+    tensor = source.to(device = 'cuda' if dr.is_cuda_v(dtype) else 'cpu', dtype = scalarType).contiguous()
+    if tensor.data_ptr() != source.data_ptr():
+        bytesCopied += tensor.numel() * tensor.element_size()
+    return dtype(tensor)
+
+def drjitToTorch(array):
+    '''
+    convert a drjit array to a torch tensor sharing its memory (on the device of the drjit backend)
+    :param array: drjit array (evaluated if needed)
+    :return: torch tensor
+    '''
+    dr.eval(array)
+    return array.torch()
@@ -95,33 +95,31 @@ class ImageFolder:
         self.imageNames = []
         supportedFormats = ['.jpg', '.jpeg', '.png']
 
-        filenames = next(walk(path), (None, None, []))[2]
+        # sorted so that the frames of a sequence are in order (the directory listing order is arbitrary)
+        filenames = sorted(filename for filename in next(walk(path), (None, None, []))[2]
+                           if os.path.splitext(filename)[1].lower() in supportedFormats)
         width = None
         height = None
-        ct = 0
 
         assert (len(filenames) > 0)  # no images found in the given directory
-        for filename in filenames:
-            if os.path.splitext(filename)[1].lower() in supportedFormats:
-                image = Image(path + '/' + filename, device, maxRes)
+        for ct, filename in enumerate(filenames):
+            image = Image(path + '/' + filename, device, maxRes)
 
-                if width is None:
-                    width = image.width
-                    height = image.height
-                    self.tensor = torch.zeros([len(filenames), height, width, image.channels], device = self.device)
-                    self.center = torch.zeros([len(filenames), 2], device = self.device)
+            if width is None:
+                width = image.width
+                height = image.height
+                self.tensor = torch.zeros([len(filenames), height, width, image.channels], device = self.device)
+                self.center = torch.zeros([len(filenames), 2], device = self.device)
 
-                assert image.width == width and image.height == height
+            assert image.width == width and image.height == height
 
-                self.width = image.width
-                self.height = image.height
-                self.channels = image.channels
-                self.tensor[ct] = image.tensor[0].clone().detach()
-                self.center[ct] = image.center[0].clone().detach()
-                self.imageNames.append(image.imageName)
-                image = None
-
-                ct += 1
+            self.width = image.width
+            self.height = image.height
+            self.channels = image.channels
+            self.tensor[ct] = image.tensor[0].clone().detach()
+            self.center[ct] = image.center[0].clone().detach()
+            self.imageNames.append(image.imageName)
+            image = None
 
 
         import gc
@@ -132,5 +130,94 @@ class ImageFolder:
     def asNumpyArray(self):
         return self.tensor.detach().cpu().numpy() * 255.0
 
+videoFormats = ['.mp4', '.avi', '.mov', '.mkv', '.webm', '.m4v']
+
+def isVideoFile(path):
+    '''
+    return True if path is a video file (based on its extension)
+    '''
+    return os.path.isfile(path) and os.path.splitext(path)[1].lower() in videoFormats
+
+class VideoChunk:
+
+    def __init__(self, tensor, firstFrame, device):
+        '''
+        a chunk of consecutive video frames, exposes the same attributes as ImageFolder
+        :param tensor: frames tensor [n, h, w, channels]
+        :param firstFrame: index of the first frame of the chunk in the video
+        '''
+        self.device = device
+        self.tensor = tensor
+        self.firstFrame = firstFrame
+        self.height = tensor.shape[1]
+        self.width = tensor.shape[2]
+        self.channels = tensor.shape[3]
+        self.gamma = 2.2
+        self.center = torch.tensor([self.width / 2, self.height / 2], dtype=torch.float32, device=self.device).reshape(1, -1).repeat(tensor.shape[0], 1)
+        self.imageNames = ['frame' + str(firstFrame + i) for i in range(tensor.shape[0])]
+
+    def frame(self, i):
+        '''
+        return frame i of the chunk as a single frame VideoChunk (no copy)
+        '''
+        return VideoChunk(self.tensor[i: i + 1], self.firstFrame + i, self.device)
+
+    @property
+    def asNumpyArray(self):
+        return self.tensor.detach().cpu().numpy() * 255.0
+
+class VideoSource:
+
+    def __init__(self, path, device, maxRes = 256, chunkSize = 64):
+        '''
+        class that decodes a video file in chunks of consecutive frames, so that only chunkSize frames are in memory at once
+        the frames are resized as Image does (maxRes x maxRes)
+        :param path: the path to the video
+        :param device: where to store the frames ('cpu' or 'cuda')
+        :param maxRes: resolution of the frames
+        :param chunkSize: maximum number of frames per chunk
+        '''
+        assert(maxRes > 0 and chunkSize > 0)
+        self.path = path
+        self.device = device
+        self.maxRes = maxRes
+        self.chunkSize = chunkSize
+
+        capture = cv2.VideoCapture(path)
+        if not capture.isOpened():
+            raise RuntimeError('could not open video: ' + path)
+        self.framesNumber = int(capture.get(cv2.CAP_PROP_FRAME_COUNT)) #estimation only for some containers
+        self.fps = capture.get(cv2.CAP_PROP_FPS)
+        capture.release()
+
+    def __iter__(self):
+        '''
+        yield VideoChunk objects of at most chunkSize frames, in order
+        '''
+        print('loading video from path:', self.path)
+        capture = cv2.VideoCapture(self.path)
+        if not capture.isOpened():
+            raise RuntimeError('could not open video: ' + self.path)
+        try:
+            buffer = np.empty([self.chunkSize, self.maxRes, self.maxRes, 3], dtype=np.uint8)
+            firstFrame = 0
+            while True:
+                count = 0
+                while count < self.chunkSize:
+                    success, frame = capture.read()
+                    if not success:
+                        break
+                    buffer[count] = cv2.resize(cv2.cvtColor(frame[..., 0:3], cv2.COLOR_BGR2RGB), (self.maxRes, self.maxRes))
+                    count += 1
+                if count == 0:
+                    break
+                tensor = torch.from_numpy(buffer[:count]).to(self.device).to(dtype=torch.float32) / 255.0
+                yield VideoChunk(tensor, firstFrame, self.device)
+                firstFrame += count
+                if count < self.chunkSize:
+                    break
+        finally:
+            capture.release()
+
 if __name__ == "__main__":
     pass
\ No newline at end of file
@@ -0,0 +1,78 @@
+from modelcache import loadModelCache, writeModelCache
+import numpy as np
+import hashlib
+import torch
+
+'''
+persistent landmarks cache: the 2d landmarks detected on a dataset are stored in a single binary file (see modelcache.py)
+so that re-running the optimizer on the same images skips the landmarks detection.
+an entry is addressed by the hash of the image content (as loaded, so after resizing to maxResolution) and of the detection settings
+(detector type, landmarks mask...): changing any of them gives a different key.
+'''
+
+class LandmarksCache:
+
+    def __init__(self, cachePath, settings):
+        '''
+        open (or create) a landmarks cache
+        :param cachePath: path of the cache file
+        :param settings: string describing everything (other than the image) the landmarks depend on
+        '''
+        self.path = cachePath
+        self.settingsDigest = hashlib.sha1(settings.encode('utf-8')).digest()
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.modified = False
+
+        cache = loadModelCache(cachePath)
+        if cache is not None and 'keys' in cache:
+            keys = cache.array('keys')
+            offsets = cache.array('offsets')
+            landmarks = cache.array('landmarks')
+            for i in range(keys.shape[0]):
+                self.entries[keys[i].tobytes()] = np.array(landmarks[offsets[i]: offsets[i + 1]])
+
+    def imageKey(self, image):
+        '''
+        content address of an image
+        :param image: float tensor [h, w, channels] in [0, 1]
+        :return: bytes
+        '''
+        pixels = (image.detach() * 255.0).round().clamp(0, 255).to(torch.uint8).cpu().numpy()
+        h = hashlib.sha1(self.settingsDigest)
+        h.update(np.array(pixels.shape, dtype=np.int64).tobytes())
+        h.update(pixels.tobytes())
+        return h.digest()
+
+    def get(self, key):
+        '''
+        :return: landmarks numpy array [landmarksNumber, 2] or None if the key is not in the cache
+        '''
+        landmarks = self.entries.get(key)
+        if landmarks is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return landmarks
+
+    def put(self, key, landmarks):
+        self.entries[key] = np.asarray(landmarks, dtype=np.float32).reshape(-1, 2)
+        self.modified = True
+
+    def save(self):
+        '''
+        write the cache file if new entries were added
+        '''
+        if not self.modified:
+            return
+        keys = list(self.entries.keys())
+        counts = np.array([self.entries[k].shape[0] for k in keys], dtype=np.int64)
+        arrays = {'keys': np.frombuffer(b''.join(keys), dtype=np.uint8).reshape(len(keys), -1),
+                  'offsets': np.concatenate([np.zeros(1, dtype=np.int64), np.cumsum(counts)]),
+                  'landmarks': np.concatenate([self.entries[k] for k in keys]).astype(np.float32)}
+        try:
+            writeModelCache(self.path, arrays)
+            self.modified = False
+        except OSError as e:
+            print('[WARN] could not write landmarks cache:', e)
@@ -5,11 +5,14 @@ import cv2
 
 
 class LandmarksDetectorFAN:
-	def __init__(self, mask, device):
+	def __init__(self, mask, device, batchSize = 8, trackFaceBoxes = False, boxMargin = 0.1):
 		'''
 		init landmark detector with given mask on target device
 		:param mask: valid mask for the 68 landmarks of shape [n]
 		:param device:
+		:param batchSize: number of frames sent at once to the face detector
+		:param trackFaceBoxes: if True the images are consecutive frames of a sequence: the face box of a frame is taken from the landmarks of the previous one and the face detector only runs when the tracking is lost
+		:param boxMargin: margin (fraction of the landmarks bounds size) added around the landmarks bounds to build a face box
 		'''
 		assert(mask.dim() == 1)
 		assert(mask.max().item() <= 67 and mask.min().item() >= 0)
@@ -17,44 +20,101 @@ class LandmarksDetectorFAN:
 		self.device = device
 		self.landmarksDetector = face_alignment.FaceAlignment(face_alignment.LandmarksType._3D, flip_input=False, device=self.device)
 		self.mask = mask.to(self.device)
+		self.maskNumpy = self.mask.detach().cpu().numpy()
+		self.batchSize = max(1, batchSize)
+		self.trackFaceBoxes = trackFaceBoxes
+		self.boxMargin = boxMargin
+		self.faceBox = None # face box of the last processed frame (used when tracking)
 
-	def detect(self, images):
+	def setVideoMode(self, isVideo):
+		'''
+		if isVideo is True the images passed to detect are consecutive frames of a sequence (see trackFaceBoxes)
+		'''
+		self.trackFaceBoxes = isVideo
+		self.faceBox = None
+
+	def detect(self, images, faceBoxes = None):
 		'''
 		detect landmakrs on a batch of images
 		:param images: tensor [n, height, width, channels]
+		:param faceBoxes: optional face boxes [n, 4] (x1, y1, x2, y2) in pixels. if given the face detector is skipped (except for frames where no face is found in the box)
 		:return: tensor [n, landmarksNumber, 2]
 		'''
-		#landmarks = torch.zeros([images.shape[0], self.mask.shape[0], 2], device = images.device, dtype = torch.float32)
 		assert(images.dim() == 4)
-		landmarks = []
-		for i in range(len(images)):
-			land = self._detect(images[i].detach().cpu().numpy() * 255.0)
-			landmarks.append(land)
+		assert(faceBoxes is None or len(faceBoxes) == images.shape[0])
+
+		frames = images.detach() * 255.0
+		if faceBoxes is not None:
+			landmarks = [self._detect(frames[i], faceBoxes[i]) for i in range(len(frames))]
+		elif self.trackFaceBoxes:
+			landmarks = []
+			for i in range(len(frames)):
+				land = self._detect(frames[i], self.faceBox)
+				self.faceBox = self.boxFromLandmarks(land, frames.shape[2], frames.shape[1])
+				landmarks.append(land)
+		else:
+			landmarks = []
+			for i in range(0, len(frames), self.batchSize):
+				landmarks += self._detectBatch(frames[i: i + self.batchSize])
 
 		torch.set_grad_enabled(True) #it turns out that the landmark detector disables the autograd engine. this line fixes this
- 		#UserWarning: Creating a tensor from a list of numpy.ndarrays is extremely slow. Please consider converting the list to a single numpy.ndarray with numpy.array() before converting to a tensor. 
-  		
-		# landmarks = np.array(landmarks) 
-		return torch.tensor(landmarks, device = self.device)
- 
-	def _detect(self, image):
-		arr = self.landmarksDetector.get_landmarks_from_image(image, None)
+		landmarks = np.stack([land[self.maskNumpy, :2] for land in landmarks]).astype(np.float32)
+		return torch.from_numpy(landmarks).to(self.device)
+
+	def boxFromLandmarks(self, landmarks, width, height):
+		'''
+		face box from the bounds of the 68 landmarks
+		:param landmarks: numpy array [68, 2 or 3]
+		:return: numpy array [x1, y1, x2, y2] or None if the landmarks do not look like a face anymore (tracking lost)
+		'''
+		low = landmarks[:, :2].min(0)
+		high = landmarks[:, :2].max(0)
+		size = high - low
+		if not np.isfinite(landmarks).all() or size.min() < 8.0:
+			return None
+		low = np.maximum(low - self.boxMargin * size, 0.0)
+		high = np.minimum(high + self.boxMargin * size, [width - 1, height - 1])
+		if (high - low).min() < 8.0:
+			return None
+		return np.concatenate([low, high])
+
+	def _select(self, arr):
 		if arr is None or len(arr) == 0:
 			raise RuntimeError("No landmarks found in image...")
-		if len(arr) > 1:
+		if len(arr) > 68:
 			print('found multiple subjects in image. extracting landmarks for first subject only...')
+		return np.asarray(arr)[:68] #only one subject per frame
 
-		landmarks = []
-		mask = self.mask.detach().cpu().numpy()
-		for preds in arr:
-
-			preds = preds[mask]
-			subjectLandmarks = np.array([[p[0], p[1]] for p in preds])
-			landmarks.append(subjectLandmarks)
-			break #only one subject per frame
+	def _detectBatch(self, frames):
+		'''
+		run the face detector on a batch of frames (one forward pass) and the landmarks network on the detected faces
+		:param frames: tensor [n, height, width, channels] in [0, 255]
+		:return: list of numpy arrays [68, 3]
+		'''
+		arr = self.landmarksDetector.get_landmarks_from_batch(frames.permute(0, 3, 1, 2).contiguous())
+		if arr is None:
+			raise RuntimeError("No landmarks found in image...")
+		return [self._select(np.concatenate(land, 0) if isinstance(land, list) and len(land) > 0 else land) for land in arr]
 
-		return landmarks[0]
-		return torch.tensor(landmarks, device = self.device)
+	def _detect(self, image, faceBox = None):
+		'''
+		detect the landmarks of one frame
+		:param image: tensor [height, width, channels] in [0, 255]
+		:param faceBox: if not None, the face box [x1, y1, x2, y2] to use instead of running the face detector
+		:return: numpy array [68, 3]
+		'''
+		image = image.cpu().numpy()
+		if faceBox is not None:
+			arr = self.landmarksDetector.get_landmarks_from_image(image, [np.asarray(faceBox, dtype=np.float32)])
+			if arr is not None and len(arr) > 0 and self.boxFromLandmarks(arr[0], image.shape[1], image.shape[0]) is not None:
+				return arr[0]
+			# tracking lost: run the face detector
+		arr = self.landmarksDetector.get_landmarks_from_image(image, None)
+		if arr is None or len(arr) == 0:
+			raise RuntimeError("No landmarks found in image...")
+		if len(arr) > 1:
+			print('found multiple subjects in image. extracting landmarks for first subject only...')
+		return arr[0]
 
 	def drawLandmarks(self, image, landmarks):
 		'''
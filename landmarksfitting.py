@@ -0,0 +1,133 @@
+import torch
+import math
+
+'''
+levenberg-marquardt solver for the landmarks fitting (stage 1).
+the stage 1 problem is a small non linear least squares problem per frame (head pose, expression coefficients and optionally the focal length
+against the 2d landmarks), with the shape coefficients fixed the frames are independent so the normal equations are block diagonal:
+each frame is solved with its own damping and stops on its own when its cost stops decreasing.
+the jacobians of all the frames are computed at once with torch.func (vmap of jacrev on the per frame residuals).
+'''
+
+class LandmarksFitting:
+
+    def __init__(self, morphableModel, regWeight = 0.1, optimizeFocalLength = True):
+        '''
+        :param morphableModel: morphable model (the landmarks rows of the shape/expression basis are used, see getLandmarksBasis)
+        :param regWeight: weight of the expression statistical prior (same objective as the adam path of runStep1)
+        :param optimizeFocalLength: if True the focal length of each frame is optimized with the pose and expression
+        '''
+        mean, basis = morphableModel.getLandmarksBasis()
+        self.landmarksMean = mean
+        self.shapeBasis = basis[:morphableModel.shapeBasisSize]
+        self.expressionBasis = basis[morphableModel.shapeBasisSize:]
+        self.expressionPcaVar = morphableModel.expressionPcaVar
+        self.regWeight = regWeight
+        self.optimizeFocalLength = optimizeFocalLength
+        self.iterations = 0
+        self.converged = False
+
+    def computeRotation(self, rotation):
+        '''
+        rotation matrix (rotz @ roty @ rotx) from euler angles of a single frame (same convention as Camera.computeRotation)
+        :param rotation: [3]
+        :return: [3, 3]
+        '''
+        cx, cy, cz = torch.cos(rotation).unbind(-1)
+        sx, sy, sz = torch.sin(rotation).unbind(-1)
+        return torch.stack([cz * cy, cz * sy * sx - sz * cx, cz * sy * cx + sz * sx,
+                            sz * cy, sz * sy * sx + cz * cx, sz * sy * cx - cz * sx,
+                            -sy, cy * sx, cy * cx], -1).view(3, 3)
+
+    def residuals(self, x, identity, landmarks, center, focal):
+        '''
+        residuals of a single frame: their squared norm is the frame loss of runStep1
+        (mean squared landmarks pixel distance + regWeight * mean normalized squared expression coefficients)
+        :param x: frame parameters [rotation (3), translation (3), expression coefficients, focal (if optimizeFocalLength)]
+        :param identity: landmarks vertices of the frame identity (mean + shape) [landmarksNumber * 3]
+        :param landmarks: 2d landmarks [landmarksNumber, 2]
+        :param center: camera center [2]
+        :param focal: focal length (unused if optimizeFocalLength)
+        :return: residuals [landmarksNumber * 2 + expressionBasisSize]
+        '''
+        expCoeff = x[6: 6 + self.expressionBasis.shape[0]]
+        if self.optimizeFocalLength:
+            focal = x[-1]
+        vertices = (identity + expCoeff @ self.expressionBasis).view(-1, 3)
+        cameraVertices = vertices @ self.computeRotation(x[:3]).transpose(0, 1) + x[3:6]
+        pixels = center + focal * cameraVertices[:, :2] / cameraVertices[:, 2:]
+        landmarksResiduals = (pixels - landmarks).reshape(-1) / math.sqrt(landmarks.shape[0])
+        priorResiduals = expCoeff * torch.rsqrt(self.expressionPcaVar * expCoeff.shape[0] / self.regWeight)
+        return torch.cat([landmarksResiduals, priorResiduals])
+
+    def solve(self, rotation, translation, expCoeff, focals, shapeCoeff, landmarks, centers, iterations = 50, tolerance = 1e-6, verbose = False):
+        '''
+        fit the pose, expression (and focal) of each frame to its landmarks
+        :param rotation: initial euler angles [n, 3]
+        :param translation: initial translation [n, 3]
+        :param expCoeff: initial expression coefficients [n, expBasisSize]
+        :param focals: initial focals [n]
+        :param shapeCoeff: fixed shape coefficients [n or 1, shapeBasisSize]
+        :param landmarks: 2d landmarks [n, landmarksNumber, 2]
+        :param centers: camera centers [n, 2]
+        :param iterations: maximum number of iterations
+        :param tolerance: a frame stops when an accepted step decreases its cost by less than this fraction
+        :param verbose: print the loss at each iteration
+        :return: rotation [n, 3], translation [n, 3], expCoeff [n, expBasisSize], focals [n], losses (mean frame cost at each iteration)
+        '''
+        n = expCoeff.shape[0]
+        with torch.no_grad():
+            identity = (self.landmarksMean + shapeCoeff @ self.shapeBasis).expand(n, -1)
+            x = [rotation, translation, expCoeff] + ([focals[:, None]] if self.optimizeFocalLength else [])
+            x = torch.cat(x, -1).detach().clone()
+
+        def residualsAndJacobian(x, identity, landmarks, center, focal):
+            r = self.residuals(x, identity, landmarks, center, focal)
+            return r, r
+        jacobian = torch.func.vmap(torch.func.jacrev(residualsAndJacobian, has_aux=True))
+        residuals = torch.func.vmap(self.residuals)
+
+        damping = torch.full([n], 1e-3, dtype=torch.float64, device=x.device)
+        cost = residuals(x, identity, landmarks, centers, focals).pow(2).sum(-1)
+        active = torch.ones([n], dtype=torch.bool, device=x.device)
+        losses = [cost.mean().item()]
+        self.iterations = 0
+        self.converged = False
+
+        for i in range(iterations):
+            frames = active.nonzero()[:, 0]
+            args = (x[frames], identity[frames], landmarks[frames], centers[frames], focals[frames])
+            J, r = jacobian(*args)
+            J, r = J.double(), r.double()
+
+            # damped normal equations (marquardt scaling: the damping is relative to the diagonal so the parameters scales do not matter)
+            JtJ = J.transpose(1, 2) @ J
+            Jtr = J.transpose(1, 2) @ r[..., None]
+            diagonal = JtJ.diagonal(dim1=1, dim2=2)
+            diagonal = torch.maximum(diagonal, 1e-9 * diagonal.amax(-1, keepdim=True))
+            delta = torch.linalg.solve_ex(JtJ + torch.diag_embed(damping[frames, None] * diagonal), -Jtr)[0][..., 0]
+
+            candidate = args[0] + delta.to(x.dtype)
+            candidateCost = residuals(candidate, *args[1:]).pow(2).sum(-1)
+            accepted = torch.isfinite(candidateCost) & (candidateCost < cost[frames])
+            decrease = (cost[frames] - candidateCost) / cost[frames].clamp_min(1e-12)
+
+            x[frames] = torch.where(accepted[:, None], candidate, args[0])
+            cost[frames] = torch.where(accepted, candidateCost, cost[frames])
+            damping[frames] = torch.where(accepted, (damping[frames] * 0.3).clamp_min(1e-9), damping[frames] * 10.)
+
+            # a frame is done when an accepted step barely decreases its cost or when no step can be found
+            done = (accepted & (decrease < tolerance)) | (damping[frames] > 1e9)
+            active[frames[done]] = False
+
+            self.iterations = i + 1
+            losses.append(cost.mean().item())
+            if verbose:
+                print(i, '=>', losses[-1], '(' + str(int(active.sum().item())) + ' active frames)')
+            if not active.any():
+                self.converged = True
+                break
+
+        expSize = self.expressionBasis.shape[0]
+        outFocals = x[:, -1] if self.optimizeFocalLength else focals
+        return x[:, :3], x[:, 3:6], x[:, 6:6 + expSize], outFocals, losses
@@ -16,9 +16,24 @@ class LandmarksDetectorMediapipe:
 		assert(mask.max().item() <= 467 and mask.min().item() >= 0)
 
 		self.device = device
+		self.refineLandmarks = refine_landmarks
+		self.isVideo = None
+		self.setVideoMode(is_video)
+
+		self.mask = mask.to(self.device)
+
+	def setVideoMode(self, is_video):
+		'''
+		switch between static image mode (the face detector runs on every image) and tracking mode (frames are passed sequentially in order,
+		the landmarks of a frame are tracked from the previous one and the face detector only runs when the tracking is lost)
+		:param is_video: True for tracking mode
+		'''
+		if self.isVideo == is_video:
+			return
+		self.isVideo = is_video
 		mp_face_mesh = mp.solutions.face_mesh
 
-		if refine_landmarks:
+		if self.refineLandmarks:
 			try:
 				self.landmarksDetector = mp_face_mesh.FaceMesh(
 					static_image_mode=not is_video,
@@ -36,8 +51,6 @@ class LandmarksDetectorMediapipe:
 				min_tracking_confidence=0.5,
 			)
 
-		self.mask = mask.to(self.device)
-
 	def detect(self, images):
 		'''
 		detect landmakrs on a batch of images
@@ -52,7 +65,7 @@ class LandmarksDetectorMediapipe:
 			landmarks.append(land)
 
 		torch.set_grad_enabled(True) #it turns out that the landmark detector disables the autograd engine. this line fixes this
-		return torch.tensor(landmarks, device = self.device)
+		return torch.from_numpy(np.stack(landmarks).astype(np.float32)).to(self.device)
 
 	def _detect(self, image):
 
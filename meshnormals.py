@@ -2,18 +2,41 @@ import torch
 
 class MeshNormals:
 
-    def __init__(self, device, faces, vertexIndex, vertexFaceNeighbors):
+    def __init__(self, device, faces, vertexIndex, vertexFaceNeighbors, verticesNumber = None):
+        '''
+        vertices normals are the (area unweighted) mean of the normals of their neighbor faces
+        :param device: where to store the adjacency
+        :param faces: tensor [trianglesNumber, 3]
+        :param vertexIndex: list of vertices indices arrays, one per group of vertices with the same number of neighbor faces [k]
+        :param vertexFaceNeighbors: list of neighbor faces arrays, one per group [k, neighborsNumber]
+        :param verticesNumber: number of vertices of the mesh (if None it is deduced from the faces and the adjacency)
+        '''
         assert(vertexIndex is not None)
         assert(vertexFaceNeighbors is not None)
 
         self.device = device
         self.faces = faces
-        self.vertexIndex = []
-        self.vertexFaceNeighbors = []
-        if vertexIndex is not None and vertexFaceNeighbors is not None:
-            for i in range(len(vertexIndex)):
-                self.vertexIndex.append(torch.tensor(vertexIndex[i]).to(self.device))
-                self.vertexFaceNeighbors.append(torch.tensor(vertexFaceNeighbors[i]).to(self.device))
+
+        # build a CSR vertex -> faces adjacency once, the normals are then computed with a single index_add over the face normals
+        vertices = []
+        neighbors = []
+        for i in range(len(vertexIndex)):
+            vi = torch.as_tensor(vertexIndex[i], dtype=torch.int64).reshape(-1)
+            ni = torch.as_tensor(vertexFaceNeighbors[i], dtype=torch.int64).reshape(vi.shape[0], -1)
+            vertices.append(vi[:, None].expand(-1, ni.shape[1]).reshape(-1))
+            neighbors.append(ni.reshape(-1))
+        vertices = torch.cat(vertices)
+        neighbors = torch.cat(neighbors)
+        order = torch.argsort(vertices, stable=True)
+
+        if verticesNumber is None:
+            verticesNumber = int(max(vertices.max().item(), faces.max().item())) + 1
+        counts = torch.bincount(vertices, minlength=verticesNumber)
+        self.vertexFaceOffsets = torch.cat([torch.zeros(1, dtype=torch.int64), torch.cumsum(counts, 0)]).to(self.device)
+        self.vertexFaceIndices = neighbors[order].to(self.device)
+        self.vertexFaceRows = vertices[order].to(self.device)
+        # vertices without neighbor faces keep a zero normal, avoid dividing by zero
+        self.vertexFaceCounts = counts.clamp(min=1).to(torch.float32)[:, None].to(self.device)
 
     def computeNormals(self, vertices):
         '''
@@ -31,11 +54,8 @@ class MeshNormals:
         v3 = vertices[..., faces[:, 2], :] - v1
         faceNormals = torch.cross(v2, v3, dim=vertices.dim() - 1)
 
-        normals = torch.zeros_like(vertices)
-        for (ni, vi) in zip(self.vertexFaceNeighbors, self.vertexIndex):
-            vc4 = faceNormals[..., ni, :]
-            vc4 = torch.mean(vc4, -2)
-            normals[..., vi, :] = vc4
+        neighborNormals = faceNormals.index_select(-2, self.vertexFaceIndices)
+        normals = torch.zeros_like(vertices).index_add(-2, self.vertexFaceRows, neighborNormals)
+        normals = normals / self.vertexFaceCounts
 
         return torch.nn.functional.normalize(normals, 2, -1)
-
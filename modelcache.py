@@ -0,0 +1,247 @@
+import numpy as np
+import struct
+import json
+import zlib
+import mmap
+import os
+
+'''
+binary cache for the morphable model assets (pca basis, mesh normals, uv parametrization...).
+the file is laid out so that it can be memory mapped and wrapped as numpy arrays / torch tensors without any copy:
+
+    [magic (8 bytes)][version (uint32)][header size (uint32)][header crc32 (uint32)][reserved (uint32)]
+    [json header describing every array (name, dtype, shape, offset, size, crc32) + free metadata]
+    [padding up to the next page boundary]
+    [array 0][padding][array 1][padding]...
+
+every array starts on a page boundary so that processes opening the same file share the pages through the os page cache.
+'''
+
+CACHE_MAGIC = b'NFCACHE\0'
+CACHE_VERSION = 1
+CACHE_PAGE_SIZE = max(4096, mmap.ALLOCATIONGRANULARITY)
+_PREFIX = struct.Struct('<8sIII4x')
+
+def _align(offset, alignment = CACHE_PAGE_SIZE):
+    return (offset + alignment - 1) // alignment * alignment
+
+def _sourceSignature(sourcePath):
+    '''
+    return a small signature (size and modification time) of the file the cache was built from
+    '''
+    stat = os.stat(sourcePath)
+    return {'size': stat.st_size, 'mtime': int(stat.st_mtime)}
+
+def dictionaryToArrays(dic):
+    '''
+    flatten a dictionary (as stored in the pickle files of the morphable model) into named arrays and metadata
+    numpy arrays are stored as is, lists of arrays are stored as 'key.i' entries and scalars go to the metadata
+    :param dic: dictionary of numpy arrays, list of numpy arrays or scalars
+    :return: dictionary of numpy arrays, metadata dictionary
+    '''
+    arrays = {}
+    metadata = {'lists': {}, 'scalars': {}}
+    for key, val in dic.items():
+        if isinstance(val, np.ndarray):
+            arrays[key] = val
+        elif isinstance(val, (list, tuple)):
+            metadata['lists'][key] = len(val)
+            for i in range(len(val)):
+                arrays[key + '.' + str(i)] = np.asarray(val[i])
+        else:
+            metadata['scalars'][key] = val.item() if isinstance(val, np.generic) else val
+    return arrays, metadata
+
+def arraysToDictionary(cache):
+    '''
+    inverse of dictionaryToArrays, the arrays are views on the memory mapped file (no copy)
+    :param cache: an opened ModelCache
+    :return: dictionary
+    '''
+    dic = {}
+    lists = cache.metadata.get('lists', {})
+    for key, count in lists.items():
+        dic[key] = [cache.array(key + '.' + str(i)) for i in range(count)]
+    for key, val in cache.metadata.get('scalars', {}).items():
+        dic[key] = val
+    for name in cache.names():
+        if name.rsplit('.', 1)[0] not in lists:
+            dic[name] = cache.array(name)
+    return dic
+
+def writeModelCache(cachePath, arrays, metadata = None, sourcePath = None):
+    '''
+    write arrays to a page aligned binary cache file. the file is written to a temporary file first and then renamed,
+    so concurrent readers never see a partially written cache
+    :param cachePath: path of the cache file
+    :param arrays: dictionary name -> numpy array
+    :param metadata: json serializable dictionary stored in the header
+    :param sourcePath: if not None, the signature of this file is stored so that a stale cache can be detected
+    '''
+    metadata = dict(metadata) if metadata is not None else {}
+    if sourcePath is not None and os.path.exists(sourcePath):
+        metadata['source'] = _sourceSignature(sourcePath)
+
+    entries = []
+    for name, arr in arrays.items():
+        arr = np.ascontiguousarray(arr)
+        entries.append({'name': name,
+                        'dtype': arr.dtype.str,
+                        'shape': list(arr.shape),
+                        'nbytes': int(arr.nbytes),
+                        'crc32': zlib.crc32(arr.data) & 0xffffffff})
+
+    # the offsets depend on the header size which depends on the offsets: iterate until stable
+    dataStart = CACHE_PAGE_SIZE
+    while True:
+        offset = dataStart
+        for entry in entries:
+            entry['offset'] = offset
+            offset = _align(offset + entry['nbytes'])
+        header = json.dumps({'arrays': entries, 'metadata': metadata}).encode('utf-8')
+        required = _align(_PREFIX.size + len(header))
+        if required <= dataStart:
+            break
+        dataStart = required
+
+    tmpPath = cachePath + '.tmp' + str(os.getpid())
+    with open(tmpPath, 'wb') as f:
+        f.write(_PREFIX.pack(CACHE_MAGIC, CACHE_VERSION, len(header), zlib.crc32(header) & 0xffffffff))
+        f.write(header)
+        for entry in entries:
+            f.seek(entry['offset'])
+            f.write(np.ascontiguousarray(arrays[entry['name']]).data)
+        f.truncate(max(f.tell(), dataStart))
+    os.replace(tmpPath, cachePath)
+
+class ModelCache:
+
+    def __init__(self, cachePath, verify = False):
+        '''
+        open a binary cache written by writeModelCache. the file is memory mapped (copy on write) and arrays are exposed as views on it
+        :param cachePath: path of the cache file
+        :param verify: if True the crc32 of every array is checked (reads the whole file)
+        '''
+        self.path = cachePath
+        with open(cachePath, 'rb') as f:
+            prefix = f.read(_PREFIX.size)
+            if len(prefix) != _PREFIX.size:
+                raise ValueError('truncated model cache: ' + cachePath)
+            magic, version, headerSize, headerCrc = _PREFIX.unpack(prefix)
+            if magic != CACHE_MAGIC:
+                raise ValueError('not a model cache file: ' + cachePath)
+            if version != CACHE_VERSION:
+                raise ValueError('unsupported model cache version ' + str(version) + ' in ' + cachePath)
+            header = f.read(headerSize)
+        if len(header) != headerSize or zlib.crc32(header) & 0xffffffff != headerCrc:
+            raise ValueError('corrupted model cache header: ' + cachePath)
+
+        header = json.loads(header.decode('utf-8'))
+        self.metadata = header['metadata']
+        self.entries = {entry['name']: entry for entry in header['arrays']}
+        fileSize = os.path.getsize(cachePath)
+        for entry in self.entries.values():
+            if entry['offset'] + entry['nbytes'] > fileSize:
+                raise ValueError('truncated model cache: ' + cachePath)
+
+        # mode 'c' keeps the pages shared between processes until one of them writes to it
+        self.buffer = np.memmap(cachePath, dtype=np.uint8, mode='c') if fileSize > 0 else np.zeros(0, dtype=np.uint8)
+        if verify:
+            self.verify()
+
+    def names(self):
+        return list(self.entries.keys())
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def array(self, name):
+        '''
+        return a numpy array (view on the mapped file, no copy)
+        :param name: name of the array
+        :return: numpy array
+        '''
+        entry = self.entries[name]
+        dtype = np.dtype(entry['dtype'])
+        data = self.buffer[entry['offset']: entry['offset'] + entry['nbytes']]
+        return data.view(dtype).reshape(entry['shape'])
+
+    def tensor(self, name, device = 'cpu'):
+        '''
+        return a torch tensor wrapping the mapped array. on cpu no copy is done, on other devices the data is uploaded once
+        :param name: name of the array
+        :param device: target device
+        :return: torch tensor
+        '''
+        import torch
+        return torch.from_numpy(self.array(name)).to(device)
+
+    def verify(self):
+        '''
+        check the crc32 of every array
+        '''
+        for name, entry in self.entries.items():
+            if zlib.crc32(self.array(name).data) & 0xffffffff != entry['crc32']:
+                raise ValueError('checksum mismatch for array ' + name + ' in model cache: ' + self.path)
+
+    def isStale(self, sourcePath):
+        '''
+        return True if the cache was built from a source file that has changed since
+        '''
+        if sourcePath is None or not os.path.exists(sourcePath) or 'source' not in self.metadata:
+            return False
+        return self.metadata['source'] != _sourceSignature(sourcePath)
+
+def loadModelCache(cachePath, sourcePath = None, verify = False):
+    '''
+    open a model cache if it exists, is valid and is up to date with its source file
+    :param cachePath: path of the cache file
+    :param sourcePath: the file the cache was built from (can be None)
+    :param verify: if True the checksum of every array is checked
+    :return: a ModelCache or None
+    '''
+    if not os.path.exists(cachePath):
+        return None
+    try:
+        cache = ModelCache(cachePath, verify)
+    except (ValueError, OSError) as e:
+        print('[WARN] ignoring invalid model cache:', e)
+        return None
+    if cache.isStale(sourcePath):
+        print('[INFO] model cache is out of date:', cachePath)
+        return None
+    return cache
+
+def buildModelCache(cachePath, dic, sourcePath = None, verify = False):
+    '''
+    write a dictionary to a model cache and reopen it memory mapped
+    :param cachePath: path of the cache file
+    :param dic: dictionary to store (see dictionaryToArrays)
+    :param sourcePath: the file the dictionary was loaded from
+    :param verify: if True the checksum of every array is checked
+    :return: a ModelCache or None if the cache could not be written (read only directory for instance)
+    '''
+    arrays, metadata = dictionaryToArrays(dic)
+    try:
+        writeModelCache(cachePath, arrays, metadata, sourcePath)
+    except OSError as e:
+        print('[WARN] could not write model cache:', e)
+        return None
+    return ModelCache(cachePath, verify)
+
+def loadOrBuildModelCache(cachePath, sourcePath, loadFunction, verify = False):
+    '''
+    open the cache or build it from the dictionary returned by loadFunction
+    :param cachePath: path of the cache file
+    :param sourcePath: the file the dictionary is loaded from
+    :param loadFunction: function returning the dictionary to cache
+    :param verify: if True the checksum of every array is checked
+    :return: dictionary whose arrays are views on the mapped cache (or the loaded dictionary if the cache is unavailable)
+    '''
+    cache = loadModelCache(cachePath, sourcePath, verify)
+    if cache is None:
+        dic = loadFunction()
+        cache = buildModelCache(cachePath, dic, sourcePath, verify)
+        if cache is None:
+            return dic
+    return arraysToDictionary(cache)
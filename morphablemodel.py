@@ -1,6 +1,8 @@
 from utils import loadDictionaryFromPickle, writeDictionaryToPickle
 from normalsampler import NormalSampler
 from meshnormals import MeshNormals
+from modelcache import loadOrBuildModelCache, buildModelCache, arraysToDictionary
+from texturemapping import TextureMapping
 import numpy as np
 import torch
 import h5py
@@ -10,16 +12,27 @@ import mitsuba as mi
 import drjit as dr
 class MorphableModel:
 
-    def __init__(self, path, textureResolution = 256, trimPca = False, landmarksPathName = 'landmark_62_mp.txt', device='cuda'):
+    def __init__(self, path, textureResolution = 256, trimPca = False, landmarksPathName = 'landmark_62_mp.txt', device='cuda', useCache = True, verifyCache = False,
+                 shapeRank = None, expressionRank = None, albedoRank = None, explainedVariance = None,
+                 textureBasis = False, textureBasisRank = None):
         '''
         a statistical morphable model is a generative model that can generate faces with different identity, expression and skin reflectance
         it is mainly composed of an orthogonal basis (eigen vectors) obtained from applying principal component analysis (PCA) on a set of face scans.
         a linear combination of these eigen vectors produces different type shape and skin
         :param path: drive path of where the data of the morphable model is saved
         :param textureResolution: the resolution of the texture used for diffuse and specular reflectance
-        :param trimPca: if True keep only a subset of the PCA basis
+        :param trimPca: if True keep only a subset of the PCA basis (80 leading components unless a rank or explainedVariance is given)
         :param landmarksPathName: a text file conains the association between the 2d pixel position and the 3D points in the mesh
         :param device: where to store the morphableModel data (cpu or gpu)
+        :param useCache: if True the model data is loaded from memory mapped binary caches (see modelcache.py), built on first run next to the pickle files
+        :param verifyCache: if True the checksum of the cached arrays is verified when opening the caches (reads the whole files)
+        :param shapeRank: number of leading shape components to load (None or <= 0: see explainedVariance)
+        :param expressionRank: number of leading expression components to load (None or <= 0: see explainedVariance)
+        :param albedoRank: number of leading diffuse/specular albedo components to load (None or <= 0: see explainedVariance)
+        :param explainedVariance: if in ]0, 1], the ranks not given explicitly are the smallest ones explaining this fraction of the pca variance
+        :param textureBasis: if True the diffuse and specular albedo basis are also precomputed in texture space (see computeTextures)
+        :param textureBasisRank: number of leading albedo components precomputed in texture space (None or <= 0: all), the others go through the per vertex path.
+        trades memory (2 * textureResolution^2 * 3 floats per component) for speed
         '''
         assert textureResolution == 256 or textureResolution == 512 or textureResolution == 1024 or textureResolution == 2048 #can handle only 256 or 512 texture res
         self.shapeBasisSize = 199
@@ -34,118 +47,84 @@ class MorphableModel:
         pathPickleFileName = path + '/morphableModel-2017.pickle'
         pathNormals = path + '/normals.pickle'
 
-        if os.path.exists(pathPickleFileName) == False:
-            print("Loading Basel Face Model 2017 from " + pathH5Model + "... this may take a while the first time... The next runtime it will be faster...")
-
-            if os.path.exists(pathH5Model) == False:
-                print('[Error] to use the library, you have to install basel morphable  face model 2017 from: https://faces.dmi.unibas.ch/bfm/bfm2017.html', file=sys.stderr, flush=True)
-                print('Fill the form on the link and you will get instant download link into your inbox.', file=sys.stderr, flush=True)
-                print('Download  "model2017-1_face12_nomouth.h5" and put it inside ',path, ' and run again...', file=sys.stderr, flush=True)
-                exit(0)
-
-            self.file = h5py.File(pathH5Model, 'r')
-            assert(self.file is not None)
-
-            print("loading shape basis...")
-            self.shapeMean = torch.Tensor(self.file["shape"]["model"]["mean"]).reshape(-1, 3).to(device).float()
-            self.shapePca = torch.Tensor(self.file["shape"]["model"]["pcaBasis"]).reshape(-1, 3, self.shapeBasisSize).to(device).float().permute(2, 0, 1)
-            self.shapePcaVar = torch.Tensor(self.file["shape"]["model"]["pcaVariance"]).reshape(self.shapeBasisSize).to(device).float()
-
-            print("loading expression basis...")
-            self.expressionPca = torch.Tensor(self.file["expression"]["model"]["pcaBasis"]).reshape(-1, 3, self.expBasisSize).to(device).float().permute(2, 0, 1)
-            self.expressionPcaVar = torch.Tensor(self.file["expression"]["model"]["pcaVariance"]).reshape(self.expBasisSize).to(device).float()
-            self.faces = torch.Tensor(np.transpose(self.file["shape"]["representer"]["cells"])).reshape(-1, 3).to(device).long()
-            self.file.close()
-
-            print("Loading Albedo model from " + pathAlbedoModel + "...")
-            if os.path.exists(pathAlbedoModel) == False:
-                print('[ERROR] Please install the albedo model from the link below, put it inside', path, 'and run again: https://github.com/waps101/AlbedoMM/releases/download/v1.0/albedoModel2020_face12_albedoPart.h5', file=sys.stderr, flush=True)
-                exit(0)
-
-            self.file = h5py.File(pathAlbedoModel, 'r')
-            assert(self.file is not None)
-
-            self.diffuseAlbedoMean = torch.Tensor(self.file["diffuseAlbedo"]["model"]["mean"]).reshape(-1, 3).to(device).float()
-            self.diffuseAlbedoPca = torch.Tensor(self.file["diffuseAlbedo"]["model"]["pcaBasis"]).reshape(-1, 3, self.albedoBasisSize).to(device).float().permute(2, 0, 1)
-            self.diffuseAlbedoPcaVar = torch.Tensor(self.file["diffuseAlbedo"]["model"]["pcaVariance"]).reshape(self.albedoBasisSize).to(device).float()
-
-            self.specularAlbedoMean = torch.Tensor(self.file["specularAlbedo"]["model"]["mean"]).reshape(-1, 3).to(device).float()
-            self.specularAlbedoPca = torch.Tensor(self.file["specularAlbedo"]["model"]["pcaBasis"]).reshape(-1, 3, self.albedoBasisSize).to(device).float().permute(2, 0, 1)
-            self.specularAlbedoPcaVar = torch.Tensor(self.file["specularAlbedo"]["model"]["pcaVariance"]).reshape(self.albedoBasisSize).to(device).float()
-            self.file.close()
-
-            #save to pickle for future loading
-            dict = {'shapeMean': self.shapeMean.cpu().numpy(),
-                    'shapePca': self.shapePca.cpu().numpy(),
-                    'shapePcaVar': self.shapePcaVar.cpu().numpy(),
-
-                    'diffuseAlbedoMean': self.diffuseAlbedoMean.cpu().numpy(),
-                    'diffuseAlbedoPca': self.diffuseAlbedoPca.cpu().numpy(),
-                    'diffuseAlbedoPcaVar': self.diffuseAlbedoPcaVar.cpu().numpy(),
-
-                    'specularAlbedoMean': self.specularAlbedoMean.cpu().numpy(),
-                    'specularAlbedoPca': self.specularAlbedoPca.cpu().numpy(),
-                    'specularAlbedoPcaVar': self.specularAlbedoPcaVar.cpu().numpy(),
-
-                    'expressionPca': self.expressionPca.cpu().numpy(),
-                    'expressionPcaVar': self.expressionPcaVar.cpu().numpy(),
-                    'faces': self.faces.cpu().numpy()}
-            writeDictionaryToPickle(dict, pathPickleFileName)
-        else:
+        def loadModel():
+            if os.path.exists(pathPickleFileName) == False:
+                return self.fuseBasis(self.loadH5Model(path, pathH5Model, pathAlbedoModel, pathPickleFileName))
             print("Loading Basel Face Model 2017 from " + pathPickleFileName + "...")
-
-            dict = loadDictionaryFromPickle(pathPickleFileName)
-            self.shapeMean = torch.tensor(dict['shapeMean']).to(device)
-            self.shapePca = torch.tensor(dict['shapePca']).to(device)
-            self.shapePcaVar = torch.tensor(dict['shapePcaVar']).to(device)
-
-            self.diffuseAlbedoMean = torch.tensor(dict['diffuseAlbedoMean']).to(device)
-            self.diffuseAlbedoPca = torch.tensor(dict['diffuseAlbedoPca']).to(device)
-            self.diffuseAlbedoPcaVar = torch.tensor(dict['diffuseAlbedoPcaVar']).to(device)
-            
-            self.specularAlbedoMean = torch.tensor(dict['specularAlbedoMean']).to(device)
-            self.specularAlbedoPca = torch.tensor(dict['specularAlbedoPca']).to(device)
-            self.specularAlbedoPcaVar = torch.tensor(dict['specularAlbedoPcaVar']).to(device)
-
-            self.expressionPca = torch.tensor(dict['expressionPca']).to(device)
-            self.expressionPcaVar = torch.tensor(dict['expressionPcaVar']).to(device)
-            self.faces = torch.tensor(dict['faces']).to(device)
-
+            return self.fuseBasis(loadDictionaryFromPickle(pathPickleFileName))
+
+        if useCache:
+            print("Loading Basel Face Model 2017 from cache...")
+            pathCache = path + '/morphableModel-2017.cache'
+            dict = loadOrBuildModelCache(pathCache, pathPickleFileName, loadModel, verifyCache)
+            if 'shapeExpressionPca' not in dict:
+                print('[INFO] rebuilding the model cache with the fused basis layout:', pathCache)
+                dict = loadModel()
+                cache = buildModelCache(pathCache, dict, pathPickleFileName, verifyCache)
+                if cache is not None:
+                    dict = arraysToDictionary(cache)
+        else:
+            dict = loadModel()
 
         if trimPca:
-            newDim = min(80,
-                         self.shapePca.shape[0],
-                         self.diffuseAlbedoPca.shape[0],
-                         self.specularAlbedoPcaVar.shape[0],
-                         self.expressionPca.shape[0])
-
-            self.shapePca = self.shapePca[0:newDim, ...]
-            self.shapePcaVar = self.shapePcaVar[0:newDim, ...]
-
-            self.diffuseAlbedoPca = self.diffuseAlbedoPca[0:newDim, ...]
-            self.diffuseAlbedoPcaVar = self.diffuseAlbedoPcaVar[0:newDim, ...]
-
-            self.specularAlbedoPca = self.specularAlbedoPca[0:newDim, ...]
-            self.specularAlbedoPcaVar = self.specularAlbedoPcaVar[0:newDim, ...]
-
-            self.expressionPca = self.expressionPca[0:newDim, ...]
-            self.expressionPcaVar = self.expressionPcaVar[0:newDim, ...]
-            self.shapeBasisSize = newDim
-            self.expBasisSize = newDim
-            self.albedoBasisSize = newDim
+            shapeRank = shapeRank if shapeRank is not None and shapeRank > 0 else 80
+            expressionRank = expressionRank if expressionRank is not None and expressionRank > 0 else 80
+            albedoRank = albedoRank if albedoRank is not None and albedoRank > 0 else 80
+
+        self.shapeBasisSize = self.computeRank(dict['shapePcaVar'], shapeRank, explainedVariance)
+        self.expBasisSize = self.computeRank(dict['expressionPcaVar'], expressionRank, explainedVariance)
+        self.albedoBasisSize = max(self.computeRank(dict['diffuseAlbedoPcaVar'], albedoRank, explainedVariance),
+                                   self.computeRank(dict['specularAlbedoPcaVar'], albedoRank, explainedVariance))
+        print('pca ranks: shape', self.shapeBasisSize, ', expression', self.expBasisSize, ', albedo', self.albedoBasisSize)
+
+        def leadingComponents(name, rank, start = 0):
+            # torch.from_numpy wraps the (memory mapped) arrays without copy, .to(device) is a no-op on cpu
+            # when the arrays are memory mapped only the pages of the leading components are ever read
+            arr = dict[name][start:start + rank]
+            if not isinstance(arr, np.memmap):
+                arr = arr.copy() # do not keep the full basis alive
+            return torch.from_numpy(arr).to(device)
+
+        # the fused bases are stored as such in the cache: the leading rows are mapped directly (see buildFusedBasis)
+        fullShapeSize = dict['shapePcaVar'].shape[0]
+        if self.shapeBasisSize == fullShapeSize:
+            self.shapeExpressionPca = leadingComponents('shapeExpressionPca', fullShapeSize + self.expBasisSize)
+        else:
+            # the kept shape and expression rows are not adjacent in the fused layout: only these rows are copied
+            self.shapeExpressionPca = torch.cat([leadingComponents('shapeExpressionPca', self.shapeBasisSize),
+                                                 leadingComponents('shapeExpressionPca', self.expBasisSize, fullShapeSize)], dim=0)
+        self.albedoPca = leadingComponents('albedoPca', self.albedoBasisSize)
+
+        self.shapeMean = torch.from_numpy(dict['shapeMean']).to(device)
+        self.shapePcaVar = leadingComponents('shapePcaVar', self.shapeBasisSize)
+        self.diffuseAlbedoMean = torch.from_numpy(dict['diffuseAlbedoMean']).to(device)
+        self.diffuseAlbedoPcaVar = leadingComponents('diffuseAlbedoPcaVar', self.albedoBasisSize)
+        self.specularAlbedoMean = torch.from_numpy(dict['specularAlbedoMean']).to(device)
+        self.specularAlbedoPcaVar = leadingComponents('specularAlbedoPcaVar', self.albedoBasisSize)
+        self.expressionPcaVar = leadingComponents('expressionPcaVar', self.expBasisSize)
+        self.faces = torch.from_numpy(dict['faces']).to(device)
+        dict = None
+        self.buildFusedBasis()
 
         print("loading mesh normals...")
-        dic = loadDictionaryFromPickle(pathNormals)
-        self.meshNormals = MeshNormals(device, self.faces, dic['vertexIndex'], dic['vertexFaceNeighbors'])
+        if useCache:
+            dic = loadOrBuildModelCache(path + '/normals.cache', pathNormals, lambda: loadDictionaryFromPickle(pathNormals), verifyCache)
+        else:
+            dic = loadDictionaryFromPickle(pathNormals)
+        self.meshNormals = MeshNormals(device, self.faces, dic['vertexIndex'], dic['vertexFaceNeighbors'], self.shapeMean.shape[0])
 
         print("loading uv parametrization...")
-        self.uvParametrization = loadDictionaryFromPickle(pathUV)
+        if useCache:
+            self.uvParametrization = loadOrBuildModelCache(path + '/uvParametrization.' + str(textureResolution) + '.cache', pathUV, lambda: loadDictionaryFromPickle(pathUV), verifyCache)
+        else:
+            self.uvParametrization = loadDictionaryFromPickle(pathUV)
 
         for key in self.uvParametrization:
             if key != 'uvResolution':
-                self.uvParametrization[key] = torch.tensor(self.uvParametrization[key]).to(device)
+                self.uvParametrization[key] = torch.as_tensor(self.uvParametrization[key]).to(device)
 
         self.uvMap = self.uvParametrization['uvVertices'].to(device)
+        self.textureMapping = TextureMapping(self.faces, self.shapeMean.shape[0], self.uvParametrization)
 
         print("loading landmarks association file...")
         self.landmarksAssociation = torch.tensor(np.genfromtxt(pathLandmarks, delimiter='\t\t')[:, 1].astype(np.int64)).to(device)
@@ -154,26 +133,202 @@ class MorphableModel:
         print('creating sampler...')
         self.sampler = NormalSampler(self)
 
-    def generateTextureFromAlbedo(self, albedo):
+        self.textureBasis = None
+        if textureBasis:
+            print("loading texture space albedo basis...")
+            self.buildTextureBasis(path, textureBasisRank, pathPickleFileName, useCache, verifyCache)
+
+    def fuseBasis(self, dic):
+        '''
+        replace the per-basis pca arrays of a loaded model dictionary by the fused layouts stored in the model cache:
+        the shape and expression basis concatenated into one [shapeBasisSize + expBasisSize, verticesNumber * 3] matrix
+        and the diffuse and specular basis (that share the same coefficients) stacked into one [albedoBasisSize, 2 * verticesNumber * 3] matrix
+        :param dic: dictionary returned by loadH5Model
+        :return: dictionary with 'shapeExpressionPca' and 'albedoPca' instead of the per-basis arrays
+        '''
+        dic = dict(dic)
+        shapePca, expressionPca = dic.pop('shapePca'), dic.pop('expressionPca')
+        diffuseAlbedoPca, specularAlbedoPca = dic.pop('diffuseAlbedoPca'), dic.pop('specularAlbedoPca')
+        dic['shapeExpressionPca'] = np.concatenate([shapePca.reshape(shapePca.shape[0], -1),
+                                                    expressionPca.reshape(expressionPca.shape[0], -1)], axis=0)
+        dic['albedoPca'] = np.concatenate([diffuseAlbedoPca.reshape(diffuseAlbedoPca.shape[0], -1),
+                                           specularAlbedoPca.reshape(specularAlbedoPca.shape[0], -1)], axis=1)
+        return dic
+
+    def buildFusedBasis(self):
+        '''
+        expose the per-basis tensors (shapePca, expressionPca, diffuseAlbedoPca, specularAlbedoPca) as views on the fused matrices
+        shapeExpressionPca and albedoPca (mapped from the model cache, see fuseBasis) used to evaluate the model with a single matrix product
+        '''
+        verticesNumber = self.shapeMean.shape[0]
+        self.shapePca = self.shapeExpressionPca[0:self.shapeBasisSize].view(self.shapeBasisSize, verticesNumber, 3)
+        self.expressionPca = self.shapeExpressionPca[self.shapeBasisSize:].view(self.expBasisSize, verticesNumber, 3)
+        self.shapeMeanFlat = self.shapeMean.reshape(1, -1)
+
+        self.diffuseAlbedoPca = self.albedoPca[:, 0:verticesNumber * 3].view(self.albedoBasisSize, verticesNumber, 3)
+        self.specularAlbedoPca = self.albedoPca[:, verticesNumber * 3:].view(self.albedoBasisSize, verticesNumber, 3)
+        self.albedoMeanFlat = torch.cat([self.diffuseAlbedoMean.reshape(-1), self.specularAlbedoMean.reshape(-1)]).reshape(1, -1)
+        self.buffers = {}
+
+    def buildTextureBasis(self, path, rank, pathPickleFileName, useCache = True, verifyCache = False):
+        '''
+        precompute the mean and the leading components of the diffuse and specular albedo in texture space, stacked in one matrix
+        [rank, 2 * texRes * texRes * 3] so that both textures are generated with a single gemm (see computeTextures).
+        the result is stored in a memory mapped cache next to the model
+        :param path: directory of the morphable model
+        :param rank: number of leading albedo components to precompute (None or <= 0: all)
+        :param pathPickleFileName: model file used to detect a stale cache
+        '''
+        rank = self.albedoBasisSize if rank is None or rank <= 0 else min(int(rank), self.albedoBasisSize)
+        res = self.getTextureResolution()
+
+        def computeBasis():
+            chunk = 16
+            with torch.no_grad():
+                mean = torch.cat([self.generateTextureFromAlbedo(self.diffuseAlbedoMean[None]).reshape(1, -1),
+                                  self.generateTextureFromAlbedo(self.specularAlbedoMean[None]).reshape(1, -1)], dim=1)
+                basis = []
+                for i in range(0, rank, chunk):
+                    j = min(i + chunk, rank)
+                    basis.append(torch.cat([self.generateTextureFromAlbedo(self.diffuseAlbedoPca[i:j]).reshape(j - i, -1),
+                                            self.generateTextureFromAlbedo(self.specularAlbedoPca[i:j]).reshape(j - i, -1)], dim=1).cpu())
+            return {'meanTextures': mean.cpu().numpy(), 'textureBasis': torch.cat(basis, dim=0).numpy()}
+
+        if useCache:
+            dic = loadOrBuildModelCache(path + '/textureBasis.' + str(res) + '.' + str(rank) + '.cache', pathPickleFileName, computeBasis, verifyCache)
+        else:
+            dic = computeBasis()
+        self.meanTextures = torch.from_numpy(dic['meanTextures']).to(self.device)
+        self.textureBasis = torch.from_numpy(dic['textureBasis']).to(self.device)
+        self.textureBasisRank = rank
+
+    def computeTextures(self, albedoCoeff):
+        '''
+        compute the diffuse and specular textures directly from the albedo coeffs using the texture space basis (see buildTextureBasis).
+        equivalent to generateTextureFromAlbedo(computeDiffuseAlbedo(albedoCoeff)) and generateTextureFromAlbedo(computeSpecularAlbedo(albedoCoeff))
+        :param albedoCoeff: tensor [n, self.albedoBasisSize]
+        :return: diffuse textures [n, texRes, texRes, 3], specular textures [n, texRes, texRes, 3]
+        '''
+        assert(self.textureBasis is not None)
+        assert(albedoCoeff.dim() == 2 and albedoCoeff.shape[1] == self.albedoBasisSize)
+        n = albedoCoeff.shape[0]
+        rank = self.textureBasisRank
+        res = self.getTextureResolution()
+
+        textures = self.linearCombination('textures', self.meanTextures, albedoCoeff[:, 0:rank], self.textureBasis)
+        if rank < self.albedoBasisSize:
+            # the components not precomputed go through the per vertex path
+            albedos = torch.mm(albedoCoeff[:, rank:], self.albedoPca[rank:])
+            residual = self.generateTextureFromAlbedo(albedos.view(n * 2, -1, 3), 'residualTextures')
+            textures = textures + residual.view(n, -1)
+        textures = textures.view(n, 2, res, res, 3)
+        return textures[:, 0], textures[:, 1]
+
+    def getBuffer(self, name, rows, cols, reference):
+        '''
+        return a preallocated [rows, cols] output buffer (reallocated only if the shape changes)
+        :param name: buffer name
+        :param reference: tensor giving the dtype and device of the buffer
+        '''
+        buffer = self.buffers.get(name)
+        if buffer is None or buffer.shape[0] != rows or buffer.shape[1] != cols or buffer.dtype != reference.dtype or buffer.device != reference.device:
+            buffer = torch.empty([rows, cols], dtype=reference.dtype, device=reference.device)
+            self.buffers[name] = buffer
+        return buffer
+
+    def linearCombination(self, name, mean, coeffs, basis):
+        '''
+        compute mean + coeffs @ basis with a single addmm.
+        when autograd is not recording, the result is written into a preallocated buffer that is overwritten by the next call with the same name
+        :param mean: [1, cols]
+        :param coeffs: [n, rows]
+        :param basis: [rows, cols]
+        :return: [n, cols]
+        '''
+        if torch.is_grad_enabled() and (coeffs.requires_grad or basis.requires_grad):
+            return torch.addmm(mean, coeffs, basis)
+        return torch.addmm(mean, coeffs, basis, out=self.getBuffer(name, coeffs.shape[0], basis.shape[1], basis))
+
+    def computeRank(self, variances, rank = None, explainedVariance = None):
+        '''
+        compute the number of leading pca components to keep
+        :param variances: pca variances sorted in decreasing order (numpy array [basisSize])
+        :param rank: requested number of components (ignored if None or <= 0)
+        :param explainedVariance: fraction of the total variance the kept components must explain in ]0, 1] (ignored if None or <= 0)
+        :return: int in [1, basisSize]
+        '''
+        size = variances.shape[0]
+        if rank is not None and rank > 0:
+            return min(int(rank), size)
+        if explainedVariance is not None and explainedVariance > 0:
+            assert(explainedVariance <= 1.0)
+            ratio = np.cumsum(variances, dtype=np.float64) / np.sum(variances, dtype=np.float64)
+            return min(int(np.searchsorted(ratio, explainedVariance)) + 1, size)
+        return size
+
+    def loadH5Model(self, path, pathH5Model, pathAlbedoModel, pathPickleFileName):
+        '''
+        load the basel face model 2017 and the albedo model from their h5 files and save them to a pickle file for future loading
+        :return: dictionary of numpy arrays
+        '''
+        print("Loading Basel Face Model 2017 from " + pathH5Model + "... this may take a while the first time... The next runtime it will be faster...")
+
+        if os.path.exists(pathH5Model) == False:
+            print('[Error] to use the library, you have to install basel morphable  face model 2017 from: https://faces.dmi.unibas.ch/bfm/bfm2017.html', file=sys.stderr, flush=True)
+            print('Fill the form on the link and you will get instant download link into your inbox.', file=sys.stderr, flush=True)
+            print('Download  "model2017-1_face12_nomouth.h5" and put it inside ',path, ' and run again...', file=sys.stderr, flush=True)
+            exit(0)
+
+        def loadBasis(model, basisSize):
+            basis = np.asarray(model["pcaBasis"], dtype=np.float32).reshape(-1, 3, basisSize).transpose(2, 0, 1)
+            return np.ascontiguousarray(basis)
+
+        file = h5py.File(pathH5Model, 'r')
+        assert(file is not None)
+
+        print("loading shape basis...")
+        dict = {}
+        dict['shapeMean'] = np.asarray(file["shape"]["model"]["mean"], dtype=np.float32).reshape(-1, 3)
+        dict['shapePca'] = loadBasis(file["shape"]["model"], self.shapeBasisSize)
+        dict['shapePcaVar'] = np.asarray(file["shape"]["model"]["pcaVariance"], dtype=np.float32).reshape(self.shapeBasisSize)
+
+        print("loading expression basis...")
+        dict['expressionPca'] = loadBasis(file["expression"]["model"], self.expBasisSize)
+        dict['expressionPcaVar'] = np.asarray(file["expression"]["model"]["pcaVariance"], dtype=np.float32).reshape(self.expBasisSize)
+        dict['faces'] = np.ascontiguousarray(np.transpose(file["shape"]["representer"]["cells"]).reshape(-1, 3).astype(np.int64))
+        file.close()
+
+        print("Loading Albedo model from " + pathAlbedoModel + "...")
+        if os.path.exists(pathAlbedoModel) == False:
+            print('[ERROR] Please install the albedo model from the link below, put it inside', path, 'and run again: https://github.com/waps101/AlbedoMM/releases/download/v1.0/albedoModel2020_face12_albedoPart.h5', file=sys.stderr, flush=True)
+            exit(0)
+
+        file = h5py.File(pathAlbedoModel, 'r')
+        assert(file is not None)
+
+        dict['diffuseAlbedoMean'] = np.asarray(file["diffuseAlbedo"]["model"]["mean"], dtype=np.float32).reshape(-1, 3)
+        dict['diffuseAlbedoPca'] = loadBasis(file["diffuseAlbedo"]["model"], self.albedoBasisSize)
+        dict['diffuseAlbedoPcaVar'] = np.asarray(file["diffuseAlbedo"]["model"]["pcaVariance"], dtype=np.float32).reshape(self.albedoBasisSize)
+
+        dict['specularAlbedoMean'] = np.asarray(file["specularAlbedo"]["model"]["mean"], dtype=np.float32).reshape(-1, 3)
+        dict['specularAlbedoPca'] = loadBasis(file["specularAlbedo"]["model"], self.albedoBasisSize)
+        dict['specularAlbedoPcaVar'] = np.asarray(file["specularAlbedo"]["model"]["pcaVariance"], dtype=np.float32).reshape(self.albedoBasisSize)
+        file.close()
+
+        #save to pickle for future loading
+        writeDictionaryToPickle(dict, pathPickleFileName)
+        return dict
+
+    def generateTextureFromAlbedo(self, albedo, name = None):
         '''
         generate diffuse and specular textures from per vertex albedo color
         :param albedo: tensor of per vertex albedo color [n, verticesNumber, 3]
+        :param name: if given and autograd is not recording, the textures are written into a preallocated buffer overwritten by the next call with the same name
         :return: generated textures [n, self.getTextureResolution(), self.getTextureResolution(), 3]
         '''
         assert (albedo.dim() == 3 and albedo.shape[-1] == self.diffuseAlbedoMean.shape[-1] and albedo.shape[-2] == self.diffuseAlbedoMean.shape[-2])
-        textureSize = self.uvParametrization['uvResolution']
-        halfRes = textureSize // 2
-        baryCenterWeights = self.uvParametrization['uvFaces']
-        oFaces = self.uvParametrization['uvMapFaces']
-        uvxyMap = self.uvParametrization['uvXYMap']
-
-        neighboors = torch.arange(self.faces.shape[-1], dtype = torch.int64, device = self.faces.device)
-
-        texture = (baryCenterWeights[:, neighboors, None] * albedo[:, self.faces[oFaces[:, None], neighboors]]).sum(dim=-2)
-        textures = torch.zeros((albedo.size(0), textureSize, textureSize, 3), dtype=torch.float32, device = self.faces.device)
-        textures[:, uvxyMap[:, 0], uvxyMap[:, 1]] = texture
-        textures[:, halfRes, :, :] = (textures[:, halfRes -1, :, :] + textures[:, halfRes + 1, :, :]) * 0.5
-        return textures.permute(0, 2, 1, 3).flip([1])
+        # the barycentric interpolation, seam fix and flip/permute are precompiled in a sparse matrix (see texturemapping.py)
+        return self.textureMapping.apply(albedo, name)
 
     def getTextureResolution(self):
         '''
@@ -192,8 +347,41 @@ class MorphableModel:
         assert (shapeCoff.ndim == 2 and shapeCoff.shape[1] == self.shapeBasisSize)
         assert (expCoff.dim() == 2 and expCoff.shape[1] == self.expBasisSize)
 
-        vertices = self.shapeMean + torch.einsum('ni,ijk->njk', (shapeCoff, self.shapePca)) + torch.einsum('ni,ijk->njk', (expCoff, self.expressionPca))
-        return vertices
+        if shapeCoff.shape[0] != expCoff.shape[0]: # shared identity
+            assert(shapeCoff.shape[0] == 1)
+            shapeCoff = shapeCoff.expand(expCoff.shape[0], -1)
+        coeffs = torch.cat([shapeCoff, expCoff], dim=-1)
+        vertices = self.linearCombination('shape', self.shapeMeanFlat, coeffs, self.shapeExpressionPca)
+        return vertices.view(coeffs.shape[0], -1, 3)
+    def getLandmarksBasis(self):
+        '''
+        return the rows of the fused shape/expression basis that correspond to the landmarks vertices (computed once and cached)
+        :return: mean [1, landmarksNumber * 3], basis [shapeBasisSize + expBasisSize, landmarksNumber * 3]
+        '''
+        if getattr(self, 'landmarksBasis', None) is None:
+            columns = (self.landmarksAssociation[:, None] * 3 + torch.arange(3, device=self.landmarksAssociation.device)).reshape(-1)
+            self.landmarksMean = self.shapeMeanFlat[:, columns].contiguous()
+            self.landmarksBasis = self.shapeExpressionPca[:, columns].contiguous()
+        return self.landmarksMean, self.landmarksBasis
+
+    def computeLandmarksShape(self, shapeCoff, expCoff):
+        '''
+        compute only the landmarks vertices (see landmarksAssociation) from shape and exp coeff.
+        equivalent to computeShape(shapeCoff, expCoff)[:, self.landmarksAssociation] but evaluated on the landmarks sub-basis only
+        :param shapeCoff: [n, self.shapeBasisSize]
+        :param expCoff: [n, self.expBasisSize]
+        :return: return vertices tensor [n, landmarksNumber, 3]
+        '''
+        assert (shapeCoff.ndim == 2 and shapeCoff.shape[1] == self.shapeBasisSize)
+        assert (expCoff.dim() == 2 and expCoff.shape[1] == self.expBasisSize)
+
+        if shapeCoff.shape[0] != expCoff.shape[0]: # shared identity
+            assert(shapeCoff.shape[0] == 1)
+            shapeCoff = shapeCoff.expand(expCoff.shape[0], -1)
+        mean, basis = self.getLandmarksBasis()
+        vertices = self.linearCombination('landmarks', mean, torch.cat([shapeCoff, expCoff], dim=-1), basis)
+        return vertices.view(expCoff.shape[0], -1, 3)
+
     def computeShapeMitsuba(self, shapeCoff, expCoff):
         '''
         compute vertices from shape and exp coeff
@@ -228,8 +416,9 @@ class MorphableModel:
         '''
         assert(diffAlbedoCoeff.dim() == 2 and diffAlbedoCoeff.shape[1] == self.albedoBasisSize)
 
-        colors = self.diffuseAlbedoMean + torch.einsum('ni,ijk->njk', (diffAlbedoCoeff, self.diffuseAlbedoPca))
-        return colors
+        cols = self.diffuseAlbedoPca.shape[1] * 3
+        colors = self.linearCombination('diffuseAlbedo', self.albedoMeanFlat[:, 0:cols], diffAlbedoCoeff, self.albedoPca[:, 0:cols])
+        return colors.view(diffAlbedoCoeff.shape[0], -1, 3)
 
     def computeSpecularAlbedo(self, specAlbedoCoeff):
         '''
@@ -239,8 +428,9 @@ class MorphableModel:
         '''
         assert(specAlbedoCoeff.dim() == 2 and specAlbedoCoeff.shape[1] == self.albedoBasisSize)
 
-        colors = self.specularAlbedoMean + torch.einsum('ni,ijk->njk', (specAlbedoCoeff, self.specularAlbedoPca))
-        return colors
+        cols = self.specularAlbedoPca.shape[1] * 3
+        colors = self.linearCombination('specularAlbedo', self.albedoMeanFlat[:, cols:], specAlbedoCoeff, self.albedoPca[:, cols:])
+        return colors.view(specAlbedoCoeff.shape[0], -1, 3)
 
     def computeShapeAlbedo(self, shapeCoeff, expCoeff, albedoCoeff):
         '''
@@ -251,9 +441,13 @@ class MorphableModel:
         :return: vertices [n, verticesNumber 3], diffuse albedo [n, verticesNumber 3], specAlbedo albedo [n, verticesNumber 3]
         '''
 
+        assert(albedoCoeff.dim() == 2 and albedoCoeff.shape[1] == self.albedoBasisSize)
         vertices = self.computeShape(shapeCoeff, expCoeff)
-        diffAlbedo = self.computeDiffuseAlbedo(albedoCoeff)
-        specAlbedo = self.computeSpecularAlbedo(albedoCoeff)
+        # diffuse and specular share the same coefficients: evaluate both with one product on the stacked basis
+        albedos = self.linearCombination('albedo', self.albedoMeanFlat, albedoCoeff, self.albedoPca)
+        cols = self.diffuseAlbedoPca.shape[1] * 3
+        diffAlbedo = albedos[:, 0:cols].view(albedoCoeff.shape[0], -1, 3)
+        specAlbedo = albedos[:, cols:].view(albedoCoeff.shape[0], -1, 3)
         return vertices, diffAlbedo, specAlbedo
 
     def computeShapeAlbedoMitsuba(self, shapeCoeff, expCoeff, albedoCoeff):
@@ -1,12 +1,16 @@
-from image import Image, ImageFolder, overlayImage, saveImage
+from image import Image, ImageFolder, VideoChunk, VideoSource, isVideoFile, overlayImage, saveImage
 from torchmetrics.functional.image import image_gradients
 from gaussiansmoothing import GaussianSmoothing, smoothImage
 from projection import estimateCameraPosition
+from landmarkscache import LandmarksCache
+from convergence import ConvergenceMonitor, FrameConvergenceMonitor
+from landmarksfitting import LandmarksFitting
 from textureloss import TextureLoss
 from pipeline import Pipeline
 from config import Config
 from utils import *
 import argparse
+import hashlib
 import pickle
 import tqdm
 import sys
@@ -21,7 +25,9 @@ class Optimizer:
 
         if self.config.lamdmarksDetectorType == 'fan':
             from landmarksfan import LandmarksDetectorFAN
-            self.landmarksDetector = LandmarksDetectorFAN(self.pipeline.morphableModel.landmarksMask, self.device)
+            self.landmarksDetector = LandmarksDetectorFAN(self.pipeline.morphableModel.landmarksMask, self.device,
+                                                          batchSize = self.config.fanBatchSize,
+                                                          trackFaceBoxes = self.config.trackFaceBoxes)
         elif self.config.lamdmarksDetectorType == 'mediapipe':
             from landmarksmediapipe import LandmarksDetectorMediapipe
             self.landmarksDetector = LandmarksDetectorMediapipe(self.pipeline.morphableModel.landmarksMask, self.device)
@@ -32,6 +38,8 @@ class Optimizer:
 
         self.inputImage = None
         self.landmarks = None
+        self.videoMode = False
+        self.stageIterations = {}
         torch.set_grad_enabled(False)
         self.smoothing = GaussianSmoothing(3, 3, 1.0, 2).to(self.device)
         self.outputDir = outputDir + '/'
@@ -45,6 +53,7 @@ class Optimizer:
         self.vEnhancedDiffuse = None
         self.vEnhancedSpecular = None
         self.vEnhancedRoughness = None
+        self.maskCache = None # (key, projected vertices, mask) of the last mask computed by getMask
 
     def saveParameters(self, outputFileName):
 
@@ -138,14 +147,17 @@ class Optimizer:
         self.pipeline.vFocals.requires_grad = True
         self.pipeline.vShCoeffs.requires_grad = True
 
-    def setImage(self, imagePath, sharedIdentity = False):
+    def setImage(self, imagePath, sharedIdentity = False, frames = None):
         '''
         set image to estimate face reflectance and geometry
         :param imagePath: drive path to the image
         :param sharedIdentity: if true than the shape and albedo coeffs are equal to 1, as they belong to the same person identity
+        :param frames: if not None, already decoded frames (a VideoChunk of the video at imagePath) used instead of loading imagePath
         :return:
         '''
-        if os.path.isfile(imagePath):
+        if frames is not None:
+            self.inputImage = frames
+        elif os.path.isfile(imagePath):
             self.inputImage = Image(imagePath, self.device, self.config.maxResolution)
         else:
             self.inputImage = ImageFolder(imagePath, self.device, self.config.maxResolution)
@@ -156,17 +168,53 @@ class Optimizer:
         self.pipeline.renderer.screenHeight = self.inputImage.height
 
         print('detecting landmarks using:', self.config.lamdmarksDetectorType)
-        landmarks = self.landmarksDetector.detect(self.inputImage.tensor)
+        landmarks, detected = self.detectLandmarks(imagePath)
         #assert (landmarks.shape[0] == 1)  # can only handle single subject in image
         assert (landmarks.dim() == 3 and landmarks.shape[2] == 2)
         self.landmarks = landmarks
         for i in range(self.framesNumber):
-            imagesLandmark = self.landmarksDetector.drawLandmarks(self.inputImage.tensor[i], self.landmarks[i])
-            cv2.imwrite(self.outputDir  + '/landmarks' + str(i) + '.png', cv2.cvtColor(imagesLandmark, cv2.COLOR_BGR2RGB) )
+            fileName = self.outputDir  + '/landmarks' + str(i) + '.png'
+            if detected[i] or not os.path.exists(fileName):
+                imagesLandmark = self.landmarksDetector.drawLandmarks(self.inputImage.tensor[i], self.landmarks[i])
+                cv2.imwrite(fileName, cv2.cvtColor(imagesLandmark, cv2.COLOR_BGR2RGB) )
         self.pipeline.initSceneParameters(self.framesNumber, sharedIdentity)
         self.initCameraPos() #always init the head pose (rotation + translation)
         self.enableGrad()
 
+    def detectLandmarks(self, imagePath):
+        '''
+        detect the landmarks of the input images. if the landmarks cache is enabled, only the images not found in the cache are sent to the detector
+        :param imagePath: path of the image or the images folder (the cache file is stored next to it unless landmarksCachePath is set)
+        :return: landmarks tensor [n, landmarksNumber, 2], list of n booleans (True if the frame landmarks were detected, False if they come from the cache)
+        '''
+        images = self.inputImage.tensor
+        if not self.config.useLandmarksCache:
+            return self.landmarksDetector.detect(images), [True] * images.shape[0]
+
+        cachePath = self.config.landmarksCachePath if self.config.landmarksCachePath else os.path.normpath(imagePath) + '.landmarks.cache'
+        mask = self.pipeline.morphableModel.landmarksMask.detach().cpu().numpy().astype(np.int64)
+        settings = '|'.join([self.config.lamdmarksDetectorType,
+                             'tracking' if self.videoMode or (self.config.lamdmarksDetectorType == 'fan' and self.config.trackFaceBoxes) else 'static',
+                             hashlib.sha1(mask.tobytes()).hexdigest(),
+                             str(self.config.maxResolution)])
+        cache = LandmarksCache(cachePath, settings)
+
+        keys = [cache.imageKey(images[i]) for i in range(images.shape[0])]
+        landmarks = [cache.get(key) for key in keys]
+        missing = [i for i in range(len(landmarks)) if landmarks[i] is None]
+        if len(missing) > 0:
+            detectedLandmarks = self.landmarksDetector.detect(images[missing]).detach().cpu().numpy()
+            for j, i in enumerate(missing):
+                landmarks[i] = detectedLandmarks[j]
+                cache.put(keys[i], detectedLandmarks[j])
+            cache.save()
+
+        print('[INFO] landmarks cache:', cache.hits, 'hit(s),', cache.misses, 'miss(es)')
+        detected = [False] * len(landmarks)
+        for i in missing:
+            detected[i] = True
+        return torch.from_numpy(np.stack(landmarks).astype(np.float32)).to(self.device), detected
+
     def initCameraPos(self):
         print('init camera pose...', file=sys.stderr, flush=True)
         association = self.pipeline.morphableModel.landmarksAssociation
@@ -174,7 +222,9 @@ class Optimizer:
         headPoints = vertices[:, association]
         rot, trans = estimateCameraPosition(self.pipeline.vFocals, self.inputImage.center,
                                     self.landmarks, headPoints, self.pipeline.vRotation,
-                                    self.pipeline.vTranslation)
+                                    self.pipeline.vTranslation,
+                                    solver = self.config.pnpSolver,
+                                    workers = self.config.pnpWorkers)
 
         self.pipeline.vRotation = rot.clone().detach()
         self.pipeline.vTranslation = trans.clone().detach()
@@ -321,6 +371,27 @@ class Optimizer:
         plt.colorbar(label='debugTensor')
         plt.show()
         
+    def createConvergenceMonitor(self, minIterations = None):
+        return ConvergenceMonitor(self.config.convergenceTolerance,
+                                  self.config.convergencePatience,
+                                  self.config.convergenceMinIterations if minIterations is None else minIterations)
+
+    def createFrameConvergenceMonitor(self, minIterations = None):
+        # with a shared identity the shared parameters must keep seeing every frame: converged frames are frozen but not dropped from the loss
+        return FrameConvergenceMonitor(self.framesNumber,
+                                       self.config.convergenceTolerance,
+                                       self.config.convergencePatience,
+                                       self.config.convergenceMinIterations if minIterations is None else minIterations,
+                                       dropFrames = not self.pipeline.sharedIdentity)
+
+    def reportIterations(self, stage, monitor, maxIterations):
+        '''
+        record the number of iterations a stage actually ran (written to the run report)
+        '''
+        self.stageIterations[stage] = monitor.iterations
+        if monitor.converged:
+            print(stage, 'converged after', monitor.iterations, 'iterations (max', str(maxIterations) + ')', file=sys.stderr, flush=True)
+
     def regStatModel(self, coeff, var):
         loss = ((coeff * coeff) / var).mean()
         return loss
@@ -332,11 +403,16 @@ class Optimizer:
         plt.scatter(np.arange(0, len(lossArr)).tolist(), lossArr, c='red')
         plt.savefig(fileName)
 
-    def landmarkLoss(self, cameraVertices, landmarks):
-        return self.pipeline.landmarkLoss(cameraVertices, landmarks, self.pipeline.vFocals, self.inputImage.center)
+    def landmarkLoss(self, cameraVertices, landmarks, sparse = False, frames = None, perFrame = False):
+        select = self.pipeline.selectFrames
+        return self.pipeline.landmarkLoss(cameraVertices, select(landmarks, frames), select(self.pipeline.vFocals, frames), select(self.inputImage.center, frames), sparse = sparse, perFrame = perFrame)
 
     def runStep1(self):
         print("1/3 => Optimizing head pose and expressions using landmarks...", file=sys.stderr, flush=True)
+        if self.config.step1Solver == 'lm':
+            return self.runStep1LM()
+        elif self.config.step1Solver != 'adam':
+            raise ValueError(f'step1Solver must be one of [adam, lm] but was {self.config.step1Solver}')
         torch.set_grad_enabled(True)
 
         params = [
@@ -352,11 +428,12 @@ class Optimizer:
         optimizer = torch.optim.Adam(params)
         losses = []
 
+        monitor = self.createConvergenceMonitor()
         for iter in tqdm.tqdm(range(self.config.iterStep1)):
             optimizer.zero_grad()
-            vertices = self.pipeline.computeShape()
-            cameraVertices = self.pipeline.transformVertices(vertices)
-            loss = self.landmarkLoss(cameraVertices, self.landmarks)
+            # only the landmarks vertices are needed by the loss: evaluate the model on the landmarks sub-basis
+            projLandmarks = self.pipeline.projectLandmarks(self.inputImage.center)
+            loss = self.pipeline.landmarkPixelsLoss(projLandmarks, self.landmarks)
             loss += 0.1 * self.regStatModel(self.pipeline.vExpCoeff, self.pipeline.morphableModel.expressionPcaVar)
             loss.backward()
             optimizer.step()
@@ -364,7 +441,9 @@ class Optimizer:
             if self.verbose:
                 print(iter, '=>', loss.item())
             if self.config.debugFrequency > 0 and iter % self.config.debugFrequency == 0:
-                    # save obj
+                    # save obj (the dense mesh is only built here)
+                    with torch.no_grad():
+                        cameraVertices = self.pipeline.transformVertices()
                     cameraNormals = self.pipeline.morphableModel.computeNormals(cameraVertices) # only used of obj (might be too slow)
                     saveObj(self.debugDir + '/mesh/' + self.renderer+'_step1_iter' + str(iter)+'.obj',
                             'material' + str(iter) + '.mtl',
@@ -374,9 +453,74 @@ class Optimizer:
                             self.pipeline.morphableModel.uvMap,
                             self.debugDir + 'diffuseMap_' + str(self.getTextureIndex(0)) + '.png')
 
+            if monitor.step(losses[-1]):
+                break
+
+        self.reportIterations('stage1', monitor, self.config.iterStep1)
         self.plotLoss(losses, 1, self.outputDir + 'checkpoints/stage1_loss.png')
         self.saveParameters(self.outputDir + 'checkpoints/stage1_output.pickle')
                     
+    def runStep1LM(self):
+        '''
+        stage 1 solved with levenberg-marquardt (see landmarksfitting.py): same objective as the adam path, each frame stops when its cost stops decreasing
+        '''
+        pipeline = self.pipeline
+        solver = LandmarksFitting(pipeline.morphableModel, 0.1, self.config.optimizeFocalLength)
+        rotation, translation, expCoeff, focals, losses = solver.solve(pipeline.vRotation.detach(), pipeline.vTranslation.detach(),
+                                                                       pipeline.vExpCoeff.detach(), pipeline.vFocals.detach(),
+                                                                       pipeline.vShapeCoeff.detach(), self.landmarks, self.inputImage.center,
+                                                                       iterations = self.config.lmIterations,
+                                                                       tolerance = max(self.config.convergenceTolerance, 0.),
+                                                                       verbose = self.verbose)
+        with torch.no_grad():
+            pipeline.vRotation.copy_(rotation)
+            pipeline.vTranslation.copy_(translation)
+            pipeline.vExpCoeff.copy_(expCoeff)
+            pipeline.vFocals.copy_(focals)
+
+        if self.config.debugFrequency > 0:
+            with torch.no_grad():
+                cameraVertices = pipeline.transformVertices()
+                cameraNormals = pipeline.morphableModel.computeNormals(cameraVertices)
+            saveObj(self.debugDir + '/mesh/' + self.renderer + '_step1_iter' + str(solver.iterations) + '.obj',
+                    'material' + str(solver.iterations) + '.mtl',
+                    cameraVertices[0],
+                    pipeline.faces32,
+                    cameraNormals[0],
+                    pipeline.morphableModel.uvMap,
+                    self.debugDir + 'diffuseMap_' + str(self.getTextureIndex(0)) + '.png')
+
+        self.reportIterations('stage1', solver, self.config.lmIterations)
+        self.plotLoss(losses, 1, self.outputDir + 'checkpoints/stage1_loss.png')
+        self.saveParameters(self.outputDir + 'checkpoints/stage1_output.pickle')
+
+    def buildPyramid(self, inputTensor, iterations):
+        '''
+        build the coarse to fine schedule of stage 2 (see pyramidResolutions and pyramidIterations in config)
+        :param inputTensor: gamma linearized input images [n, h, w, 3]
+        :param iterations: total number of iterations of the stage
+        :return: list of levels (first iteration, width, height, scale, target images), the last one is the full resolution
+        '''
+        width, height = self.inputImage.width, self.inputImage.height
+        resolutions = [int(r) for r in self.config.pyramidResolutions.split(',') if r.strip()]
+        budgets = [int(i) for i in self.config.pyramidIterations.split(',') if i.strip()]
+        if len(resolutions) != len(budgets):
+            raise ValueError(f'pyramidResolutions and pyramidIterations must have the same number of values but were {self.config.pyramidResolutions} and {self.config.pyramidIterations}')
+
+        levels = []
+        firstIteration = 0
+        for resolution, budget in zip(resolutions, budgets):
+            if resolution >= width or budget <= 0 or firstIteration + budget > iterations:
+                continue
+            scale = resolution / width
+            levelHeight = max(1, round(height * scale))
+            # the targets are area downsampled once per level
+            target = torch.nn.functional.interpolate(inputTensor.permute(0, 3, 1, 2), size=(levelHeight, resolution), mode='area').permute(0, 2, 3, 1).contiguous()
+            levels.append((firstIteration, resolution, levelHeight, scale, target))
+            firstIteration += budget
+        levels.append((firstIteration, width, height, 1.0, inputTensor))
+        return levels
+
     def runStep2(self):
         print("2/3 => Optimizing shape, statistical albedos, expression, head pose and scene light...", file=sys.stderr, flush=True)
         torch.set_grad_enabled(True)
@@ -392,92 +536,145 @@ class Optimizer:
         ])
         losses = []
         
-        for iter in tqdm.tqdm(range(self.config.iterStep2 + 1)):
-            if iter == 100:
-                optimizer.add_param_group({'params': self.pipeline.vShapeCoeff, 'lr': 0.01}) #0.01
-                optimizer.add_param_group({'params': self.pipeline.vExpCoeff, 'lr': 0.01}) # 0.01
-                optimizer.add_param_group({'params': self.pipeline.vRotation, 'lr': 0.0001})
-                optimizer.add_param_group({'params': self.pipeline.vTranslation, 'lr': 0.0001})
-            optimizer.zero_grad() 
+        # frames that converged are frozen and no more rendered (unless the identity is shared, see createFrameConvergenceMonitor)
+        frameMonitor = self.createFrameConvergenceMonitor(max(self.config.convergenceMinIterations, 101))
+        perFrameParameters = [self.pipeline.vShCoeffs, self.pipeline.vExpCoeff, self.pipeline.vRotation, self.pipeline.vTranslation]
+        if not self.pipeline.sharedIdentity:
+            perFrameParameters += [self.pipeline.vShapeCoeff, self.pipeline.vAlbedoCoeff]
+        # coarse to fine: the first iterations only fix the coarse lighting and albedo and are done at lower resolutions
+        levels = self.buildPyramid(inputTensor, self.config.iterStep2 + 1)
+        level = 0
+
+        def setLevel(index):
+            _, levelWidth, levelHeight, levelScale, levelInput = levels[index]
+            if len(levels) > 1:
+                self.pipeline.setRenderResolution(levelWidth, levelHeight, levelScale)
+            if index > 0: # the loss scale changes with the resolution
+                frameMonitor.reset()
+            return levelInput
+
+        levelInput = setLevel(level)
+        try:
+            for iter in tqdm.tqdm(range(self.config.iterStep2 + 1)):
+                if level + 1 < len(levels) and iter == levels[level + 1][0]:
+                    level += 1
+                    levelInput = setLevel(level)
+                if iter == 100:
+                    optimizer.add_param_group({'params': self.pipeline.vShapeCoeff, 'lr': 0.01}) #0.01
+                    optimizer.add_param_group({'params': self.pipeline.vExpCoeff, 'lr': 0.01}) # 0.01
+                    optimizer.add_param_group({'params': self.pipeline.vRotation, 'lr': 0.0001})
+                    optimizer.add_param_group({'params': self.pipeline.vTranslation, 'lr': 0.0001})
+                optimizer.zero_grad() 
            
-            vertices, diffAlbedo, specAlbedo = self.pipeline.morphableModel.computeShapeAlbedo(self.pipeline.vShapeCoeff, self.pipeline.vExpCoeff, self.pipeline.vAlbedoCoeff)
-            cameraVerts = self.pipeline.camera.transformVertices(vertices, self.pipeline.vTranslation, self.pipeline.vRotation)
-            diffuseTextures = self.pipeline.morphableModel.generateTextureFromAlbedo(diffAlbedo)
-            specularTextures = self.pipeline.morphableModel.generateTextureFromAlbedo(specAlbedo)
-            roughTextures = self.pipeline.vRoughness.detach().clone() if self.vEnhancedRoughness is None else self.vEnhancedRoughness.detach().clone()
-            # clamp values to not have errors
-            diffuseTextures = diffuseTextures.clamp(0,1)
-            specularTextures = specularTextures.clamp(0,1)
-            roughTextures = roughTextures.clamp(0,1)
-
-            # IMAGE IS [X, Y, 4]
-            # render -> updates the scene as well as the params
+                if self.pipeline.morphableModel.textureBasis is not None and self.renderer != 'vertex':
+                    # textures straight from the texture space basis, no per vertex albedo needed
+                    vertices = self.pipeline.computeShape()
+                    diffAlbedo, specAlbedo = None, None
+                    diffuseTextures, specularTextures = self.pipeline.morphableModel.computeTextures(self.pipeline.vAlbedoCoeff)
+                else:
+                    vertices, diffAlbedo, specAlbedo = self.pipeline.morphableModel.computeShapeAlbedo(self.pipeline.vShapeCoeff, self.pipeline.vExpCoeff, self.pipeline.vAlbedoCoeff)
+                    diffuseTextures = self.pipeline.morphableModel.generateTextureFromAlbedo(diffAlbedo, 'diffuseTextures')
+                    specularTextures = self.pipeline.morphableModel.generateTextureFromAlbedo(specAlbedo, 'specularTextures')
+                cameraVerts = self.pipeline.camera.transformVertices(vertices, self.pipeline.vTranslation, self.pipeline.vRotation)
+                roughTextures = self.pipeline.vRoughness.detach().clone() if self.vEnhancedRoughness is None else self.vEnhancedRoughness.detach().clone()
+                # clamp values to not have errors
+                diffuseTextures = diffuseTextures.clamp(0,1)
+                specularTextures = specularTextures.clamp(0,1)
+                roughTextures = roughTextures.clamp(0,1)
+
+                # only the frames that did not converge yet are rendered
+                frames = frameMonitor.activeFrames(self.device)
+                select = self.pipeline.selectFrames
+                cameraVerts, diffAlbedo, specAlbedo = select(cameraVerts, frames), select(diffAlbedo, frames), select(specAlbedo, frames)
+                diffuseTextures, specularTextures, roughTextures = select(diffuseTextures, frames), select(specularTextures, frames), select(roughTextures, frames)
+                frameInput = select(levelInput, frames)
+
+                # IMAGE IS [X, Y, 4]
+                # render -> updates the scene as well as the params
             
-            if self.renderer == 'vertex':
-                rgba_img = self.pipeline.renderVertexBased(cameraVerts, diffAlbedo, specAlbedo) # vertex based
-                # mask_alpha = self.getMask(cameraVerts, diffAlbedo) #redondant                
-                mask_alpha = rgba_img[...,3:]                
-            elif self.renderer == 'redner':
-                rgba_img = self.pipeline.render(cameraVerts, diffuseTextures, specularTextures) #redner
-                mask_alpha = rgba_img[...,3:]
+                if self.renderer == 'vertex':
+                    rgba_img = self.pipeline.renderVertexBased(cameraVerts, diffAlbedo, specAlbedo, frames = frames) # vertex based
+                    # mask_alpha = self.getMask(cameraVerts, diffAlbedo) #redondant                
+                    mask_alpha = rgba_img[...,3:]                
+                elif self.renderer == 'redner':
+                    rgba_img = self.pipeline.render(cameraVerts, diffuseTextures, specularTextures, frames = frames) #redner
+                    mask_alpha = rgba_img[...,3:]
                 
-            elif self.renderer == 'mitsuba':
-                rgba_img = self.pipeline.renderMitsuba(cameraVerts, diffuseTextures, specularTextures) #mitsuba
-                mask_alpha = self.getMask(cameraVerts, diffAlbedo)
+                elif self.renderer == 'mitsuba':
+                    rgba_img = self.pipeline.renderMitsuba(cameraVerts, diffuseTextures, specularTextures, frames = frames) #mitsuba
+                    mask_alpha = self.getMask(cameraVerts, diffAlbedo, frames)
                     
-            if self.config.smoothing :
-                smoothedImage = smoothImage(rgba_img[..., 0:3], self.smoothing)            
-                diff = mask_alpha * (smoothedImage - inputTensor).abs()
-            else :
-                diff = mask_alpha * (rgba_img[..., 0:3] - inputTensor).abs()
-            photoLoss = 1000.* diff.mean()
-            landmarksLoss = self.config.weightLandmarksLossStep2 *  self.landmarkLoss(cameraVerts, self.landmarks)
-            regLoss = 0.0001 * self.pipeline.vShCoeffs.pow(2).mean()
-            regLoss += self.config.weightAlbedoReg * self.regStatModel(self.pipeline.vAlbedoCoeff, self.pipeline.morphableModel.diffuseAlbedoPcaVar)
-            regLoss += self.config.weightShapeReg * self.regStatModel(self.pipeline.vShapeCoeff, self.pipeline.morphableModel.shapePcaVar)
-            regLoss += self.config.weightExpressionReg * self.regStatModel(self.pipeline.vExpCoeff, self.pipeline.morphableModel.expressionPcaVar)
-
-            loss = photoLoss + landmarksLoss + regLoss
-            losses.append(loss.item())
-            loss.backward()
-            # grad_loss = loss.grad
-            # grad_shapeCoeff = self.pipeline.vShapeCoeff.grad
-            # grad_expCoeff = self.pipeline.vExpCoeff.grad
-            # grad_shCoeff = self.pipeline.vShCoeffs.grad
-            # grad_rotation = self.pipeline.vRotation.grad
-            # grad_translation = self.pipeline.vTranslation.grad
-            # grad_albedo = self.pipeline.vAlbedoCoeff.grad
-            optimizer.step()
+                if self.config.smoothing :
+                    smoothedImage = smoothImage(rgba_img[..., 0:3], self.smoothing)            
+                    diff = mask_alpha * (smoothedImage - frameInput).abs()
+                else :
+                    diff = mask_alpha * (rgba_img[..., 0:3] - frameInput).abs()
+                # per frame data terms, normalized by the total number of frames so that the gradients do not depend on how many frames are active
+                frameLosses = 1000. * diff.mean(dim=(1, 2, 3))
+                photoLoss = frameLosses.sum() / self.framesNumber
+                frameLandmarksLosses = self.config.weightLandmarksLossStep2 * self.landmarkLoss(cameraVerts, self.landmarks, frames = frames, perFrame = True)
+                frameLosses = frameLosses + frameLandmarksLosses
+                landmarksLoss = frameLandmarksLosses.sum() / self.framesNumber
+                regLoss = 0.0001 * self.pipeline.vShCoeffs.pow(2).mean()
+                regLoss += self.config.weightAlbedoReg * self.regStatModel(self.pipeline.vAlbedoCoeff, self.pipeline.morphableModel.diffuseAlbedoPcaVar)
+                regLoss += self.config.weightShapeReg * self.regStatModel(self.pipeline.vShapeCoeff, self.pipeline.morphableModel.shapePcaVar)
+                regLoss += self.config.weightExpressionReg * self.regStatModel(self.pipeline.vExpCoeff, self.pipeline.morphableModel.expressionPcaVar)
+
+                loss = photoLoss + landmarksLoss + regLoss
+                losses.append(loss.item())
+                loss.backward()
+                # grad_loss = loss.grad
+                # grad_shapeCoeff = self.pipeline.vShapeCoeff.grad
+                # grad_expCoeff = self.pipeline.vExpCoeff.grad
+                # grad_shCoeff = self.pipeline.vShCoeffs.grad
+                # grad_rotation = self.pipeline.vRotation.grad
+                # grad_translation = self.pipeline.vTranslation.grad
+                # grad_albedo = self.pipeline.vAlbedoCoeff.grad
+                frameMonitor.maskGradients(perFrameParameters)
+                optimizer.step()
+                frameMonitor.restoreParameters(perFrameParameters)
             
-            if self.verbose:
-                print(iter, '. photo Loss:', loss,
-                      '. landmarks Loss: ', landmarksLoss.item(),
-                      '. regLoss: ', regLoss.item())
-                print(f"Iteration {iter:03d}: Loss {self.renderer} = {losses[0]:6f}", end='\r')
-
-            if self.config.debugFrequency > 0 and iter % self.config.debugFrequency == 0:
-                self.debugFrame(rgba_img[..., 0:3], inputTensor, diff, diffuseTextures, specularTextures, roughTextures, self.debugDir + '/results/'+self.renderer+'_step2_' + str(iter))
-                # generate one with mitsuba for reference
-                # image_grad = image_gradients(rgba_img)
-                # self.debugImageGrad(rgba_img[..., 0:3], inputTensor, image_grad[0], image_grad[1], self.debugDir + '/Baseline/mitsuba/mitsuba_gradient_' + str(iter))
-                # self.debugFrameGrad(rgba_img[..., 0:3], inputTensor, grad_shapeCoeff, grad_expCoeff, grad_shCoeff, grad_rotation, grad_translation, grad_albedo,self.debugDir + '/results/'+self.renderer+'_gradient' + str(iter) )
-                if self.renderer == 'vertex':
-                    mitsuba_img = self.pipeline.renderMitsuba(cameraVerts, diffuseTextures, specularTextures) #mitsuba
-                    self.debugRender(mitsuba_img[..., 0:3],self.debugDir + '/results/ref')
-                    lightingVertexRender = self.pipeline.renderVertexBased(cameraVerts, diffAlbedo, specAlbedo, lightingOnly=True)
-                    albedoVertexRender = self.pipeline.renderVertexBased(cameraVerts, diffAlbedo, specAlbedo, albedoOnly=True)
-                    self.debugIteration(rgba_img[..., 0:3], inputTensor,diff, albedoVertexRender, lightingVertexRender, self.debugDir + '/results/'+self.renderer+ str(iter)+'_detailled_step2') # custom made
-                # also save obj
-                cameraNormals = self.pipeline.morphableModel.computeNormals(cameraVerts) # only used of obj (might be too slow)
-                for i in range(inputTensor.shape[0]):
-                    saveObj(self.debugDir + '/mesh/' + self.renderer+'_step2_iter' + str(iter)+'.obj',
-                            'material' + str(iter) + '.mtl',
-                            cameraVerts[i],
-                            self.pipeline.faces32,
-                            cameraNormals[i],
-                            self.pipeline.morphableModel.uvMap,
-                            self.debugDir + 'diffuseMap_' + str(self.getTextureIndex(i)) + '.png')
+                if self.verbose:
+                    print(iter, '. photo Loss:', loss,
+                          '. landmarks Loss: ', landmarksLoss.item(),
+                          '. regLoss: ', regLoss.item())
+                    print(f"Iteration {iter:03d}: Loss {self.renderer} = {losses[0]:6f}", end='\r')
+
+                if self.config.debugFrequency > 0 and iter % self.config.debugFrequency == 0:
+                    self.debugFrame(rgba_img[..., 0:3], frameInput, diff, diffuseTextures, specularTextures, roughTextures, self.debugDir + '/results/'+self.renderer+'_step2_' + str(iter))
+                    # generate one with mitsuba for reference
+                    # image_grad = image_gradients(rgba_img)
+                    # self.debugImageGrad(rgba_img[..., 0:3], inputTensor, image_grad[0], image_grad[1], self.debugDir + '/Baseline/mitsuba/mitsuba_gradient_' + str(iter))
+                    # self.debugFrameGrad(rgba_img[..., 0:3], inputTensor, grad_shapeCoeff, grad_expCoeff, grad_shCoeff, grad_rotation, grad_translation, grad_albedo,self.debugDir + '/results/'+self.renderer+'_gradient' + str(iter) )
+                    if self.renderer == 'vertex':
+                        mitsuba_img = self.pipeline.renderMitsuba(cameraVerts, diffuseTextures, specularTextures, frames = frames) #mitsuba
+                        self.debugRender(mitsuba_img[..., 0:3],self.debugDir + '/results/ref')
+                        lightingVertexRender = self.pipeline.renderVertexBased(cameraVerts, diffAlbedo, specAlbedo, lightingOnly=True, frames = frames)
+                        albedoVertexRender = self.pipeline.renderVertexBased(cameraVerts, diffAlbedo, specAlbedo, albedoOnly=True, frames = frames)
+                        self.debugIteration(rgba_img[..., 0:3], frameInput,diff, albedoVertexRender, lightingVertexRender, self.debugDir + '/results/'+self.renderer+ str(iter)+'_detailled_step2') # custom made
+                    # also save obj
+                    cameraNormals = self.pipeline.morphableModel.computeNormals(cameraVerts) # only used of obj (might be too slow)
+                    for i in range(frameInput.shape[0]):
+                        saveObj(self.debugDir + '/mesh/' + self.renderer+'_step2_iter' + str(iter)+'.obj',
+                                'material' + str(iter) + '.mtl',
+                                cameraVerts[i],
+                                self.pipeline.faces32,
+                                cameraNormals[i],
+                                self.pipeline.morphableModel.uvMap,
+                                self.debugDir + 'diffuseMap_' + str(self.getTextureIndex(i)) + '.png')
                    
+                if frameMonitor.step(frameLosses, frames):
+                    if level == len(levels) - 1:
+                        break
+                    # converged at a coarse level: go straight to the full resolution
+                    level = len(levels) - 1
+                    levelInput = setLevel(level)
+        finally:
+            # the next stages (and the outputs) render at the input resolution
+            if len(levels) > 1:
+                self.pipeline.setRenderResolution(self.inputImage.width, self.inputImage.height, 1.0)
+
+        self.reportIterations('stage2', frameMonitor, self.config.iterStep2)
         self.plotLoss(losses, 1, self.outputDir + 'checkpoints/stage2_loss.png')
         self.saveParameters(self.outputDir + 'checkpoints/stage2_output.pickle')
 
@@ -519,58 +716,104 @@ class Optimizer:
 
         losses = []
 
+        # only the textures are optimized: when the geometry, pose and lighting are frozen everything that depends on them
+        # (camera vertices, normals, env maps, mask, landmarks and regularization losses) is computed once
+        pipeline = self.pipeline
+        optimizedParameters = [p for group in optimizer.param_groups for p in group['params']]
+        frozenParameters = [pipeline.vShapeCoeff, pipeline.vExpCoeff, pipeline.vAlbedoCoeff, pipeline.vRotation, pipeline.vTranslation, pipeline.vFocals, pipeline.vShCoeffs]
+        geometryFrozen = not any(p is q for p in frozenParameters for q in optimizedParameters)
+        if geometryFrozen:
+            with torch.no_grad():
+                # the model may write into reused buffers when autograd is off: keep copies
+                vertices, diffAlbedo, specAlbedo = [x.clone() for x in pipeline.morphableModel.computeShapeAlbedo(pipeline.vShapeCoeff, pipeline.vExpCoeff, pipeline.vAlbedoCoeff)]
+                staticCameraVerts = pipeline.camera.transformVertices(vertices, pipeline.vTranslation, pipeline.vRotation).clone()
+                staticNormals = pipeline.morphableModel.meshNormals.computeNormals(staticCameraVerts).clone()
+                staticEnvMaps = pipeline.sh.toEnvMap(pipeline.vShCoeffs)
+                staticDiffAlbedo, staticSpecAlbedo = diffAlbedo, specAlbedo
+                staticLandmarksLosses = self.config.weightLandmarksLossStep3 * self.landmarkLoss(staticCameraVerts, self.landmarks, perFrame = True)
+                staticRegLoss = 0.0001 * pipeline.vShCoeffs.pow(2).mean()
+                staticRegLoss += self.config.weightExpressionReg * self.regStatModel(pipeline.vExpCoeff, pipeline.morphableModel.expressionPcaVar)
+                staticRegLoss += self.config.weightShapeReg * self.regStatModel(pipeline.vShapeCoeff, pipeline.morphableModel.shapePcaVar)
+                staticMask = self.getMask(staticCameraVerts, staticDiffAlbedo) if self.renderer == 'mitsuba' else None
+                # the vertex based image does not depend on the textures
+                staticImage = pipeline.renderVertexBased(staticCameraVerts, staticDiffAlbedo, staticSpecAlbedo) if self.renderer == 'vertex' else None
+
+        # frames that converged are frozen and no more rendered (unless the identity is shared, see createFrameConvergenceMonitor)
+        frameMonitor = self.createFrameConvergenceMonitor()
+        perFrameParameters = [] if self.pipeline.sharedIdentity else [vDiffTextures, vSpecTextures, vRoughTextures]
         for iter in tqdm.tqdm(range(self.config.iterStep3 + 1)):
             optimizer.zero_grad()
             # torch.cuda.empty_cache() # clear out the cache
-            vertices, diffAlbedo, specAlbedo = self.pipeline.morphableModel.computeShapeAlbedo(self.pipeline.vShapeCoeff, self.pipeline.vExpCoeff, self.pipeline.vAlbedoCoeff)
-            cameraVerts = self.pipeline.camera.transformVertices(vertices, self.pipeline.vTranslation, self.pipeline.vRotation)
+            if geometryFrozen:
+                cameraVerts, diffAlbedo, specAlbedo, normals, envMaps = staticCameraVerts, staticDiffAlbedo, staticSpecAlbedo, staticNormals, staticEnvMaps
+            else:
+                vertices, diffAlbedo, specAlbedo = self.pipeline.morphableModel.computeShapeAlbedo(self.pipeline.vShapeCoeff, self.pipeline.vExpCoeff, self.pipeline.vAlbedoCoeff)
+                cameraVerts = self.pipeline.camera.transformVertices(vertices, self.pipeline.vTranslation, self.pipeline.vRotation)
+                normals, envMaps = None, None
+
+            # only the frames that did not converge yet are rendered
+            frames = frameMonitor.activeFrames(self.device)
+            select = self.pipeline.selectFrames
+            cameraVerts, diffAlbedo, specAlbedo = select(cameraVerts, frames), select(diffAlbedo, frames), select(specAlbedo, frames)
+            normals, envMaps = select(normals, frames), select(envMaps, frames)
+            diffTextures, specTextures, roughTextures = select(vDiffTextures, frames), select(vSpecTextures, frames), select(vRoughTextures, frames)
+            frameInput = select(inputTensor, frames)
 
             if self.renderer == 'vertex':
-                rgba_img = self.pipeline.renderVertexBased(cameraVerts, diffAlbedo, specAlbedo) # vertex based
+                rgba_img = select(staticImage, frames) if geometryFrozen else self.pipeline.renderVertexBased(cameraVerts, diffAlbedo, specAlbedo, frames = frames) # vertex based
                 # mask_alpha = self.getMask(cameraVerts, diffAlbedo) #redondant                
                 mask_alpha = rgba_img[...,3:]                
             elif self.renderer == 'redner':
-                rgba_img = self.pipeline.render(cameraVerts, vDiffTextures, vSpecTextures) #redner
+                rgba_img = self.pipeline.render(cameraVerts, diffTextures, specTextures, frames = frames, normals = normals, envMaps = envMaps) #redner
                 mask_alpha = rgba_img[...,3:]
                 
             elif self.renderer == 'mitsuba':
-                rgba_img = self.pipeline.renderMitsuba(cameraVerts, vDiffTextures, vSpecTextures, vRoughTextures) #mitsuba
-                mask_alpha = self.getMask(cameraVerts, diffAlbedo)
+                rgba_img = self.pipeline.renderMitsuba(cameraVerts, diffTextures, specTextures, roughTextures, frames = frames, normals = normals, envMaps = envMaps) #mitsuba
+                mask_alpha = select(staticMask, frames) if geometryFrozen else self.getMask(cameraVerts, diffAlbedo, frames)
                 
             if self.config.smoothing :
                 smoothedImage = smoothImage(rgba_img[..., 0:3], self.smoothing)            
-                diff = mask_alpha * (smoothedImage - inputTensor).abs()
+                diff = mask_alpha * (smoothedImage - frameInput).abs()
             else :
-                diff = mask_alpha * (rgba_img[..., 0:3] - inputTensor).abs()
-
-            #loss =  diff.mean(dim=-1).sum() / float(self.framesNumber)
-            loss = 1000.0 * diff.mean()
+                diff = mask_alpha * (rgba_img[..., 0:3] - frameInput).abs()
+
+            # per frame data terms, normalized by the total number of frames so that the gradients do not depend on how many frames are active
+            if geometryFrozen:
+                landmarksLosses = select(staticLandmarksLosses, frames)
+            else:
+                landmarksLosses = self.config.weightLandmarksLossStep3 * self.landmarkLoss(cameraVerts, self.landmarks, frames = frames, perFrame = True)
+            frameLosses = 1000.0 * diff.mean(dim=(1, 2, 3)) + landmarksLosses
+            loss = frameLosses.sum() / self.framesNumber
             loss += 0.2 * (self.textureLoss.regTextures(vDiffTextures, refDiffTextures, ws = self.config.weightDiffuseSymmetryReg, wr =  self.config.weightDiffuseConsistencyReg, wc = self.config.weightDiffuseConsistencyReg, wsm = self.config.weightDiffuseSmoothnessReg, wm = 0.) + \
                     self.textureLoss.regTextures(vSpecTextures, refSpecTextures, ws = self.config.weightSpecularSymmetryReg, wr = self.config.weightSpecularConsistencyReg, wc = self.config.weightSpecularConsistencyReg, wsm = self.config.weightSpecularSmoothnessReg, wm = 0.5) + \
                     self.textureLoss.regTextures(vRoughTextures, refRoughTextures, ws = self.config.weightRoughnessSymmetryReg, wr = self.config.weightRoughnessConsistencyReg, wc = self.config.weightRoughnessConsistencyReg, wsm = self.config.weightRoughnessSmoothnessReg, wm = 0.))
-            loss += 0.0001 * self.pipeline.vShCoeffs.pow(2).mean()
-            loss += self.config.weightExpressionReg * self.regStatModel(self.pipeline.vExpCoeff, self.pipeline.morphableModel.expressionPcaVar)
-            loss += self.config.weightShapeReg * self.regStatModel(self.pipeline.vShapeCoeff, self.pipeline.morphableModel.shapePcaVar)
-            loss += self.config.weightLandmarksLossStep3 * self.landmarkLoss(cameraVerts, self.landmarks)
+            if geometryFrozen:
+                loss += staticRegLoss
+            else:
+                loss += 0.0001 * self.pipeline.vShCoeffs.pow(2).mean()
+                loss += self.config.weightExpressionReg * self.regStatModel(self.pipeline.vExpCoeff, self.pipeline.morphableModel.expressionPcaVar)
+                loss += self.config.weightShapeReg * self.regStatModel(self.pipeline.vShapeCoeff, self.pipeline.morphableModel.shapePcaVar)
 
             losses.append(loss.item())
 
             loss.backward()
+            frameMonitor.maskGradients(perFrameParameters)
             optimizer.step()
+            frameMonitor.restoreParameters(perFrameParameters)
             if self.verbose:
                 print(iter, ' => Loss:', loss.item())
 
             if self.config.debugFrequency > 0 and iter % self.config.debugFrequency == 0:
-                self.debugFrame(rgba_img[..., 0:3], inputTensor, diff, vDiffTextures, vSpecTextures, vRoughTextures, self.debugDir + '/results/'+self.renderer+'_step3_' + str(iter))
+                self.debugFrame(rgba_img[..., 0:3], frameInput, diff, diffTextures, specTextures, roughTextures, self.debugDir + '/results/'+self.renderer+'_step3_' + str(iter))
                 if self.renderer == 'vertex':
-                    mitsuba_img = self.pipeline.renderMitsuba(cameraVerts, vDiffTextures, vSpecTextures, vRoughTextures) #mitsuba
+                    mitsuba_img = self.pipeline.renderMitsuba(cameraVerts, diffTextures, specTextures, roughTextures, frames = frames, normals = normals, envMaps = envMaps) #mitsuba
                     self.debugRender(mitsuba_img[..., 0:3],self.debugDir + '/results/ref') # save a ref of the image
-                    lightingVertexRender = self.pipeline.renderVertexBased(cameraVerts, diffAlbedo, specAlbedo, lightingOnly=True)
-                    albedoVertexRender = self.pipeline.renderVertexBased(cameraVerts, diffAlbedo, specAlbedo, albedoOnly=True)
-                    self.debugIteration(rgba_img[..., 0:3], inputTensor,diff, albedoVertexRender, lightingVertexRender, self.debugDir + '/results/'+self.renderer+ str(iter)+'_detailled_step3') # custom made
+                    lightingVertexRender = self.pipeline.renderVertexBased(cameraVerts, diffAlbedo, specAlbedo, lightingOnly=True, frames = frames)
+                    albedoVertexRender = self.pipeline.renderVertexBased(cameraVerts, diffAlbedo, specAlbedo, albedoOnly=True, frames = frames)
+                    self.debugIteration(rgba_img[..., 0:3], frameInput,diff, albedoVertexRender, lightingVertexRender, self.debugDir + '/results/'+self.renderer+ str(iter)+'_detailled_step3') # custom made
                 # also save obj
                 cameraNormals = self.pipeline.morphableModel.computeNormals(cameraVerts) # only used of obj (might be too slow)
-                for i in range(inputTensor.shape[0]):
+                for i in range(frameInput.shape[0]):
                     saveObj(self.debugDir + '/mesh/' + self.renderer+'_step3_iter_' + str(iter)+'.obj',
                             'material' + str(iter) + '.mtl',
                             cameraVerts[i],
@@ -579,6 +822,10 @@ class Optimizer:
                             self.pipeline.morphableModel.uvMap,
                             self.debugDir + 'diffuseMap_' + str(self.getTextureIndex(i)) + '.png')
                    
+            if frameMonitor.step(frameLosses, frames):
+                break
+
+        self.reportIterations('stage3', frameMonitor, self.config.iterStep3)
         self.plotLoss(losses, 1, self.outputDir + 'checkpoints/stage3_loss.png')
         self.saveParameters(self.outputDir + 'checkpoints/stage3_output.pickle')
 
@@ -663,7 +910,148 @@ class Optimizer:
         :return:
         '''
         self.renderer = renderer
+        if self.config.trackingMode and (isVideoFile(imagePathOrDir) or os.path.isdir(imagePathOrDir)):
+            self.runTracking(imagePathOrDir, checkpoint, doStep1, doStep2, doStep3, renderer)
+            return
+        if isVideoFile(imagePathOrDir):
+            self.runVideo(imagePathOrDir, sharedIdentity, checkpoint, doStep1, doStep2, doStep3, renderer)
+            return
         self.setImage(imagePathOrDir, sharedIdentity)
+        self.optimize(checkpoint, doStep1, doStep2, doStep3, renderer)
+
+    def runVideo(self, videoPath, sharedIdentity = False, checkpoint = None, doStep1 = True, doStep2 = True, doStep3 = True, renderer = 'mitsuba'):
+        '''
+        run optimization on a video file. the video is decoded in chunks of videoChunkSize consecutive frames that are optimized one after the other
+        (only one chunk is in memory at once). the landmarks detector runs in tracking mode across the whole video.
+        the results of each chunk are saved in outputDir/frames<first frame index>
+        :param videoPath: path to the video file
+        (see run for the other parameters, the checkpoint is only used for the first chunk)
+        '''
+        video = VideoSource(videoPath, self.device, self.config.maxResolution, self.config.videoChunkSize)
+        print('video:', videoPath, '(about', video.framesNumber, 'frames at', video.fps, 'fps)', file=sys.stderr, flush=True)
+        self.videoMode = True
+        if hasattr(self.landmarksDetector, 'setVideoMode'):
+            self.landmarksDetector.setVideoMode(True)
+
+        outputDir = self.outputDir
+        for chunk in video:
+            self.outputDir = outputDir + '/frames' + str(chunk.firstFrame).zfill(6) + '/'
+            mkdir_p(self.outputDir + '/checkpoints/')
+            self.setImage(videoPath, sharedIdentity, frames = chunk)
+            self.optimize(checkpoint if chunk.firstFrame == 0 else None, doStep1, doStep2, doStep3, renderer)
+            chunk = None
+            self.inputImage = None
+        self.outputDir = outputDir
+
+    def runTracking(self, path, checkpoint = None, doStep1 = True, doStep2 = True, doStep3 = True, renderer = 'mitsuba'):
+        '''
+        sequential tracking of a video (or of a folder of consecutive frames).
+        the identity (shape, albedo and textures) is solved once on the first frame with the full optimization (reference solve, saved in outputDir/reference).
+        every following frame starts from the pose, expression and light of the previous frame, which are refined for trackingIterations iterations
+        with the vertex renderer while the identity stays frozen. the per frame parameters are saved to outputDir/tracking.pickle
+        :param path: path to a video file or to a directory of frames
+        (see run for the other parameters, the checkpoint is used for the reference solve)
+        '''
+        import time
+        self.videoMode = True
+        if hasattr(self.landmarksDetector, 'setVideoMode'):
+            self.landmarksDetector.setVideoMode(True)
+
+        if isVideoFile(path):
+            chunks = VideoSource(path, self.device, self.config.maxResolution, self.config.videoChunkSize)
+        else:
+            folder = ImageFolder(path, self.device, self.config.maxResolution)
+            chunks = [VideoChunk(folder.tensor, 0, self.device)]
+
+        outputDir = self.outputDir
+        tracked = {'frames': [], 'vRotation': [], 'vTranslation': [], 'vExpCoeff': [], 'vShCoeffs': []}
+        optimizer = None
+        start = None
+        for chunk in chunks:
+            if optimizer is None:
+                self.outputDir = outputDir + '/reference/'
+                mkdir_p(self.outputDir + '/checkpoints/')
+                self.setImage(path, False, frames = chunk.frame(0))
+                self.optimize(checkpoint, doStep1, doStep2, doStep3, renderer)
+                self.outputDir = outputDir
+                optimizer = self.initTracking()
+                print('tracking frames...', file=sys.stderr, flush=True)
+                start = time.time()
+
+            self.inputImage = chunk
+            chunkLandmarks, _ = self.detectLandmarks(path)
+            for i in tqdm.tqdm(range(chunk.tensor.shape[0])):
+                self.inputImage = chunk.frame(i)
+                self.landmarks = chunkLandmarks[i: i + 1]
+                if chunk.firstFrame + i > 0: # the first frame is the reference solve
+                    self.trackFrame(optimizer, self.config.trackingIterations)
+                tracked['frames'].append(chunk.firstFrame + i)
+                tracked['vRotation'].append(self.pipeline.vRotation.detach().cpu().numpy()[0])
+                tracked['vTranslation'].append(self.pipeline.vTranslation.detach().cpu().numpy()[0])
+                tracked['vExpCoeff'].append(self.pipeline.vExpCoeff.detach().cpu().numpy()[0])
+                tracked['vShCoeffs'].append(self.pipeline.vShCoeffs.detach().cpu().numpy()[0])
+
+        if start is not None:
+            framesNumber = len(tracked['frames'])
+            message = "tracked {} frames in {:.2f} seconds ({:.3f} seconds per frame)".format(framesNumber, time.time() - start, (time.time() - start) / max(framesNumber - 1, 1))
+            print(message, file=sys.stderr, flush=True)
+
+        dict = {key: np.stack(val) for key, val in tracked.items()}
+        dict['vShapeCoeff'] = self.pipeline.vShapeCoeff.detach().cpu().numpy()
+        dict['vAlbedoCoeff'] = self.pipeline.vAlbedoCoeff.detach().cpu().numpy()
+        dict['vFocals'] = self.pipeline.vFocals.detach().cpu().numpy()
+        handle = open(self.outputDir + '/tracking.pickle', 'wb')
+        pickle.dump(dict, handle, pickle.HIGHEST_PROTOCOL)
+        handle.close()
+
+    def initTracking(self):
+        '''
+        freeze the identity of the reference solve and create the optimizer of the per frame refinement (pose, expression and light).
+        the per vertex albedos are computed once here, they do not change while tracking
+        :return: the optimizer, shared by all frames so that its state carries over from one frame to the next
+        '''
+        self.pipeline.vShapeCoeff.requires_grad = False
+        self.pipeline.vAlbedoCoeff.requires_grad = False
+        self.pipeline.vFocals.requires_grad = False
+        with torch.no_grad():
+            morphableModel = self.pipeline.morphableModel
+            self.trackingDiffAlbedo = morphableModel.computeDiffuseAlbedo(self.pipeline.vAlbedoCoeff).clone()
+            self.trackingSpecAlbedo = morphableModel.computeSpecularAlbedo(self.pipeline.vAlbedoCoeff).clone()
+
+        return torch.optim.Adam([
+            {'params': self.pipeline.vRotation, 'lr': 0.005},
+            {'params': self.pipeline.vTranslation, 'lr': 0.05},
+            {'params': self.pipeline.vExpCoeff, 'lr': 0.02},
+            {'params': self.pipeline.vShCoeffs, 'lr': 0.005}
+        ])
+
+    def trackFrame(self, optimizer, iterations):
+        '''
+        refine the pose, expression and light of the current frame (warm started from the previous frame) with the vertex renderer
+        :param optimizer: optimizer returned by initTracking
+        :param iterations: number of iterations
+        '''
+        torch.set_grad_enabled(True)
+        inputTensor = torch.pow(self.inputImage.tensor, self.inputImage.gamma)
+        for iter in range(iterations):
+            optimizer.zero_grad()
+            vertices = self.pipeline.computeShape()
+            cameraVerts = self.pipeline.camera.transformVertices(vertices, self.pipeline.vTranslation, self.pipeline.vRotation)
+            rgba_img = self.pipeline.renderVertexBased(cameraVerts, self.trackingDiffAlbedo, self.trackingSpecAlbedo)
+            diff = rgba_img[..., 3:] * (rgba_img[..., 0:3] - inputTensor).abs()
+            loss = 1000. * diff.mean()
+            loss += self.config.weightLandmarksLossTracking * self.landmarkLoss(cameraVerts, self.landmarks)
+            loss += 0.0001 * self.pipeline.vShCoeffs.pow(2).mean()
+            loss += self.config.weightExpressionReg * self.regStatModel(self.pipeline.vExpCoeff, self.pipeline.morphableModel.expressionPcaVar)
+            loss.backward()
+            optimizer.step()
+            if self.verbose:
+                print(iter, '=>', loss.item())
+
+    def optimize(self, checkpoint = None, doStep1 = True, doStep2 = True, doStep3 = True, renderer = 'mitsuba'):
+        '''
+        run the optimization stages on the current input (see setImage) and save the results
+        '''
         assert(self.framesNumber >= 1) #could not load any image from path
 
         if checkpoint is not None and checkpoint != '':
@@ -675,6 +1063,7 @@ class Optimizer:
             # self.loadAlbedoParameters(os.path.join(checkpoint_dir, "stage2_output.pickle"))
         import time
         start = time.time()
+        self.stageIterations = {}
         if doStep1:
             self.runStep1()
             if self.config.saveIntermediateStage:
@@ -687,6 +1076,8 @@ class Optimizer:
             self.runStep3()
         end = time.time()
         message = "took {:.2f} minutes to optimize".format((end - start) / 60.)
+        for stage, iterations in self.stageIterations.items():
+            message += "\n{}: {} iterations".format(stage, iterations)
         print(message, file=sys.stderr, flush=True)
 
         # Create a unique file name based on the current timestamp
@@ -697,30 +1088,42 @@ class Optimizer:
             file.write(message)
         self.saveOutput(self.outputDir)
     
-    def getMask(self, cameraVerts, diffuseAlbedo):
-       """generate a vertexBased Image and only take the alpha part
-       slower but cant find a mitsuba alternative that works 
-
-        Returns:
-            _type_: _description_
-       """
-       initialMask = self.pipeline.renderVertexBased(cameraVerts, diffuseAlbedo)[..., 3:]
-       # the mask is fileld with black holes from gaps between vertex
-       # Assuming mask is your mask image with random black points
-       # Convert the mask to uint8 format
-       mask = (initialMask[0].detach().cpu().numpy() * 255).astype(np.uint8)
-       # Define a kernel. The size of the kernel affects how many pixels around the black point will be considered
-       kernel = np.ones((5,5),np.uint8)
-       # Perform the closing operation
-       mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, kernel)
-       mask = torch.from_numpy(mask / 255.0).unsqueeze(0).unsqueeze(-1).to(self.device).to(torch.float32)
-    #    self.debugTensor(mask)
-       return mask
-   
+    def getMask(self, cameraVerts, diffuseAlbedo = None, frames = None):
+        '''
+        foreground mask of the face: the alpha of the vertex based image with the holes between the splatted vertices filled
+        by a morphological closing (5x5 max pooling dilation then erosion, on device).
+        the mask is cached and only recomputed when a projected vertex moved by more than maskTolerance pixels (see config)
+        :param cameraVerts: camera vertices [n, verticesNumber, 3]
+        :param diffuseAlbedo: unused (only the alpha is used)
+        :param frames: indices of the frames of cameraVerts (see Pipeline.selectFrames)
+        :return: mask [n, height, width, 1]
+        '''
+        with torch.no_grad():
+            pipeline = self.pipeline
+            cameraVerts = cameraVerts.detach()
+            focals = pipeline.selectFrames(pipeline.vFocals, frames).detach() * pipeline.renderScale
+            # clone: the projection is written into the camera buffer that the vertex based render below overwrites
+            pixels = pipeline.camera.projectVertices(cameraVerts, focals, torch.zeros([cameraVerts.shape[0], 2], dtype=cameraVerts.dtype, device=cameraVerts.device)).clone()
+            key = (None if frames is None else tuple(frames.tolist()), pipeline.renderWidth, pipeline.renderHeight)
+            if self.config.maskTolerance > 0. and self.maskCache is not None:
+                cachedKey, cachedPixels, cachedMask = self.maskCache
+                if cachedKey == key and cachedPixels.shape == pixels.shape and (pixels - cachedPixels).abs().amax().item() <= self.config.maskTolerance:
+                    return cachedMask
+
+            # only the alpha is used, the colors do not matter
+            alpha = pipeline.renderVertexBased(cameraVerts, torch.ones_like(cameraVerts), frames = frames)[..., 3:]
+            # the mask is filled with black holes from gaps between vertices: closing (same as cv2.MORPH_CLOSE with a 5x5 kernel)
+            mask = alpha.permute(0, 3, 1, 2)
+            mask = torch.nn.functional.max_pool2d(mask, 5, stride=1, padding=2)
+            mask = -torch.nn.functional.max_pool2d(-mask, 5, stride=1, padding=2)
+            mask = mask.permute(0, 2, 3, 1).contiguous()
+            self.maskCache = (key, pixels, mask)
+            return mask
+
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
-    parser.add_argument("--input", required=False, default='./input/s1.png', help="path to a directory or image to reconstruct (images in same directory should have the same resolution")
+    parser.add_argument("--input", required=False, default='./input/s1.png', help="path to a directory, image or video to reconstruct (images in same directory should have the same resolution")
 
     parser.add_argument("--sharedIdentity", dest='sharedIdentity', action='store_true', help='in case input directory contains multiple images, this flag tells the optimizations that all images are for the same person ( that means the identity shape and skin reflectance is common for all images), if this flag is false, that each image belong to a different subject', required=False)
     #parser.add_argument("--no-sharedIdentity", dest='sharedIdentity', action='store_false', help='in case input directory contains multiple images, this flag tells the optimizations that all images are for the same person ( that means the identity shape and skin reflectance is common for all images), if this flag is false, that each image belong to a different subject', required=False)
@@ -30,15 +30,27 @@ class Pipeline:
                                              textureResolution= config.textureResolution,
                                              trimPca= config.trimPca,
                                              landmarksPathName=pathLandmarksAssociation,
-                                             device = self.device
+                                             device = self.device,
+                                             useCache = config.useModelCache,
+                                             verifyCache = config.verifyModelCache,
+                                             shapeRank = config.shapeRank,
+                                             expressionRank = config.expressionRank,
+                                             albedoRank = config.albedoRank,
+                                             explainedVariance = config.explainedVariance,
+                                             textureBasis = config.useTextureBasis,
+                                             textureBasisRank = config.textureBasisRank
                                              )
         self.renderer = Renderer(config.rtTrainingSamples, 1, self.device)
-        self.rendererMitsuba = RendererMitsuba(config.rtTrainingSamples, config.bounces, self.device, self.config.maxResolution, self.config.maxResolution) # todo get screen size from somewhere
+        self.rendererMitsuba = RendererMitsuba(config.rtTrainingSamples, config.bounces, self.device, self.config.maxResolution, self.config.maxResolution, config.mitsubaThreads) # todo get screen size from somewhere
         self.uvMap = self.morphableModel.uvMap.clone()
         self.uvMap[:, 1] = 1.0 - self.uvMap[:, 1]
         self.faces32 = self.morphableModel.faces.to(torch.int32).contiguous()
         self.shBands = config.bands
         self.sharedIdentity = False
+        # resolution of the rendered images, lowered by the coarse levels of the stage 2 pyramid (see setRenderResolution)
+        self.renderWidth = config.maxResolution
+        self.renderHeight = config.maxResolution
+        self.renderScale = 1.0
 
     def initSceneParameters(self, n, sharedIdentity = False):
         '''
@@ -72,6 +84,16 @@ class Pipeline:
         texRes = self.morphableModel.getTextureResolution()
         self.vRoughness = 0.4 * torch.ones([nShape, texRes, texRes, 1], dtype=torch.float32, device=self.device)
 
+    def selectFrames(self, tensor, frames = None):
+        '''
+        restrict a per frame tensor to a subset of the frames
+        :param tensor: tensor [n, ...] (tensors shared by all frames, [1, ...], are returned as is)
+        :param frames: indices of the frames to keep (if None all the frames are kept)
+        '''
+        if frames is None or tensor is None or tensor.shape[0] == 1:
+            return tensor
+        return tensor[frames]
+
     def computeShape(self):
         '''
         compute shape vertices from the shape and expression coefficients
@@ -82,6 +104,16 @@ class Pipeline:
         vertices = self.morphableModel.computeShape(self.vShapeCoeff, self.vExpCoeff)
         return vertices
 
+    def computeLandmarksShape(self):
+        '''
+        compute only the landmarks vertices from the shape and expression coefficients (much cheaper than computeShape)
+        :return: tensor of 3d vertices [n, landmarksNumber, 3]
+        '''
+
+        assert(self.vShapeCoeff is not None and self.vExpCoeff is not None)
+        vertices = self.morphableModel.computeLandmarksShape(self.vShapeCoeff, self.vExpCoeff)
+        return vertices
+
     def transformVertices(self, vertices = None):
         '''
         transform vertices to camera coordinate space
@@ -99,7 +131,22 @@ class Pipeline:
         transformedVertices = self.camera.transformVertices(vertices, self.vTranslation, self.vRotation)
         return transformedVertices
 
-    def render(self, cameraVerts = None, diffuseTextures = None, specularTextures = None, roughnessTextures = None, renderAlbedo = False):
+    def setRenderResolution(self, width, height, scale = 1.0):
+        '''
+        set the resolution of the images rendered by all the renderers (redner, mitsuba and vertex based)
+        :param width: width in pixels
+        :param height: height in pixels
+        :param scale: ratio between this resolution and the input image resolution. the focals (given in input image pixels) are multiplied by it
+        so that the field of view, hence the rendered image content, does not change
+        '''
+        self.renderWidth = width
+        self.renderHeight = height
+        self.renderScale = scale
+        self.renderer.screenWidth = width
+        self.renderer.screenHeight = height
+        self.rendererMitsuba.setScreenSize(width, height)
+
+    def render(self, cameraVerts = None, diffuseTextures = None, specularTextures = None, roughnessTextures = None, renderAlbedo = False, frames = None, normals = None, envMaps = None):
         '''
         ray trace an image given camera vertices and corresponding textures
         :param cameraVerts: camera vertices tensor [n, verticesNumber, 3]
@@ -108,26 +155,33 @@ class Pipeline:
         :param roughnessTextures: roughness textures tensor [n, texRes, texRes, 1]
         :param renderAlbedo: if True render albedo else ray trace image
         :param vertexBased: if True we render by vertex instead of ray tracing
+        :param frames: if not None, indices of the frames to render (the given camera vertices and textures are already restricted to these frames)
+        :param normals: precomputed normals of the camera vertices [n, verticesNumber, 3] (computed if None)
+        :param envMaps: precomputed env maps of the rendered frames [n, h, w, 3] (computed from vShCoeffs if None)
         :return: ray traced images [n, resX, resY, 4]
         '''
         
         if cameraVerts is None :
             vertices, diffAlbedo, specAlbedo = self.morphableModel.computeShapeAlbedo(self.vShapeCoeff, self.vExpCoeff, self.vAlbedoCoeff)
-            cameraVerts = self.camera.transformVertices(vertices, self.vTranslation, self.vRotation)
+            cameraVerts = self.selectFrames(self.camera.transformVertices(vertices, self.vTranslation, self.vRotation), frames)
+            diffAlbedo = self.selectFrames(diffAlbedo, frames)
+            specAlbedo = self.selectFrames(specAlbedo, frames)
 
         #compute normals
-        normals = self.morphableModel.meshNormals.computeNormals(cameraVerts)
+        if normals is None:
+            normals = self.morphableModel.meshNormals.computeNormals(cameraVerts)
 
         if diffuseTextures is None:
-            diffuseTextures = self.morphableModel.generateTextureFromAlbedo(diffAlbedo)
+            diffuseTextures = self.morphableModel.generateTextureFromAlbedo(diffAlbedo, 'diffuseTextures')
 
         if specularTextures is None:
-            specularTextures = self.morphableModel.generateTextureFromAlbedo(specAlbedo)
+            specularTextures = self.morphableModel.generateTextureFromAlbedo(specAlbedo, 'specularTextures')
 
         if roughnessTextures is None:
             roughnessTextures  = self.vRoughness
 
-        envMaps = self.sh.toEnvMap(self.vShCoeffs)
+        if envMaps is None:
+            envMaps = self.sh.toEnvMap(self.selectFrames(self.vShCoeffs, frames))
 
         assert(envMaps.dim() == 4 and envMaps.shape[-1] == 3)
         assert (cameraVerts.dim() == 3 and cameraVerts.shape[-1] == 3)
@@ -137,34 +191,37 @@ class Pipeline:
         assert(cameraVerts.shape[0] == envMaps.shape[0])
         assert (diffuseTextures.shape[0] == specularTextures.shape[0] == roughnessTextures.shape[0])
 
-        scenes = self.renderer.buildScenes(cameraVerts, self.faces32, normals, self.uvMap, diffuseTextures, specularTextures, torch.clamp(roughnessTextures, 1e-20, 10.0), self.vFocals, envMaps)
+        scenes = self.renderer.buildScenes(cameraVerts, self.faces32, normals, self.uvMap, diffuseTextures, specularTextures, torch.clamp(roughnessTextures, 1e-20, 10.0), self.selectFrames(self.vFocals, frames) * self.renderScale, envMaps)
         if renderAlbedo:
             images = self.renderer.renderAlbedo(scenes)
         else:
             images = self.renderer.render(scenes)
                 
         return images
-    def renderVertexBased(self, cameraVerts = None, diffuseAlbedo = None, specularAlbedo = None, albedoOnly= False, lightingOnly=False ):
+    def renderVertexBased(self, cameraVerts = None, diffuseAlbedo = None, specularAlbedo = None, albedoOnly= False, lightingOnly=False, frames = None):
         '''
         render the vertices in an image given camera vertices and corresponding albedos
         :param cameraVerts: camera vertices tensor [n, verticesNumber, 3]
         :param diffuseAlbedo: diffuse textures tensor [n, texRes, texRes, 3]
         :param specularAlbedo: specular textures tensor [n, texRes, texRes, 3]
+        :param frames: if not None, indices of the frames to render (the given camera vertices and albedos are already restricted to these frames)
         :return: ray traced images [n, resX, resY, 4]
         '''
         if cameraVerts is None or diffuseAlbedo is None:
             vertices, diffuseAlbedo, specularAlbedo = self.morphableModel.computeShapeAlbedo(self.vShapeCoeff, self.vExpCoeff, self.vAlbedoCoeff)
-            cameraVerts = self.camera.transformVertices(vertices, self.vTranslation, self.vRotation)
+            cameraVerts = self.selectFrames(self.camera.transformVertices(vertices, self.vTranslation, self.vRotation), frames)
+            diffuseAlbedo = self.selectFrames(diffuseAlbedo, frames)
+            specularAlbedo = self.selectFrames(specularAlbedo, frames)
         # compute normals
         normals = self.morphableModel.meshNormals.computeNormals(cameraVerts)
         assert (cameraVerts.dim() == 3 and cameraVerts.shape[-1] == 3)
         # compute colors for vertices
-        vertexColors = self.computeVertexColor(diffuseAlbedo, specularAlbedo, normals, albedoOnly=albedoOnly, lightingOnly=lightingOnly)
+        vertexColors = self.computeVertexColor(diffuseAlbedo, specularAlbedo, normals, albedoOnly=albedoOnly, lightingOnly=lightingOnly, frames=frames)
         # compute image based on the colors
-        images = self.computeVertexImage(cameraVerts, vertexColors, normals, debug=False, interpolation=False)
+        images = self.computeVertexImage(cameraVerts, vertexColors, normals, debug=False, interpolation=False, frames=frames)
                 
         return images
-    def renderMitsuba(self, cameraVerts = None, diffuseTextures = None, specularTextures = None, roughnessTextures = None, renderAlbedo = False,):
+    def renderMitsuba(self, cameraVerts = None, diffuseTextures = None, specularTextures = None, roughnessTextures = None, renderAlbedo = False, frames = None, normals = None, envMaps = None):
         '''
         ray trace an image given camera vertices and corresponding textures
         :param cameraVerts: camera vertices tensor [n, verticesNumber, 3]
@@ -173,26 +230,33 @@ class Pipeline:
         :param roughnessTextures: roughness textures tensor [n, texRes, texRes, 1]
         :param renderAlbedo: if True render albedo else ray trace image
         :param vertexBased: if True we render by vertex instead of ray tracing
+        :param frames: if not None, indices of the frames to render (the given camera vertices and textures are already restricted to these frames)
+        :param normals: precomputed normals of the camera vertices [n, verticesNumber, 3] (computed if None)
+        :param envMaps: precomputed env maps of the rendered frames [n, h, w, 3] (computed from vShCoeffs if None)
         :return: ray traced images [n, resX, resY, 4]
         '''
         
         if cameraVerts is None :
             vertices, diffAlbedo, specAlbedo = self.morphableModel.computeShapeAlbedo(self.vShapeCoeff, self.vExpCoeff, self.vAlbedoCoeff)
-            cameraVerts = self.camera.transformVertices(vertices, self.vTranslation, self.vRotation)
+            cameraVerts = self.selectFrames(self.camera.transformVertices(vertices, self.vTranslation, self.vRotation), frames)
+            diffAlbedo = self.selectFrames(diffAlbedo, frames)
+            specAlbedo = self.selectFrames(specAlbedo, frames)
 
         #compute normals
-        normals = self.morphableModel.meshNormals.computeNormals(cameraVerts)
+        if normals is None:
+            normals = self.morphableModel.meshNormals.computeNormals(cameraVerts)
 
         if diffuseTextures is None:
-            diffuseTextures = self.morphableModel.generateTextureFromAlbedo(diffAlbedo)
+            diffuseTextures = self.morphableModel.generateTextureFromAlbedo(diffAlbedo, 'diffuseTextures')
 
         if specularTextures is None:
-            specularTextures = self.morphableModel.generateTextureFromAlbedo(specAlbedo)
+            specularTextures = self.morphableModel.generateTextureFromAlbedo(specAlbedo, 'specularTextures')
 
         if roughnessTextures is None:
             roughnessTextures  = self.vRoughness
 
-        envMaps = self.sh.toEnvMap(self.vShCoeffs)
+        if envMaps is None:
+            envMaps = self.sh.toEnvMap(self.selectFrames(self.vShCoeffs, frames))
 
         assert(envMaps.dim() == 4 and envMaps.shape[-1] == 3)
         assert (cameraVerts.dim() == 3 and cameraVerts.shape[-1] == 3)
@@ -203,7 +267,7 @@ class Pipeline:
         assert (diffuseTextures.shape[0] == specularTextures.shape[0] == roughnessTextures.shape[0])
 
         # TODO mitsuba should generate an alpha channel to do loss only on geometry part of picture
-        img = self.rendererMitsuba.render(cameraVerts, self.faces32, normals, self.uvMap, diffuseTextures, specularTextures, torch.clamp(roughnessTextures, 1e-20, 10.0),self.vFocals[0], envMaps)
+        images = self.rendererMitsuba.render(cameraVerts, self.faces32, normals, self.uvMap, diffuseTextures, specularTextures, torch.clamp(roughnessTextures, 1e-20, 10.0), self.selectFrames(self.vFocals, frames) * self.renderScale, envMaps)
         # #cut link to backward
         # img = img.detach().cpu().numpy()
         # img = torch.tensor(img).to(self.device)
@@ -213,17 +277,19 @@ class Pipeline:
         #     return rgba_img, depth_img 
         # else:
         #     return rgba_img
-        return img.unsqueeze(0) # add batch dimension
+        return images
         
    
-    def landmarkLoss(self, cameraVertices, landmarks, focals, cameraCenters,  debugDir = None):
+    def landmarkLoss(self, cameraVertices, landmarks, focals, cameraCenters,  debugDir = None, sparse = False, perFrame = False):
         '''
         calculate scalar loss between vertices in camera space and 2d landmarks pixels
-        :param cameraVertices: 3d vertices [n, nVertices, 3]
+        :param cameraVertices: 3d vertices [n, nVertices, 3] (or [n, landmarksNumber, 3] if sparse is True)
         :param landmarks: 2d corresponding pixels [n, nVertices, 2]
         :param landmarks: camera focals [n]
         :param cameraCenters: camera centers [n, 2
         :param debugDir: if not none save landmarks and vertices to an image file
+        :param sparse: if True, cameraVertices already contains only the landmarks vertices (see computeLandmarksShape)
+        :param perFrame: if True return the loss of each frame [n] instead of their mean
         :return: scalar loss (float)
         '''
         assert (cameraVertices.dim() == 3 and cameraVertices.shape[-1] == 3)
@@ -232,12 +298,34 @@ class Pipeline:
         assert (landmarks.dim() == 3 and landmarks.shape[-1] == 2)
         assert cameraVertices.shape[0] == landmarks.shape[0] == focals.shape[0] == cameraCenters.shape[0]
 
-        headPoints = cameraVertices[:, self.morphableModel.landmarksAssociation]
+        headPoints = cameraVertices if sparse else cameraVertices[:, self.morphableModel.landmarksAssociation]
         assert (landmarks.shape[-2] == headPoints.shape[-2])
 
-        projPoints = focals.view(-1, 1, 1) * headPoints[..., :2] / headPoints[..., 2:]
-        projPoints += cameraCenters.unsqueeze(1)
-        loss = torch.norm(projPoints - landmarks, 2, dim=-1).pow(2).mean()
+        projPoints = self.camera.projectVertices(headPoints, focals, cameraCenters)
+        return self.landmarkPixelsLoss(projPoints, landmarks, debugDir, perFrame)
+
+    def projectLandmarks(self, cameraCenters):
+        '''
+        project the landmarks vertices of the current shape, expression and pose to pixels.
+        only the landmarks rows of the basis are evaluated and the rigid transform and projection are done in one pass
+        :param cameraCenters: camera centers [n, 2]
+        :return: landmarks pixels [n, landmarksNumber, 2]
+        '''
+        vertices = self.computeLandmarksShape()
+        return self.camera.transformAndProject(vertices, self.vTranslation, self.vRotation, self.vFocals, cameraCenters)
+
+    def landmarkPixelsLoss(self, projPoints, landmarks, debugDir = None, perFrame = False):
+        '''
+        calculate scalar loss between projected landmarks vertices and 2d landmarks pixels
+        :param projPoints: projected landmarks vertices [n, landmarksNumber, 2]
+        :param landmarks: 2d corresponding pixels [n, landmarksNumber, 2]
+        :param debugDir: if not none save landmarks and vertices to an image file
+        :param perFrame: if True return the loss of each frame [n] instead of their mean
+        :return: scalar loss (float)
+        '''
+        assert (projPoints.shape == landmarks.shape)
+        loss = torch.norm(projPoints - landmarks, 2, dim=-1).pow(2)
+        loss = loss.mean(-1) if perFrame else loss.mean()
         if debugDir:
             for i in range(projPoints.shape[0]):
                 image = saveLandmarksVerticesProjections(self.inputImage.tensor[i], projPoints[i], self.landmarks[i])
@@ -246,7 +334,7 @@ class Pipeline:
         return loss
     
     # Generate colors for each vertices
-    def computeVertexColor(self, diffAlbedo, specAlbedo, normals, roughnessTexture = None,  gamma = None, albedoOnly=False, lightingOnly=False):
+    def computeVertexColor(self, diffAlbedo, specAlbedo, normals, roughnessTexture = None,  gamma = None, albedoOnly=False, lightingOnly=False, frames = None):
         """
         Return:
             face_color       -- torch.tensor, size (B, N, 3), range (0, 1.)
@@ -260,7 +348,7 @@ class Pipeline:
             return diffAlbedo
         gammaInit = 2.2
         # vShCoeffs is of shape [1, 81, 3]
-        sh = self.vShCoeffs # order 8
+        sh = self.selectFrames(self.vShCoeffs, frames) # order 8
         Y = self.sh.preComputeSHBasisFunction(normals,sh_order=8)
         r = Y @ sh[..., :1]
         g = Y @ sh[..., 1:2]
@@ -276,49 +364,35 @@ class Pipeline:
 
         return face_color
     # predict face and mask
-    def computeVertexImage(self, cameraVertices, verticesColor, normals, debug=False, interpolation=False) : 
+    def computeVertexImage(self, cameraVertices, verticesColor, normals, debug=False, interpolation=False, frames = None) : 
         #since we already have the cameraVertices
-        width = self.config.maxResolution
-        height = self.config.maxResolution
-        fov = torch.tensor([360.0 * torch.atan(width / (2.0 * self.vFocals)) / torch.pi]) # from renderer.py
-        far = 100
-        near = 0.1
-        
-        # find projectionMatrix based from camera : camera space -> clip space
-        projMatrix = self.perspectiveProjMatrix(fov,width/height, near, far).to(self.device)
-        # Apply the projection matrix to vertices
-        ones = torch.ones(cameraVertices.shape[0], cameraVertices.shape[1], 1).to(self.device)
-        homogeneous_vertices = torch.cat((cameraVertices, ones), -1)
-        vertices_in_clip_space = (projMatrix @ homogeneous_vertices.transpose(-1, -2)).transpose(-1, -2)
-
-        # Normalize the vertices (divide by W) and put them in cartesian coordinates
-        vertices_in_clip_space = vertices_in_clip_space[..., :3] / vertices_in_clip_space[..., 3:]
+        width = self.renderWidth
+        height = self.renderHeight
+        # project straight to screen space: with the fov derived from the focal (as in renderer.py) the perspective matrix
+        # followed by the viewport transform reduces to focal * xy / z + screen center
+        centers = torch.tensor([[width / 2.0, height / 2.0]], dtype=cameraVertices.dtype, device=cameraVertices.device).expand(cameraVertices.shape[0], -1)
+        screen = self.camera.projectVertices(cameraVertices, self.selectFrames(self.vFocals, frames).detach() * self.renderScale, centers)
         # Create a mask for the vertices where the normal is pointing towards -z
         normal_mask = normals[..., 2] <= 0
-        # ignore vertices both the x and y coordinates are within the range -1 to 1 and the normal is not pointing towards -z.
-        mask = (torch.abs(vertices_in_clip_space[:, :, :2]) <= 1.0 ).all(dim=-1) & normal_mask 
-        vertices_in_clip_space = vertices_in_clip_space[mask]
-
-        # Convert vertices from clip space to screen space
-        vertices_in_screen_space = vertices_in_clip_space.clone()
-        vertices_in_screen_space[..., 0] = (vertices_in_clip_space[..., 0] + 1) / 2 * width
-        vertices_in_screen_space[..., 1] = (vertices_in_clip_space[..., 1] + 1) / 2 * height
-
-        # Vertices color manipulation
-        verticesColor = verticesColor.squeeze(0)
-        mask = mask.squeeze(0)
-        colors_in_screen_space = verticesColor[mask]
-
-        image_data = torch.zeros((1, height, width, 4), dtype=torch.float32, device=self.device)  # add batch dimension and alpha dimension(all 0)
-        alpha_channel = torch.zeros((1, width, height, 1)).to(self.device)
+        # ignore vertices outside of the screen and the ones whose normal is not pointing towards -z.
+        mask = ((screen[..., 0] >= 0) & (screen[..., 0] <= width) & (screen[..., 1] >= 0) & (screen[..., 1] <= height)) & normal_mask
+        vertices_in_screen_space = screen[mask]
+
+        # Vertices color manipulation (all the frames at once, b_indices is the frame of each visible vertex)
+        n = cameraVertices.shape[0]
+        b_indices = torch.arange(n, device=mask.device)[:, None].expand(-1, mask.shape[1])[mask]
+        colors_in_screen_space = verticesColor.expand(n, -1, -1)[mask]
+
+        image_data = torch.zeros((n, height, width, 4), dtype=torch.float32, device=self.device)  # batch dimension and alpha dimension(all 0)
+        alpha_channel = torch.zeros((n, height, width, 1)).to(self.device)
         # Initialize a counter for each pixel
-        counter = torch.zeros((1, height, width, 3), dtype=torch.float32, device=self.device)
+        counter = torch.zeros((n, height, width, 3), dtype=torch.float32, device=self.device)
         if interpolation:
             vertices_in_screen_space = vertices_in_screen_space.long()  # Convert to long for indexing
-            vertices_in_screen_space.clamp_(0, max=self.config.maxResolution-1)  # Clamp to valid pixel range TODO change for bigger width + height values
-            y_indices, x_indices = vertices_in_screen_space[:, 1], vertices_in_screen_space[:, 0] # create two tensors for values
+            x_indices = vertices_in_screen_space[:, 0].clamp(0, width - 1) # clamp to valid pixel range
+            y_indices = vertices_in_screen_space[:, 1].clamp(0, height - 1)
             # Perform scatter operation + add alpha values
-            image_data[0, y_indices, x_indices, :3] += colors_in_screen_space # add colors to pixels
+            image_data[b_indices, y_indices, x_indices, :3] += colors_in_screen_space # add colors to pixels
                 # ----------
             # Define the interpolation factor
             interpolation_factor = 32
@@ -338,17 +412,17 @@ class Pipeline:
         else:
             # Convert vertices and colors to an image without interpolation
             vertices_in_screen_space = vertices_in_screen_space.long()  # Convert to long for indexing
-            vertices_in_screen_space.clamp_(0, max=self.config.maxResolution-1)  # Clamp to valid pixel range TODO change for bigger width + height values
-            y_indices, x_indices = vertices_in_screen_space[:, 1], vertices_in_screen_space[:, 0] # create two tensors for values
+            x_indices = vertices_in_screen_space[:, 0].clamp(0, width - 1) # clamp to valid pixel range
+            y_indices = vertices_in_screen_space[:, 1].clamp(0, height - 1)
             # Perform scatter operation + add alpha values
-            counter[0, y_indices, x_indices] += 1 # count all the pixels that have a vertex on them
-            image_data[0, y_indices, x_indices, :3] += colors_in_screen_space # add colors to pixels
+            counter[b_indices, y_indices, x_indices] += 1 # count all the pixels that have a vertex on them
+            image_data[b_indices, y_indices, x_indices, :3] += colors_in_screen_space # add colors to pixels
             
         # Update the alpha channel of those pixels to 1 where we have updated the color
-        alpha_mask = counter[0, y_indices, x_indices].sum(dim=1) > 0 # create a mask for each vertex where there is at least one pixel splat there
-        alpha_channel[0, y_indices[alpha_mask], x_indices[alpha_mask]] = 1.0 # put a 1.0 to all the pixels that are in our mask
+        alpha_mask = counter[b_indices, y_indices, x_indices].sum(dim=1) > 0 # create a mask for each vertex where there is at least one pixel splat there
+        alpha_channel[b_indices[alpha_mask], y_indices[alpha_mask], x_indices[alpha_mask]] = 1.0 # put a 1.0 to all the pixels that are in our mask
         # Average the color and clamp at 1
-        image_data[0, :, :, :3] /= counter[0].clamp(min=1) # average tje color and clamp to one so that we dont divide by one
+        image_data[..., :3] /= counter.clamp(min=1) # average tje color and clamp to one so that we dont divide by one
         image_data = image_data.clamp(0, 1) # clamp values of color and alpha to be between 0 and 1
 
         # Add alpha channel to the image_data
@@ -2,6 +2,7 @@ import numpy as np
 import torch
 import math
 import cv2
+from concurrent.futures import ThreadPoolExecutor
 
 def isRotationMatrix(R):
     """
@@ -50,7 +51,7 @@ def rodrigues2Euler(rotation_vector):
     return np.array([roll, pitch, yaw])
 
 
-def estimateCameraPosition(focalLength, image_center, landmarks, vertices, rotAngles, translation):
+def estimateCameraPosition(focalLength, image_center, landmarks, vertices, rotAngles, translation, solver = 'batched', workers = 0, iterations = 10):
     '''
     estimate the camera position (rotation and translation) using perspective n points pnp
     :param focalLength: tensor representing the camera focal length of shape [n]
@@ -59,6 +60,9 @@ def estimateCameraPosition(focalLength, image_center, landmarks, vertices, rotAn
     :param vertices: tensor representing the 3d coordinate position of the landmarks  [n, verticesNumber, 3]
     :param rotAngles: the initial rotation angles [n, 3]
     :param translation: the initial translation angles [n, 3]
+    :param solver: 'batched' (all frames at once in torch, see solvePnPBatched) or 'opencv' (cv2.solvePnP frame by frame)
+    :param workers: number of threads used by the opencv solver (0 or 1: serial)
+    :param iterations: number of gauss-newton iterations of the batched solver
     :return: estimated rotation [n, 3] , estimated translations  [n, 3]
     '''
     assert (focalLength.dim() == 1 and
@@ -69,22 +73,164 @@ def estimateCameraPosition(focalLength, image_center, landmarks, vertices, rotAn
             rotAngles.dim() == 2 and rotAngles.shape[-1] == 3 and
             translation.dim() == 2 and translation.shape[-1] == 3)
     assert (focalLength.shape[0] == image_center.shape[0] == landmarks.shape[0] == vertices.shape[0] == rotAngles.shape[0] == translation.shape[0])
-    rots = []
-    transs = []
-    for i in range(focalLength.shape[0]):
-        rot, trans = solvePnP(focalLength[i].item(),
-                              image_center[i].detach().cpu().numpy(),
-                              vertices[i],
-                              landmarks[i],
-                              rotAngles[i],
-                              translation[i])
-        rots.append(rot)
-        transs.append(trans)
-        
-    # rots = np.array(rots)
-    # transs = np.array(trans)
+    assert (solver in ['batched', 'opencv'])
+
+    if solver == 'batched':
+        with torch.no_grad():
+            rots, transs, valid = solvePnPBatched(focalLength, image_center, vertices, landmarks, iterations)
+        if valid.all():
+            return rots, transs
+        # degenerate frames are solved again with opencv from the initial guess
+        invalid = torch.nonzero(~valid).view(-1).tolist()
+        print('[WARN] batched pnp failed for', len(invalid), 'frame(s), falling back to opencv')
+        rotsCv, transsCv = estimateCameraPositionOpenCV(focalLength[invalid], image_center[invalid], landmarks[invalid], vertices[invalid],
+                                                        rotAngles[invalid], translation[invalid], workers)
+        rots[invalid] = rotsCv
+        transs[invalid] = transsCv
+        return rots, transs
+
+    return estimateCameraPositionOpenCV(focalLength, image_center, landmarks, vertices, rotAngles, translation, workers)
+
+def estimateCameraPositionOpenCV(focalLength, image_center, landmarks, vertices, rotAngles, translation, workers = 0):
+    '''
+    estimate the camera position frame by frame with cv2.solvePnP (see estimateCameraPosition for the parameters)
+    :param workers: if > 1 the frames are solved by a pool of threads (opencv releases the gil)
+    :return: estimated rotation [n, 3] , estimated translations  [n, 3]
+    '''
+    focals = focalLength.detach().cpu().numpy()
+    centers = image_center.detach().cpu().numpy()
+    verticesNp = vertices.detach().cpu().numpy()
+    landmarksNp = landmarks.detach().cpu().numpy()
+    rotAnglesNp = rotAngles.detach().cpu().numpy()
+    translationNp = translation.detach().cpu().numpy()
+
+    def solveFrame(i):
+        return solvePnP(float(focals[i]), centers[i], verticesNp[i], landmarksNp[i], rotAnglesNp[i], translationNp[i])
+
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers = workers) as pool:
+            results = list(pool.map(solveFrame, range(focals.shape[0])))
+    else:
+        results = [solveFrame(i) for i in range(focals.shape[0])]
+
+    rots = np.array([r[0] for r in results])
+    transs = np.array([r[1] for r in results])
     return torch.tensor(rots, device=vertices.device, dtype=torch.float32), torch.tensor(transs, device=vertices.device, dtype=torch.float32)
 
+def skew(v):
+    '''
+    cross product matrices
+    :param v: [..., 3]
+    :return: [..., 3, 3]
+    '''
+    zero = torch.zeros_like(v[..., 0])
+    return torch.stack([zero, -v[..., 2], v[..., 1],
+                        v[..., 2], zero, -v[..., 0],
+                        -v[..., 1], v[..., 0], zero], -1).view(v.shape[:-1] + (3, 3))
+
+def rotationExp(omega):
+    '''
+    batched rodrigues formula (axis angle to rotation matrix)
+    :param omega: [n, 3]
+    :return: [n, 3, 3]
+    '''
+    theta = torch.linalg.norm(omega, dim=-1)[:, None, None]
+    K = skew(omega)
+    small = theta < 1e-8
+    safeTheta = torch.where(small, torch.ones_like(theta), theta)
+    a = torch.where(small, torch.ones_like(theta), torch.sin(safeTheta) / safeTheta)
+    b = torch.where(small, 0.5 * torch.ones_like(theta), (1.0 - torch.cos(safeTheta)) / (safeTheta * safeTheta))
+    eye = torch.eye(3, dtype=omega.dtype, device=omega.device)
+    return eye + a * K + b * (K @ K)
+
+def nearestRotation(M):
+    '''
+    closest rotation matrices (frobenius norm) to the given matrices
+    :param M: [n, 3, 3]
+    :return: rotations [n, 3, 3], mean singular values [n]
+    '''
+    U, S, Vh = torch.linalg.svd(M)
+    d = torch.sign(torch.linalg.det(U @ Vh))
+    D = torch.ones_like(S)
+    D[:, 2] = d
+    return U @ (D[..., None] * Vh), S.mean(-1)
+
+def rotationToEuler(R):
+    '''
+    batched version of rodrigues2Euler on rotation matrices (R = rotz @ roty @ rotx)
+    :param R: [n, 3, 3]
+    :return: euler angles [n, 3]
+    '''
+    roll = torch.atan2(R[:, 2, 1], R[:, 2, 2])
+    pitch = torch.atan2(-R[:, 2, 0], torch.sqrt(R[:, 0, 0] * R[:, 0, 0] + R[:, 1, 0] * R[:, 1, 0]))
+    yaw = torch.atan2(R[:, 1, 0], R[:, 0, 0])
+    return torch.stack([roll, pitch, yaw], -1)
+
+def solvePnPBatched(focalLength, imageCenter, vertices, pixels, iterations = 10):
+    '''
+    finds the pose of all frames at once from 3D vertices <-> 2D pixels correspondences.
+    a dlt on normalized coordinates gives the initial pose (one batched svd), which is then refined by minimizing the
+    reprojection error with a few batched gauss-newton iterations (rotation updated on the left with the exponential map)
+    :param focalLength: [n]
+    :param imageCenter: [n, 2]
+    :param vertices: [n, verticesNumber, 3]
+    :param pixels: [n, verticesNumber, 2]
+    :param iterations: number of gauss-newton iterations
+    :return: euler angles [n, 3], translations [n, 3], valid frames mask [n] (all float32 on the vertices device)
+    '''
+    n, N = vertices.shape[0], vertices.shape[1]
+    assert (N >= 6)
+    dtype = torch.float64
+    X = vertices.to(dtype)
+    f = focalLength.to(dtype).view(n, 1, 1)
+    c = imageCenter.to(dtype).view(n, 1, 2)
+    uv = (pixels.to(dtype) - c) / f
+
+    # dlt on centered and scaled vertices
+    centroid = X.mean(1, keepdim=True)
+    scale = (X - centroid).norm(dim=-1).mean(-1).clamp(min=1e-12).view(n, 1, 1)
+    Xn = (X - centroid) / scale
+    Xh = torch.cat([Xn, torch.ones_like(Xn[..., :1])], -1)
+    zeros = torch.zeros_like(Xh)
+    A = torch.cat([torch.cat([Xh, zeros, -uv[..., :1] * Xh], -1),
+                   torch.cat([zeros, Xh, -uv[..., 1:] * Xh], -1)], 1)
+    P = torch.linalg.svd(A).Vh[:, -1].view(n, 3, 4)
+
+    # the projection matrix is defined up to a scale: pick the sign that puts the vertices in front of the camera
+    depth = (Xh @ P[:, 2, :, None]).mean((1, 2))
+    P = P * (1.0 - 2.0 * (depth < 0).to(dtype)).view(n, 1, 1)
+    R, k = nearestRotation(P[:, :, :3])
+    t = (scale / k.view(n, 1, 1)) * P[:, None, :, 3] - (R @ centroid.transpose(1, 2)).transpose(1, 2)
+    t = t.view(n, 3)
+
+    eye = torch.eye(6, dtype=dtype, device=X.device)
+    for i in range(iterations):
+        RX = X @ R.transpose(1, 2)
+        Pc = RX + t[:, None]
+        z = Pc[..., 2:]
+        proj = Pc[..., :2] / z
+        residuals = (proj - uv).reshape(n, 2 * N)
+
+        # d proj / d Pc [n, N, 2, 3], d Pc / d (omega, t) = [-skew(RX), I]
+        dProj = torch.zeros(n, N, 2, 3, dtype=dtype, device=X.device)
+        dProj[..., 0, 0] = 1.0 / z[..., 0]
+        dProj[..., 1, 1] = 1.0 / z[..., 0]
+        dProj[..., :, 2] = -proj / z
+        J = torch.cat([-dProj @ skew(RX), dProj], -1).reshape(n, 2 * N, 6)
+
+        JtJ = J.transpose(1, 2) @ J
+        Jtr = J.transpose(1, 2) @ residuals[..., None]
+        damping = 1e-9 * JtJ.diagonal(dim1=1, dim2=2).sum(-1).view(n, 1, 1)
+        delta = torch.linalg.solve_ex(JtJ + damping * eye, -Jtr)[0][..., 0]
+        R = rotationExp(delta[:, :3]) @ R
+        t = t + delta[:, 3:]
+
+    rotAngles = rotationToEuler(R)
+    rotAngles[:, 0] = torch.where(rotAngles[:, 0] < 0., rotAngles[:, 0] + 2. * math.pi, rotAngles[:, 0])
+
+    Pc = X @ R.transpose(1, 2) + t[:, None]
+    valid = torch.isfinite(rotAngles).all(-1) & torch.isfinite(t).all(-1) & (Pc[..., 2] > 0).all(-1)
+    return rotAngles.to(torch.float32), t.to(torch.float32), valid
 
 def solvePnP(focalLength, imageCenter, vertices, pixels, rotAngles, translation):
     """
@@ -92,10 +238,10 @@ def solvePnP(focalLength, imageCenter, vertices, pixels, rotAngles, translation)
     Inputs:
      * focalLength: camera focal length
      * imageCenter: center [x, y] of the image
-     * vertices: float tensor [n, 3], of vertices
-     * pixels: float tensor [n, 2] of corresponding pixels
-     * rotAngles: initial euler angles
-     * translation: initial translation vector
+     * vertices: float array [n, 3], of vertices
+     * pixels: float array [n, 2] of corresponding pixels
+     * rotAngles: initial euler angles (numpy array)
+     * translation: initial translation vector (numpy array)
     """
 
     cameraMatrix = np.array(
@@ -104,12 +250,12 @@ def solvePnP(focalLength, imageCenter, vertices, pixels, rotAngles, translation)
          [0, 0, 1]], dtype="double"
     )
 
-    success, rotVec, transVec = cv2.solvePnP(vertices.clone().detach().cpu().numpy(),
-                                             pixels[:, None].detach().cpu().numpy(),
+    success, rotVec, transVec = cv2.solvePnP(np.ascontiguousarray(vertices, dtype=np.float64),
+                                             np.ascontiguousarray(pixels[:, None], dtype=np.float64),
                                              cameraMatrix,
                                              np.zeros((4, 1)),
-                                             eulerToRodrigues(rotAngles.detach().cpu().numpy()),
-                                             translation.detach().cpu().numpy(),
+                                             eulerToRodrigues(rotAngles),
+                                             np.array(translation, dtype=np.float64),
                                              True,
                                              flags=cv2.SOLVEPNP_ITERATIVE)
     assert success, "failed to estimate the pose using pNp"
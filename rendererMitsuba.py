@@ -3,23 +3,173 @@ import math
 import mitsuba as mi
 import drjit as dr
 import numpy as np
+from drjitbridge import mitsubaVariant, torchToDrjit, drjitToTorch
 from mitsuba.scalar_rgb import Transform4f as T
 
+class SceneState:
+    '''
+    a mitsuba scene with its (reused) parameters. the topology (faces and uvs) does not change between iterations:
+    it is uploaded once and then left untouched, and the field of view is only updated when it changes.
+    the geometry, textures and env map are only set when they changed since the previous render (see changedInputs)
+    and params.update() is skipped when nothing changed (see MitsubaRender)
+    '''
+
+    def __init__(self, scene):
+        self.scene = scene
+        self.params = mi.traverse(scene)
+        self.topology = None
+        self.fov = None
+        self.inputs = {} # tensors set by the previous render (only the ones not tracked by autograd)
+        self.dirty = False # True if a parameter was set since the last params.update()
+        self.gradImage = None # image gradient of the last render (debug only, see RendererMitsuba.debugGradients)
+
+    def setTopology(self, indices, uv):
+        '''
+        upload the faces [facesNumber, 3] and uvs [verticesNumber, 2] if they are not the ones already uploaded
+        '''
+        key = (indices.data_ptr(), tuple(indices.shape), uv.data_ptr(), tuple(uv.shape))
+        if key == self.topology:
+            return
+        self.params["mesh.faces"] = mi.UInt32(torchToDrjit(indices.reshape(-1).to(torch.int32), mi.Int32))
+        self.params["mesh.vertex_texcoords"] = torchToDrjit(uv.reshape(-1), mi.Float)
+        self.topology = key
+        self.dirty = True
+
+    def setFov(self, fov):
+        if fov != self.fov:
+            self.params["sensor.x_fov"] = fov
+            self.fov = fov
+            self.dirty = True
+
+    def changedInputs(self, *tensors):
+        '''
+        return the tensors to set on the scene for this render: a tensor that is not tracked by autograd and is the same data
+        (same storage, shape, strides and version) as the one set by the previous render is replaced by None and its parameter is left untouched.
+        tensors tracked by autograd are always set, MitsubaRender only propagates the gradients of the tensors given to the current render
+        :return: list of tensors or None, in the same order
+        '''
+        changed = []
+        for i, tensor in enumerate(tensors):
+            previous = self.inputs.get(i) # kept alive so that its storage can not be reused by another tensor
+            recording = torch.is_grad_enabled() and tensor.requires_grad
+            unchanged = not recording and previous is not None and previous.data_ptr() == tensor.data_ptr() and previous._version == tensor._version \
+                        and previous.shape == tensor.shape and previous.stride() == tensor.stride() and previous.dtype == tensor.dtype
+            changed.append(None if unchanged else tensor)
+            self.inputs[i] = None if recording else tensor
+        return changed
+
+class MitsubaRender(torch.autograd.Function):
+    '''
+    render a batch of frames (one scene per frame) as a single autograd node.
+    each distinct input tensor is converted to drjit once (through dlpack, see drjitbridge.py) and the same drjit tensor is set on every scene
+    that uses it (shared identity textures), so one backward traversal accumulates the gradients of all the frames into it
+    '''
+
+    @staticmethod
+    def forward(ctx, states, frameInputs, spp, seed, keepGradient, *tensors):
+        '''
+        :param states: SceneState of each frame (topology and fov already set)
+        :param frameInputs: for each frame, the indices in tensors of its vertices, normals, diffuse texture, roughness texture and env map
+        (-1: unchanged since the previous render of this scene and left as is, see SceneState.changedInputs)
+        :param spp: samples per pixel
+        :param seed: seed of the first frame (each frame uses seed + 2 * i and seed + 2 * i + 1 for the gradients)
+        :param keepGradient: if True the image gradient of each render is kept in SceneState.gradImage (debug)
+        :param tensors: the distinct tensors set on the scenes
+        :return: rgba images [n, screenHeight, screenWidth, 4]
+        '''
+        inputs = [torchToDrjit(t) for t in tensors]
+        for x, needsGrad in zip(inputs, ctx.needs_input_grad[5:]):
+            if needsGrad:
+                dr.enable_grad(x)
+
+        images = []
+        for i, (state, indices) in enumerate(zip(states, frameInputs)):
+            vertices, normal, diffuseTexture, roughnessTexture, envMap = [inputs[j] if j >= 0 else None for j in indices]
+            params = state.params
+            # use the drjit tensors (and their flat storage) as they are
+            if vertices is not None:
+                params["mesh.vertex_positions"] = vertices.array
+            if normal is not None:
+                params["mesh.vertex_normals"] = normal.array
+            # update BSDF
+            # https://mitsuba.readthedocs.io/en/stable/src/generated/plugins_bsdfs.html#smooth-diffuse-material-diffuse
+            if diffuseTexture is not None:
+                params["mesh.bsdf.base_color.data"] = diffuseTexture
+            if roughnessTexture is not None:
+                params["mesh.bsdf.roughness.data"] = roughnessTexture
+            #update envMaps
+            if envMap is not None:
+                params["light.data"] = envMap
+
+            if state.dirty or any(j >= 0 for j in indices):
+                params.update()
+                state.dirty = False
+            img = mi.render(state.scene, params, spp=spp, seed=seed + 2 * i, seed_grad=seed + 2 * i + 1)
+            state.gradImage = dr.grad(img) if keepGradient else None
+            images.append(img)
+
+        ctx.inputs = inputs
+        ctx.images = images
+        ctx.shapes = [t.shape for t in tensors]
+        return torch.stack([drjitToTorch(img) for img in images])
+
+    @staticmethod
+    @torch.autograd.function.once_differentiable
+    def backward(ctx, gradImages):
+        images, inputs = ctx.images, ctx.inputs
+        del ctx.images, ctx.inputs
+        for i, img in enumerate(images):
+            dr.set_grad(img, torchToDrjit(gradImages[i]))
+        dr.enqueue(dr.ADMode.Backward, *images)
+        dr.traverse(mi.Float, dr.ADMode.Backward)
+        grads = [drjitToTorch(dr.grad(x)).reshape(shape) if needsGrad else None
+                 for x, shape, needsGrad in zip(inputs, ctx.shapes, ctx.needs_input_grad[5:])]
+        return (None, None, None, None, None) + tuple(grads)
+
 class RendererMitsuba:
 
-    def __init__(self, samples, bounces, device, screenWidth, screenHeight):
+    def __init__(self, samples, bounces, device, screenWidth, screenHeight, threads = 0):
+        '''
+        :param device: torch device, the mitsuba variant follows it (cuda_ad_rgb on cuda, llvm_ad_rgb on cpu)
+        :param threads: llvm variant only, number of threads used by drjit (0: all the cores)
+        '''
         self.samples = samples
         self.bounces = bounces
         self.device = torch.device(device)
         self.counter = 0
         self.seed_inc = 0
+        self.debugGradients = False # if True the gradient of each rendered image is kept (see SceneState.gradImage)
         self.screenWidth = screenWidth
         self.screenHeight = screenHeight
-        mi.set_variant('cuda_ad_rgb')
+        mi.set_variant(mitsubaVariant(self.device))
+        if self.device.type == 'cuda':
+            dr.set_device(0 if self.device.index is None else self.device.index)
+        elif threads > 0:
+            dr.set_thread_count(threads)
         mi.LogLevel(1)
-        dr.set_device(0)
-        self.scene = self.buildInitialScene() # init my scene
-        
+        # one scene per frame (same structure, so the jit kernels are shared), for each screen size
+        self.scenes = {}
+        self.scene = self.getScene(0).scene # init my scene
+
+    def setScreenSize(self, screenWidth, screenHeight):
+        '''
+        change the resolution of the rendered images (the scenes of each resolution are built once and kept)
+        '''
+        if (screenWidth, screenHeight) == (self.screenWidth, self.screenHeight):
+            return
+        self.screenWidth = screenWidth
+        self.screenHeight = screenHeight
+        self.scene = self.getScene(0).scene
+
+    def getScene(self, frame):
+        '''
+        return the scene (SceneState) used to render a frame at the current screen size. each frame needs its own scene: the gradients
+        of a render are evaluated on the scene state at backward time, so scenes can not be shared between the frames of a batch
+        '''
+        scenes = self.scenes.setdefault((self.screenWidth, self.screenHeight), [])
+        while len(scenes) <= frame:
+            scenes.append(SceneState(self.buildInitialScene()))
+        return scenes[frame]
 
     def buildInitialScene(self):
         # Create scene
@@ -88,91 +238,52 @@ class RendererMitsuba:
     
     
     def render(self, vertices, indices, normal, uv, diffuseTexture, specularTexture, roughnessTexture, focal, envMap):
-        """take inputs and give it to wrapped function for rendering
+        """render a batch of frames, each frame with its own scene (see getScene), as a single autograd node (see MitsubaRender)
 
         Args:
-            vertices (_type_): _description_
-            indices (_type_): _description_
-            normal (_type_): _description_
-            uv (_type_): _description_
-            diffuseTexture (_type_): _description_
-            specularTexture (_type_): _description_
-            roughnessTexture (_type_): _description_
-            focal (_type_): _description_
-            envMap (_type_): _description_
+            vertices (tensor): camera vertices [n, verticesNumber, 3]
+            indices (tensor): faces [facesNumber, 3]
+            normal (tensor): vertices normals [n, verticesNumber, 3]
+            uv (tensor): uv map [verticesNumber, 2]
+            diffuseTexture (tensor): [n or 1, texRes, texRes, 3] (a single texture is shared by all the frames)
+            specularTexture (tensor): [n or 1, texRes, texRes, 3] (unused, the principled bsdf does not support specular textures)
+            roughnessTexture (tensor): [n or 1, texRes, texRes, 1]
+            focal (tensor): focals [n]
+            envMap (tensor): env maps [n, h, w, 3]
 
         Returns:
-            _type_: _description_
+            tensor: rgba images [n, screenHeight, screenWidth, 4]
         """
+        n = vertices.shape[0]
+        assert(focal.dim() == 1 and focal.shape[0] == n and normal.shape[0] == n and envMap.shape[0] == n)
         self.counter += 1
-        self.fov =  torch.tensor([360.0 * torch.atan(self.screenWidth / (2.0 * focal)) / torch.pi]) # from renderer.py
-        
-        img, grad_img =  RendererMitsuba.render_torch_djit(self.scene, vertices.squeeze(0), indices.to(torch.float32), normal.squeeze(0), uv, diffuseTexture.squeeze(0), specularTexture.squeeze(0), roughnessTexture.squeeze(0), self.fov.item(), envMap.squeeze(0), seed=self.seed_inc) # returns a pytorch
-        self.seed_inc += 2 # Make sure to use different seeds
-        
-        return img
-        # return mi.render(scene, scene_params, spp=256, seed=1, seed_grad=2) # return TensorXf
-    
-    # STANDALONE because of wrap_ad
-    @dr.wrap_ad(source='torch', target='drjit')
-    def render_torch_djit(scene, vertices, indices, normal, uv, diffuseTexture, specularTexture, roughnessTexture, fov, envMap, spp=8, seed=1):
-        """take a texture, update the scene and render it. uses a wrap ad for backpropagation and for gradients
-        we are adding a mitsuba computations in a pytorch pipeline
+        self.fov = 360.0 * torch.atan(self.screenWidth / (2.0 * focal.detach())) / torch.pi # from renderer.py
+        fovs = self.fov.tolist()
 
-        Returns:
-           image : tensorX
-        """
-        params = mi.traverse(scene)
-        params["sensor.x_fov"] = fov
-        # update mesh params
-        # # -> [1 N 3] -> [N 3]
-        params["mesh.vertex_positions"] = dr.ravel(mi.TensorXf(vertices))
-        # REVIEW could slow down the whole thing
-        params["mesh.faces"] = dr.ravel(mi.TensorXf(indices))
-        params["mesh.vertex_normals"] = dr.ravel(mi.TensorXf(normal))
-        params["mesh.vertex_texcoords"] = dr.ravel(mi.TensorXf(uv))
-        # reflance data is [ X Y 3] so we convert our diffuseTexture to it 
-        # update BSDF
-        # https://mitsuba.readthedocs.io/en/stable/src/generated/plugins_bsdfs.html#smooth-diffuse-material-diffuse
-        params["mesh.bsdf.base_color.data"] = mi.TensorXf(diffuseTexture)
-        # params["mesh.bsdf.specular.data"] = mi.TensorXf(specularTexture) # principled doesnt support specular textures
-        params["mesh.bsdf.roughness.data"] = mi.TensorXf(roughnessTexture)
-        
-        #update envMaps
-        params["light.data"] = mi.TensorXf(envMap)
-        #make them differentiable again ?
-        # dr.enable_grad(params["mesh.vertex_positions"])
-        # dr.enable_grad(params["mesh.faces"])
-        # dr.enable_grad(params["mesh.vertex_positions"])
-        # dr.enable_grad(params["mesh.vertex_normals"])
-        # dr.enable_grad(params["mesh.vertex_texcoords"])
-        # dr.enable_grad(params["light.data"])
-        
-        params.update() 
-        img = mi.render(scene, params, spp=8, seed=seed, seed_grad=seed+1)
-        grad_img = dr.grad(img)
-        # grad_img_light = dr.grad(params["light.data"])
-        # # grad_img = dr.grad(params["mesh.vertex_positions"])
-        # # see gradients ?
-        # from matplotlib import pyplot as plt
-        # import matplotlib.cm as cm
-        # plt.imshow(grad_img * 2.0)
-        # plt.axis('off');
-        
-        # vlim = dr.max(dr.abs(grad_img))[0]
-        # print(f'Remapping colors within range: [{-vlim:.2f}, {vlim:.2f}]')
-
-        # fig, axx = plt.subplots(1, 3, figsize=(8, 3))
-        # for i, ax in enumerate(axx):
-        #     ax.imshow(grad_img[..., i], cmap=cm.coolwarm, vmin=-vlim, vmax=vlim)
-        #     ax.set_title('RGB'[i] + ' gradients')
-        #     ax.axis('off')
-        # fig.tight_layout()
-        # plt.show()  
-        
-        return img, grad_img
-        
-    
-        
+        # shared identity: the [1, ...] textures are sliced once so that every frame scene is given the same tensor,
+        # which MitsubaRender converts to drjit once per render and sets on all the frame scenes
+        diffuse = diffuseTexture[0] if diffuseTexture.shape[0] == 1 else None
+        roughness = roughnessTexture[0] if roughnessTexture.shape[0] == 1 else None
+
+        states, frameInputs, tensors = [], [], []
+        def tensorIndex(tensor):
+            if tensor is None:
+                return -1
+            for j, t in enumerate(tensors):
+                if t is tensor:
+                    return j
+            tensors.append(tensor)
+            return len(tensors) - 1
+
+        for i in range(n):
+            state = self.getScene(i)
+            state.setTopology(indices, uv)
+            state.setFov(fovs[i])
+            inputs = state.changedInputs(vertices[i], normal[i], diffuseTexture[i] if diffuse is None else diffuse,
+                                         roughnessTexture[i] if roughness is None else roughness, envMap[i])
+            states.append(state)
+            frameInputs.append([tensorIndex(t) for t in inputs])
 
-    
\ No newline at end of file
+        images = MitsubaRender.apply(states, frameInputs, self.samples, self.seed_inc, self.debugGradients, *tensors)
+        self.seed_inc += 2 * n # Make sure to use different seeds
+        return images
@@ -21,6 +21,33 @@ class SphericalHarmonics:
         uv = np.mgrid[0:res[1], 0:res[0]].astype(np.float32)
         self.theta = torch.from_numpy((math.pi / res[1]) * (uv[1, :, :] + 0.5)).to(self.device)
         self.phi = torch.from_numpy((2 * math.pi / res[0]) * (uv[0, :, :] + 0.5)).to(self.device)
+        self.envMapBasis = {} # sh basis evaluated on the theta/phi grid, per (resolution, bands)
+
+    def getEnvMapBasis(self, bands):
+        '''
+        return the sh basis functions evaluated on the environment map grid (computed once per resolution and bands number)
+        :param bands: number of sh bands
+        :return: tensor [resX * resY, bands * bands]
+        '''
+        key = (self.resolution, bands)
+        if key not in self.envMapBasis:
+            basis = []
+            for l in range(bands):
+                for m in range(-l, l + 1):
+                    basis.append(self.SH(l, m, self.theta, self.phi).reshape(-1))
+            self.envMapBasis[key] = torch.stack(basis, dim=-1).contiguous()
+        return self.envMapBasis[key]
+
+    def getSmoothingScale(self, bands, window = 4):
+        '''
+        smoothSH as a per band diagonal scale: band 0 is kept, bands 1 to 3 are low pass filtered and the higher bands are dropped
+        :return: tensor [bands * bands]
+        '''
+        scale = torch.zeros([bands * bands], dtype=torch.float32, device=self.device)
+        scale[0] = 1.0
+        for l in range(1, min(bands, 4)):
+            scale[l * l: (l + 1) * (l + 1)] = math.pow(math.sin(math.pi * l / window) / (math.pi * l / window), 4.0)
+        return scale
 
     def smoothSH(self, coeffs, window=6):
         ''' multiply (convolve in sptial domain) the coefficients with a low pass filter.
@@ -80,39 +107,33 @@ class SphericalHarmonics:
         :return: environment map tensor [n, resX, resY, 3]
         '''
         assert(shCoeffs.dim() == 3 and shCoeffs.shape[-1] == 3)
-        envMaps = torch.zeros( [shCoeffs.shape[0], self.resolution[0], self.resolution[1], 3]).to(shCoeffs.device)
-        for i in range(shCoeffs.shape[0]):
-            envMap =self.constructEnvMapFromSHCoeffs(shCoeffs[i], smooth)
-            envMaps[i] = envMap
-        return envMaps
+        bands = int(math.sqrt(shCoeffs.shape[1]))
+        assert(bands * bands == shCoeffs.shape[1])
+        basis = self.getEnvMapBasis(bands).to(shCoeffs.device)
+
+        if smooth:
+            shCoeffs = shCoeffs * self.getSmoothingScale(bands).to(shCoeffs.device).view(1, -1, 1)
+
+        # all frames at once: [resX * resY, bands * bands] @ [n, bands * bands, 3]
+        envMaps = torch.matmul(basis, shCoeffs).clamp(min=0.0)
+        return envMaps.view(shCoeffs.shape[0], self.theta.shape[0], self.theta.shape[1], 3)
     
     def constructEnvMapFromSHCoeffs(self, shCoeffs, smooth = False):
-
+        '''
+        create an environment map from the sh coeffs of a single frame
+        :param shCoeffs: float tensor [bands * bands, 3]
+        :param smooth: if True, the first 3 bands are smoothed
+        :return: environment map tensor [resX, resY, 3]
+        '''
         assert (isinstance(shCoeffs, torch.Tensor) and shCoeffs.dim() == 2 and shCoeffs.shape[1] == 3)
-
-        if smooth:
-            smoothed_coeffs = self.smoothSH(shCoeffs.transpose(0, 1), 4)
-        else:
-            smoothed_coeffs =  shCoeffs.transpose(0, 1) #self.smoothSH(shCoeffs.transpose(0, 1), 4) #smooth the first three bands?
-
-        res = self.resolution
-
-        theta = self.theta
-        phi =  self.phi
-        result = torch.zeros(res[0], res[1], smoothed_coeffs.shape[0], device=smoothed_coeffs.device)
-        bands = int(math.sqrt(smoothed_coeffs.shape[1]))
-        i = 0
-
-        for l in range(bands):
-            for m in range(-l, l + 1):
-                sh_factor = self.SH(l, m, theta, phi)
-                result = result + sh_factor.view(sh_factor.shape[0], sh_factor.shape[1], 1) * smoothed_coeffs[:, i]
-                i += 1
-        result = torch.max(result, torch.zeros(res[0], res[1], smoothed_coeffs.shape[0], device=smoothed_coeffs.device))
-        return result
+        return self.toEnvMap(shCoeffs[None], smooth)[0]
     
     def preComputeSHBasisFunction(self, normals, sh_order):
-        """we need a matrix that holds all sh basis function  for our order, it is expensive computations so we save it in this class before
+        """we need a matrix that holds all sh basis function  for our order, it is expensive computations so we save it in this class before.
+        the real sh basis is evaluated directly from the cartesian normals (no acos/atan2, no per (l, m) legendre loops):
+        sin(theta)^m cos(m phi) and sin(theta)^m sin(m phi) are the real and imaginary parts of (x + iy)^m and the associated legendre
+        polynomials are sin(theta)^m times a polynomial in z, both computed with recurrences shared by all orders.
+        gives the same values as SH(l, m, acos(z), atan2(y, x))
 
         Args:
             normals ([B, N, 3] tensor): holds the current normals 
@@ -121,32 +142,44 @@ class SphericalHarmonics:
         Returns:
             [B, N, (sh_order +1)^2 ]: functions used with vSHCoeffs to get a better color approximation
         """
-        # if self.Y is not None:
-        #     return self.Y
-        
         numCoeffs = (sh_order + 1) ** 2  # Calculate the number of SH coefficients
-       
-        # Pre-allocate the tensor to hold SH basis
-        Y = torch.empty((normals.shape[0], normals.shape[1], numCoeffs), device=normals.device)
-        theta = torch.acos(normals[..., 2:]).squeeze()
-        phi = torch.atan2(normals[..., 1:2], normals[..., :1]).squeeze()
-
-        # Compute SH basis for each l, m and normal
-        element = 0
-        for l in range(sh_order+1):
-            for m in range(-l, l + 1):
-                Y_l_m = self.SH(l, m, theta, phi)
-                Y[..., element] = Y_l_m.squeeze()
-                element += 1
+        shape = list(normals.shape[:-1]) + [numCoeffs]
+
+        # Pre-allocate the tensor to hold SH basis (reused when autograd is not recording)
+        if torch.is_grad_enabled() and normals.requires_grad:
+            Y = torch.empty(shape, dtype=normals.dtype, device=normals.device)
+        else:
+            Y = getattr(self, 'Y', None)
+            if Y is None or list(Y.shape) != shape or Y.dtype != normals.dtype or Y.device != normals.device or Y.requires_grad:
+                Y = torch.empty(shape, dtype=normals.dtype, device=normals.device)
+
+        normals = torch.nn.functional.normalize(normals, 2, -1)
+        x, y, z = normals[..., 0], normals[..., 1], normals[..., 2]
+
+        # cos[m] = sin(theta)^m cos(m phi), sin[m] = sin(theta)^m sin(m phi)
+        cos = [torch.ones_like(x)]
+        sin = [torch.zeros_like(x)]
+        for m in range(1, sh_order + 1):
+            cos.append(x * cos[m - 1] - y * sin[m - 1])
+            sin.append(x * sin[m - 1] + y * cos[m - 1])
+
+        pmm = 1.0 # (-1)^m (2m - 1)!!
+        for m in range(sh_order + 1):
+            if m > 0:
+                pmm *= -(2.0 * m - 1.0)
+            # q(l) = P_l^m(z) / sin(theta)^m
+            qPrev = None
+            q = pmm
+            for l in range(m, sh_order + 1):
+                if l == m + 1:
+                    qPrev, q = q, z * (2.0 * m + 1.0) * pmm
+                elif l > m + 1:
+                    qPrev, q = q, ((2.0 * l - 1.0) * z * q - (l + m - 1.0) * qPrev) / (l - m)
+                if m == 0:
+                    Y[..., l * l + l] = self.normlizeSH(l, 0) * q
+                else:
+                    factor = math.sqrt(2.0) * self.normlizeSH(l, m) * q
+                    Y[..., l * l + l + m] = factor * cos[m]
+                    Y[..., l * l + l - m] = factor * sin[m]
         self.Y = Y
-    
-        # normalsJit = dr.cuda.TensorXf(normals.squeeze(0).transpose(0,1)) # convert to tensor TODO possible slow 
-        # print(dr.is_array_v(normalsJit))
-        # print(normalsJit.shape)
-        # print(normalsJit.Size)
-        # return dr.sh_eval(normalsJit,sh_order)
         return Y
-    
-    
-    
-    
\ No newline at end of file
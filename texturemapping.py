@@ -0,0 +1,102 @@
+import torch
+
+class SparseMatMul(torch.autograd.Function):
+    '''
+    y = matrix @ x for a constant sparse matrix (x is dense).
+    the transposed matrix is precomputed so the backward pass is a single sparse-dense product as well
+    '''
+    @staticmethod
+    def forward(ctx, x, matrix, matrixT):
+        ctx.matrixT = matrixT
+        return torch.mm(matrix, x)
+
+    @staticmethod
+    @torch.autograd.function.once_differentiable
+    def backward(ctx, grad):
+        return torch.mm(ctx.matrixT, grad.contiguous()), None, None
+
+class TextureMapping:
+
+    def __init__(self, faces, verticesNumber, uvParametrization):
+        '''
+        precompile the per vertex color -> texture mapping of a uv parametrization into a sparse matrix [texRes * texRes, verticesNumber].
+        each texel is the barycentric interpolation of the 3 vertices of the face it falls in. the seam fix (middle column averaged from its neighbors)
+        and the final flip/permute of the texture are folded in the matrix, so generating a texture is one sparse-dense product
+        :param faces: tensor [trianglesNumber, 3]
+        :param verticesNumber: number of vertices of the mesh
+        :param uvParametrization: dictionary with uvResolution, uvFaces (barycentric weights [texelsNumber, 3]), uvMapFaces [texelsNumber] and uvXYMap [texelsNumber, 2]
+        '''
+        self.resolution = int(uvParametrization['uvResolution'])
+        self.verticesNumber = verticesNumber
+        res = self.resolution
+        halfRes = res // 2
+        device = faces.device
+
+        weights = uvParametrization['uvFaces'].to(torch.float32)
+        vertices = faces[uvParametrization['uvMapFaces'].long()]
+        x = uvParametrization['uvXYMap'][:, 0].long()
+        y = uvParametrization['uvXYMap'][:, 1].long()
+
+        # a texel written twice keeps the last write (as the indexed assignment did)
+        order = torch.arange(x.shape[0], dtype=torch.int64, device=device)
+        lastWrite = torch.full([res * res], -1, dtype=torch.int64, device=device).scatter_reduce(0, x * res + y, order, reduce='amax')
+        keep = lastWrite[x * res + y] == order
+        weights, vertices, x, y = weights[keep], vertices[keep], x[keep], y[keep]
+
+        # seam: the texels of column halfRes are replaced by the average of columns halfRes - 1 and halfRes + 1
+        notSeam = x != halfRes
+        neighbors = (x == halfRes - 1) | (x == halfRes + 1)
+        x = torch.cat([x[notSeam], torch.full_like(x[neighbors], halfRes)])
+        y = torch.cat([y[notSeam], y[neighbors]])
+        vertices = torch.cat([vertices[notSeam], vertices[neighbors]])
+        weights = torch.cat([weights[notSeam], 0.5 * weights[neighbors]])
+
+        # texel (x, y) ends at row res - 1 - y and column x after permute(0, 2, 1, 3).flip([1])
+        rows = ((res - 1 - y) * res + x)[:, None].expand(-1, 3).reshape(-1)
+        cols = vertices.reshape(-1)
+        matrix = torch.sparse_coo_tensor(torch.stack([rows, cols]), weights.reshape(-1), [res * res, self.verticesNumber]).coalesce()
+        self.matrix = matrix.to_sparse_csr()
+        self.matrixT = matrix.t().coalesce().to_sparse_csr()
+        self.buffers = {}
+
+    def getBuffer(self, name, shape, reference):
+        '''
+        return a preallocated output buffer (reallocated only if the shape changes)
+        :param name: buffer name
+        :param shape: buffer shape
+        :param reference: tensor giving the dtype and device of the buffer
+        '''
+        buffer = self.buffers.get(name)
+        if buffer is None or buffer.shape != torch.Size(shape) or buffer.dtype != reference.dtype or buffer.device != reference.device:
+            buffer = torch.empty(shape, dtype=reference.dtype, device=reference.device)
+            self.buffers[name] = buffer
+        return buffer
+
+    def apply(self, colors, name = None):
+        '''
+        generate textures from per vertex colors
+        :param colors: tensor [n, verticesNumber, channels]
+        :param name: if given and autograd is not recording, the textures are written into a preallocated buffer that is overwritten by the next call with the same name
+        :return: textures [n, resolution, resolution, channels]
+        '''
+        assert(colors.dim() == 3 and colors.shape[1] == self.verticesNumber)
+        n, channels = colors.shape[0], colors.shape[2]
+        res = self.resolution
+        if name is not None and not (torch.is_grad_enabled() and colors.requires_grad):
+            if n == 1:
+                textures = self.getBuffer(name, [res * res, channels], colors)
+                torch.mm(self.matrix, colors[0].contiguous(), out=textures)
+                return textures.view(1, res, res, channels)
+            values = self.getBuffer(name + '.values', [self.verticesNumber, n * channels], colors)
+            values.view(self.verticesNumber, n, channels).copy_(colors.permute(1, 0, 2))
+            flat = self.getBuffer(name + '.flat', [res * res, n * channels], colors)
+            torch.mm(self.matrix, values, out=flat)
+            return self.getBuffer(name, [n, res, res, channels], colors).copy_(flat.view(res, res, n, channels).permute(2, 0, 1, 3))
+
+        if n == 1:
+            return SparseMatMul.apply(colors[0].contiguous(), self.matrix, self.matrixT).view(1, res, res, channels)
+
+        # all frames at once: [verticesNumber, n * channels]
+        values = colors.permute(1, 0, 2).reshape(self.verticesNumber, n * channels)
+        textures = SparseMatMul.apply(values, self.matrix, self.matrixT)
+        return textures.view(res, res, n, channels).permute(2, 0, 1, 3).contiguous()
@@ -1,5 +1,6 @@
 import numpy as np
 import drjit as dr
+from drjitbridge import torchToDrjit, drjitToTorch
 import torch
 import cv2
 import os
@@ -139,17 +140,15 @@ def to_torch(arg):
         @staticmethod
         def forward(ctx, arg, handle):
             ctx.drjit_arg = arg
-            if is_llvm:
-                return torch.tensor(np.array(arg))
-            elif is_cuda:
-                return torch.tensor(np.array(arg)).cuda()
+            if is_llvm or is_cuda:
+                return drjitToTorch(arg) # dlpack, no copy
             else:
                 raise TypeError("to_torch(): only cuda and llvm is supported")
 
         @staticmethod
         @torch.autograd.function.once_differentiable
         def backward(ctx, grad_output):
-            dr.set_grad(ctx.drjit_arg, grad_output)
+            dr.set_grad(ctx.drjit_arg, torchToDrjit(grad_output, type(ctx.drjit_arg)))
             dr.enqueue(dr.ADMode.Backward, ctx.drjit_arg)
             dr.traverse(type(ctx.drjit_arg), dr.ADMode.Backward)
             del ctx.drjit_arg
@@ -168,10 +167,8 @@ def from_torch(dtype, arg):
     class FromTorch(dr.CustomOp):
         def eval(self, arg, handle):
             self.torch_arg = arg
-            if dr.is_cuda_v(dtype):
-                return dtype(arg.cuda())
-            elif dr.is_llvm_v(dtype):
-                return dtype(arg.cpu())
+            if dr.is_cuda_v(dtype) or dr.is_llvm_v(dtype):
+                return torchToDrjit(arg, dtype) # dlpack, no copy when arg is already on the backend device
             else:
                 raise TypeError(
                     "from_torch(): only cuda and llvm is supported")
@@ -180,10 +177,8 @@ def from_torch(dtype, arg):
             raise TypeError("from_torch(): forward-mode AD is not supported!")
 
         def backward(self):
-            if dr.is_cuda_v(dtype):
-                grad = torch.tensor(np.array(self.grad_out())).cuda()
-            elif dr.is_llvm_v(dtype):
-                grad = torch.tensor(np.array(self.grad_out())).cuda().cpu()
+            # the gradient goes back to the device of the torch argument (llvm: no gpu round trip)
+            grad = drjitToTorch(self.grad_out()).to(self.torch_arg.device)
             self.torch_arg.backward(grad)
 
     handle = dr.zeros(dtype)